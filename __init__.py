@@ -1,4 +1,4 @@
 """
 Transaq Connector for Python.
 """
-__all__ = ['structures', 'commands']
+__all__ = ['structures', 'decoders', 'offload', 'dispatch', 'aio', 'orders', 'routing', 'conflation', 'metrics', 'transport', 'encoders', 'subscriptions', 'scheduler', 'baskets', 'secmaster', 'history', 'commands']
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Асинхронный фронтенд коннектора для asyncio.
+
+Команды выполняются в экзекьюторе и возвращают фьючерсы, входящие
+сообщения переносятся из потока коллбэка в цикл событий через
+call_soon_threadsafe и раздаются потокам сообщений по корневым тегам::
+
+    conn = AsyncConnector()
+    await conn.initialize("logs", 2)
+    quotes = conn.stream(['quotes'])
+    await conn.subscribe_bidasks("TQBR", ["SBER"])
+    async for quote in quotes:
+        ...
+
+Модуль написан без нового синтаксиса и работает также с trollius.
+"""
+import functools, logging
+from collections import deque
+from structures import message_tag
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+try:
+    StopAsyncIteration
+except NameError:
+    StopAsyncIteration = StopIteration
+
+log = logging.getLogger("transaq.connector")
+
+# Команды, оборачиваемые в асинхронные методы
+COMMANDS = ('uninitialize', 'connect', 'disconnect', 'server_status', 'get_instruments',
+            'subscribe_ticks', 'unsubscribe_ticks', 'subscribe_quotations', 'unsubscribe_quotations',
+            'subscribe_bidasks', 'unsubscribe_bidasks', 'new_order', 'new_stoploss', 'new_takeprofit',
+            'cancel_order', 'cancel_stoploss', 'cancel_takeprofit', 'move_order',
+            'submit_basket', 'cancel_basket', 'get_portfolio', 'get_markets', 'get_history',
+            'load_history', 'get_forts_position', 'get_limits_forts', 'change_pass', 'get_version',
+            'get_sec_info', 'get_limits_tplus', 'get_united_portfolio')
+# Долгие команды, которые выполняются в отдельном экзекьюторе,
+# чтобы не задерживать остальные команды
+LONG_COMMANDS = ('load_history',)
+
+
+class MessageStream(object):
+    """
+    Поток входящих сообщений для async for.
+    Живет в цикле событий коннектора.
+
+    :param loop:
+        Цикл событий.
+    :param maxsize:
+        Сколько непрочитанных сообщений хранить (0 - без ограничений).
+        При переполнении выкидываются самые старые, см. dropped.
+    """
+
+    def __init__(self, loop, maxsize=0):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self._items = deque()
+        self._waiters = deque()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.get()
+
+    def get(self):
+        """
+        Следующее сообщение.
+
+        :return:
+            Фьючерс с сообщением. После закрытия потока - с StopAsyncIteration.
+        """
+        future = asyncio.Future(loop=self.loop)
+        if self._items:
+            future.set_result(self._items.popleft())
+        elif self.closed:
+            future.set_exception(StopAsyncIteration())
+        else:
+            self._waiters.append(future)
+        return future
+
+    def put(self, obj):
+        """
+        Добавить сообщение (из цикла событий).
+        """
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(obj)
+                return
+        self._items.append(obj)
+        if self.maxsize and len(self._items) > self.maxsize:
+            self._items.popleft()
+            self.dropped += 1
+
+    def close(self):
+        """
+        Закрыть поток. Непрочитанные сообщения можно дочитать.
+        """
+        self.closed = True
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_exception(StopAsyncIteration())
+
+
+class AsyncConnector(object):
+    """
+    Коннектор для asyncio.
+    Методы-команды (connect, new_order, subscribe_* и т.д.) принимают те же
+    параметры, что и функции commands, и возвращают фьючерсы с CmdResult.
+
+    :param connector:
+        Синхронный коннектор (по умолчанию модуль commands).
+    :param loop:
+        Цикл событий (по умолчанию текущий).
+    :param executor:
+        Экзекьютор для команд. По умолчанию один поток,
+        чтобы команды уходили в порядке вызова.
+    :param long_executor:
+        Экзекьютор для долгих команд (LONG_COMMANDS).
+    """
+
+    def __init__(self, connector=None, loop=None, executor=None, long_executor=None):
+        if asyncio is None:
+            raise ImportError("asyncio or trollius is required")
+        if connector is None:
+            import commands as connector
+        self.connector = connector
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = executor or ThreadPoolExecutor(1)
+        self.long_executor = long_executor or ThreadPoolExecutor(4)
+        # Тег -> потоки сообщений, None - все сообщения
+        self._streams = {}
+
+    def _call(self, func, *args, **kwargs):
+        return self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def _call_long(self, func, *args, **kwargs):
+        return self.loop.run_in_executor(self.long_executor, functools.partial(func, *args, **kwargs))
+
+    def _handler(self, obj):
+        # Вызывается в потоке коллбэка
+        self.loop.call_soon_threadsafe(self._publish, obj)
+
+    def _publish(self, obj):
+        # Раздать сообщение потокам (в цикле событий)
+        for stream in self._streams.get(message_tag(obj), ()):
+            stream.put(obj)
+        for stream in self._streams.get(None, ()):
+            stream.put(obj)
+
+    def initialize(self, logdir, loglevel, **kwargs):
+        """
+        Инициализация коннектора, см. commands.initialize.
+        Хэндлер сообщений подставляется сам.
+        """
+        return self._call(self.connector.initialize, logdir, loglevel, self._handler, **kwargs)
+
+    def stream(self, tags=None, maxsize=0):
+        """
+        Поток входящих сообщений.
+
+        :param tags:
+            Корневые теги нужных сообщений (None - все).
+        :param maxsize:
+            Сколько непрочитанных сообщений хранить (0 - без ограничений).
+        :return:
+            MessageStream.
+        """
+        stream = MessageStream(self.loop, maxsize)
+        for tag in [None] if tags is None else tags:
+            self._streams.setdefault(tag, []).append(stream)
+        return stream
+
+    def close_stream(self, stream):
+        """
+        Отписать и закрыть поток сообщений.
+        """
+        for tag, streams in list(self._streams.items()):
+            if stream in streams:
+                streams.remove(stream)
+                if not streams:
+                    del self._streams[tag]
+        stream.close()
+
+    def close(self):
+        """
+        Закрыть все потоки сообщений.
+        """
+        for streams in list(self._streams.values()):
+            for stream in list(streams):
+                self.close_stream(stream)
+
+
+def _command(name):
+    # Асинхронная обертка над командой синхронного коннектора
+    call = AsyncConnector._call_long if name in LONG_COMMANDS else AsyncConnector._call
+
+    def command(self, *args, **kwargs):
+        return call(self, getattr(self.connector, name), *args, **kwargs)
+    command.__name__ = name
+    command.__doc__ = u"Асинхронная версия commands.%s." % name
+    return command
+
+
+for _name in COMMANDS:
+    setattr(AsyncConnector, _name, _command(_name))
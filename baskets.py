@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Пачки заявок и снятий (ребалансировка индекса, закрытие позиций в конце дня).
+
+Все команды пачки кодируются заранее (см. encoders), затем отправляются
+из пула потоков, так что ожидание ответа на одну команду не задерживает
+остальные. Темп и очередность при этом задает планировщик сессии, если
+он есть (см. scheduler). Без планировщика темп ничем не ограничен: команды
+уходят так быстро, как позволяет пул. Ошибка отдельной команды не
+прерывает пачку::
+
+    result = conn.submit_basket([dict(board="TQBR", ticker="SBER", client=client,
+                                      buysell="B", quantity=10), ...])
+    for transactionid, res in result.by_transaction.items():
+        ...
+    for index, error in result.failed:
+        ...
+"""
+import logging
+from collections import OrderedDict
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Под вторым питоном нужен бэкпорт futures
+    ThreadPoolExecutor = None
+import encoders
+
+log = logging.getLogger("transaq.connector")
+
+
+class BasketResult(object):
+    """
+    Результат пачки команд.
+
+    :ivar results:
+        Упорядоченный словарь ключ команды (по умолчанию номер в пачке,
+        для снятий - номер снимаемой заявки) -> CmdResult принятых команд.
+    :ivar failed:
+        Список пар (номер команды в пачке, ошибка): исключение при кодировании
+        или отправке либо CmdResult с success=False.
+
+    Ответ может прийти без transactionid, поэтому results по умолчанию
+    ключуется номером в пачке, а по transactionid - by_transaction.
+    """
+
+    def __init__(self):
+        self.results = OrderedDict()
+        self.failed = []
+
+    @property
+    def ok(self):
+        """
+        Все команды пачки приняты.
+        """
+        return not self.failed
+
+    @property
+    def by_transaction(self):
+        """
+        Упорядоченный словарь transactionid -> CmdResult принятых команд,
+        в ответе на которые он есть.
+        """
+        return OrderedDict((res.id, res) for res in self.results.values() if res.id is not None)
+
+    def __len__(self):
+        return len(self.results) + len(self.failed)
+
+    def __repr__(self):
+        return "BasketResult(accepted=%d, failed=%d)" % (len(self.results), len(self.failed))
+
+
+def _encode(encoder, args):
+    # Закодировать одну команду, ошибку вернуть вместо байтов
+    try:
+        if isinstance(args, dict):
+            return encoder(**args)
+        if isinstance(args, (tuple, list)):
+            return encoder(*args)
+        return encoder(args)
+    except Exception as e:
+        return e
+
+
+def encode_orders(orders, master=None):
+    """
+    Закодировать заявки.
+
+    :param orders:
+        Параметры new_order для каждой заявки: словари или кортежи.
+    :param master:
+        SecurityMaster для проверки заявок перед кодированием.
+    :return:
+        Список байтов команд (исключение на месте заявки, которая не закодировалась).
+    """
+    encoder = encoders.new_order
+    if master is not None:
+        def encoder(board, ticker, client, buysell, quantity, price=0, bymarket=True, usecredit=True):
+            quantity, price, _ = master.check_order(board, ticker, buysell, quantity,
+                                                    price, bymarket, usecredit)
+            return encoders.new_order(board, ticker, client, buysell, quantity,
+                                      price, bymarket, usecredit)
+    return [_encode(encoder, order) for order in orders]
+
+
+def encode_cancels(ids, stop=False):
+    """
+    Закодировать снятия заявок.
+
+    :param ids:
+        Номера транзакций.
+    :param stop:
+        Снимать условные заявки (cancelstoporder).
+    :return:
+        Список байтов команд.
+    """
+    encoder = encoders.cancel_stoploss if stop else encoders.cancel_order
+    return [_encode(encoder, id) for id in ids]
+
+
+def execute(send, commands, keys=None, workers=8, executor=None):
+    """
+    Отправить закодированные команды из пула потоков и собрать результаты.
+
+    :param send:
+        Функция отправки байтов команды, возвращающая CmdResult
+        (Connector._send_command).
+    :param commands:
+        Байты команд, исключения считаются ошибками кодирования.
+    :param keys:
+        Ключи результатов по командам (по умолчанию номер команды в пачке:
+        transactionid есть не в каждом ответе).
+    :param workers:
+        Размер пула, если executor не задан.
+    :param executor:
+        Свой экзекьютор вместо временного пула.
+    :return:
+        BasketResult.
+
+    Темп отправки ограничивает только send (планировщик сессии),
+    сама функция команды не придерживает.
+    """
+    if executor is None and ThreadPoolExecutor is None:
+        raise ImportError("concurrent.futures is required for baskets")
+    result = BasketResult()
+    pool = executor or ThreadPoolExecutor(max(1, min(workers, len(commands))))
+    try:
+        futures = [None if isinstance(cmd, Exception) else pool.submit(send, cmd)
+                   for cmd in commands]
+        for i, (cmd, future) in enumerate(zip(commands, futures)):
+            if future is None:
+                result.failed.append((i, cmd))
+                continue
+            try:
+                res = future.result()
+            except Exception as e:
+                result.failed.append((i, e))
+                continue
+            if res is None or res.success is False:
+                result.failed.append((i, res))
+            else:
+                result.results[i if keys is None else keys[i]] = res
+    finally:
+        if executor is None:
+            pool.shutdown(wait=False)
+    if result.failed:
+        log.warn(u"Не прошло %d команд из %d", len(result.failed), len(commands))
+    return result
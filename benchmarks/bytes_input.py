@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк приема сообщения: старый путь (utf-8 -> unicode -> lxml) против
+разбора байтов напрямую. Показывает лишнюю память на unicode-копию и время
+до готового дерева на сообщение для фикстур в исходном размере (типичные
+одиночные сообщения) и раздутых до пачек. Декодирование полей одинаково
+в обоих случаях и в замер не входит.
+"""
+import sys
+from common import fixture, bursts, measure, report
+from eulxml.xmlmap import parseString
+
+
+if __name__ == '__main__':
+    rows = []
+    for name in sorted(bursts):
+        for items in (None, bursts[name]):
+            xml = fixture(name, items)
+            copy = sys.getsizeof(xml.decode('utf8'))
+            old = measure(lambda: parseString(xml.decode('utf8')))
+            new = measure(lambda: parseString(xml))
+            rows.append(("%s x%s" % (name, items or 1), len(xml), copy, old, new, old - new))
+    report("Разбор сообщения в дерево, мкс", rows,
+           ("message", "bytes", "unicode copy, b", "unicode", "bytes", "saved, us"))
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк разбора ответа на команду: как было (Error.parse и CmdResult.parse,
+оба через eulxml) против разбора за один проход в commands._reply.
+"""
+from common import measure, report
+from structures import Error, CmdResult
+import commands
+
+
+def eulxml_reply(msg):
+    # Как было в _send_command
+    err = Error.parse(msg)
+    if err.text:
+        return err.text, None
+    return None, CmdResult.parse(msg)
+
+
+if __name__ == '__main__':
+    replies = [
+        ("result", '<result success="true" transactionid="4581"/>'),
+        ("result message", '<result success="false"><message>Недостаточно средств</message></result>'),
+        ("error", '<error>Нет связи с сервером</error>'),
+        ("result fallback", '<result transactionid="4581" success="true"/>'),
+    ]
+    rows = []
+    for name, msg in replies:
+        old = measure(lambda: eulxml_reply(msg))
+        new = measure(lambda: commands._reply(msg))
+        rows.append((name, old, new, "%.2fx" % (old / new)))
+    report("Разбор ответа на команду, мкс", rows, ("reply", "eulxml", "single pass", "speedup"))
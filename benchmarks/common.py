@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Общие помощники для бенчмарков: фикстуры из tests/, раздутые до
+реалистичных размеров пачек, и простой замер времени.
+
+Запуск бенчмарков из корня репозитория:
+    PYTHONPATH=. python benchmarks/<имя>.py
+"""
+import copy, os, timeit
+import lxml.etree as et
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tests')
+
+# Типичные размеры пачек (элементов в пакете) по фикстурам
+bursts = {
+    'alltrades.xml': 500,
+    'quotes.xml': 200,
+    'quotations.xml': 300,
+    'orders.xml': 100,
+    'trades.xml': 100,
+    'positions.xml': 50,
+    'candles.xml': 1000,
+    'securities.xml': 2000,
+}
+
+
+def fixture(name, items=None):
+    """
+    Текст фикстуры в байтах, при необходимости размноженный до items дочерних элементов.
+
+    :param name:
+        Имя файла в tests/.
+    :param items:
+        Желаемое количество дочерних элементов корня.
+    :return:
+        XML в utf-8.
+    """
+    with open(os.path.join(fixtures_dir, name), 'rb') as f:
+        xml = f.read()
+    if not items:
+        return xml
+    root = et.fromstring(xml)
+    children = list(root)
+    for i in range(len(children), items):
+        root.append(copy.deepcopy(children[i % len(children)]))
+    return et.tostring(root, encoding='utf-8', xml_declaration=False)
+
+
+def burst_fixtures():
+    """
+    Все фикстуры из bursts, размноженные до типичных размеров.
+
+    :return:
+        Список пар (имя, xml).
+    """
+    return [(name, fixture(name, n)) for name, n in sorted(bursts.items())]
+
+
+def measure(func, number=None, repeat=5):
+    """
+    Лучшее время одного вызова func в микросекундах.
+
+    :param func:
+        Функция без аргументов.
+    :param number:
+        Количество вызовов в серии, по умолчанию подбирается на ~0.2с.
+    :param repeat:
+        Количество серий.
+    :return:
+        Микросекунды на вызов.
+    """
+    timer = timeit.Timer(func)
+    if number is None:
+        number = 1
+        while timer.timeit(number) < 0.2:
+            number *= 2
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def report(title, rows, columns):
+    """
+    Напечатать таблицу результатов.
+
+    :param title:
+        Заголовок.
+    :param rows:
+        Список кортежей (имя, значение, ...).
+    :param columns:
+        Заголовки колонок.
+    """
+    print title
+    print ''.join('%-22s' % c for c in columns)
+    for row in rows:
+        print ''.join(('%-22.1f' if isinstance(v, float) else '%-22s') % v for v in row)
+    print
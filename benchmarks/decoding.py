@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк декодирования уже распарсенного дерева в значения полей:
+eulxml (XPath на каждое поле) против сгенерированных декодеров.
+"""
+from common import burst_fixtures, measure, report
+from eulxml.xmlmap import parseString
+import structures
+
+
+if __name__ == '__main__':
+    rows = []
+    for name, xml in burst_fixtures():
+        root = parseString(xml)
+        cls = structures.registered_class(root.tag)
+        old = measure(lambda: cls.from_element(root).to_record())
+        new = measure(lambda: cls.decode(root))
+        rows.append((name, cls.__name__, old, new, "%.2fx" % (old / new)))
+    report("Все поля пакета, мкс на сообщение", rows,
+           ("fixture", "class", "eulxml", "decoder", "speedup"))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк кодирования команд заявок: построение дерева lxml и et.tostring
+на каждую команду (как было) против готовых байтовых шаблонов encoders.
+"""
+from common import measure, report
+import lxml.etree as et
+import encoders
+
+
+def _elem(tag, text):
+    elem = et.Element(tag)
+    elem.text = text
+    return elem
+
+
+def lxml_new_order(board, ticker, client, buysell, quantity, price=0, bymarket=True, usecredit=True):
+    # Как было в commands.new_order
+    root = et.Element("command", {"id": "neworder"})
+    sec = et.Element("security")
+    sec.append(_elem("board", board))
+    sec.append(_elem("seccode", ticker))
+    root.append(sec)
+    root.append(_elem("client", client))
+    root.append(_elem("buysell", buysell.upper()))
+    root.append(_elem("quantity", str(quantity)))
+    if not bymarket:
+        root.append(_elem("price", str(price)))
+    else:
+        root.append(et.Element("bymarket"))
+    if usecredit:
+        root.append(et.Element("usecredit"))
+    return et.tostring(root, encoding="utf-8")
+
+
+def lxml_cancel_order(id):
+    root = et.Element("command", {"id": "cancelorder"})
+    root.append(_elem("transactionid", str(id)))
+    return et.tostring(root, encoding="utf-8")
+
+
+if __name__ == '__main__':
+    cases = [
+        ("neworder market", ("TQBR", "SBER", "C1", "b", 10)),
+        ("neworder limit", ("TQBR", "SBER", "C1", "b", 10, 250.75, False)),
+        ("neworder unicode", ("TQBR", u"SBER", u"клиент", "s", 10, 250.75, False)),
+    ]
+    rows = []
+    for name, args in cases:
+        old = measure(lambda: lxml_new_order(*args))
+        new = measure(lambda: encoders.new_order(*args))
+        rows.append((name, old, new, "%.2fx" % (old / new)))
+    old = measure(lambda: lxml_cancel_order(4581))
+    new = measure(lambda: encoders.cancel_order(4581))
+    rows.append(("cancelorder", old, new, "%.2fx" % (old / new)))
+    report("Кодирование команды, мкс", rows, ("command", "lxml", "template", "speedup"))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк накладных расходов логирования в пути доставки: Connector._dispatch
+на разобранных сообщениях при уровне логгера INFO (с обработчиком, пишущим
+в никуда, чтобы форматирование честно выполнялось) и WARNING. Для сравнения -
+прежнее форматирование строки на каждое сообщение и цена __repr__.
+"""
+import logging, os
+from common import fixture, measure, report
+from structures import parse
+import commands
+
+
+def eager(obj):
+    # Как было: строка собирается до проверки уровня
+    commands.log.info(u"Получил объект типа %s" % str(type(obj)))
+
+
+if __name__ == '__main__':
+    log = commands.log
+    # Библиотека для доставки не нужна
+    conn = commands.Connector(library=object())
+    log.addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+    log.propagate = False
+    rows = []
+    for name in ('quotes.xml', 'alltrades.xml', 'orders.xml', 'positions.xml'):
+        obj = parse(fixture(name))
+        timings = []
+        for level in (logging.INFO, logging.WARNING):
+            log.setLevel(level)
+            timings.append(measure(lambda: conn._dispatch(obj)))
+        timings.append(measure(lambda: eager(obj)))
+        timings.append(measure(lambda: repr(obj)))
+        rows.append((name,) + tuple(timings))
+    report("Накладные расходы на сообщение, мкс", rows,
+           ("message", "dispatch at INFO", "dispatch at WARNING", "eager at WARNING", "repr"))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк общего парсинга: старый путь (корневой тег отдельным парсингом,
+затем повторный разбор текста классом) против одного разбора на сообщение.
+"""
+from common import burst_fixtures, measure, report
+from eulxml.xmlmap import parseString, load_xmlobject_from_string
+import structures
+
+
+def double_parse(xml):
+    # Так работал parse() раньше: текст разбирается дважды
+    cls = structures.registered_class(parseString(xml).tag)
+    if cls.from_element.im_func is structures.MyXmlObject.from_element.im_func:
+        return load_xmlobject_from_string(xml, cls)
+    return cls.from_element(parseString(xml))
+
+
+if __name__ == '__main__':
+    rows = []
+    for name, xml in burst_fixtures():
+        old = measure(lambda: double_parse(xml))
+        new = measure(lambda: structures.parse(xml))
+        rows.append((name, len(xml), old, new, "%.2fx" % (old / new)))
+    report("parse(), мкс на сообщение", rows,
+           ("fixture", "bytes", "double parse", "single parse", "speedup"))
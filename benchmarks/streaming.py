@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк потокового разбора огромного пакета бумаг: пиковая память процесса
+и время до первого элемента при полном разборе и через Packet.stream.
+Каждый режим запускается в отдельном процессе, т.к. пик памяти не сбрасывается.
+"""
+import os, resource, subprocess, sys, tempfile, time
+from common import fixture
+
+modes = ('parse', 'parse_compact', 'stream', 'stream_compact')
+
+
+def run(mode, path):
+    import structures
+    start = time.time()
+    first = None
+    count = 0
+    if mode.startswith('parse'):
+        packet = structures.parse(open(path, 'rb').read(), compact=mode.endswith('compact'))
+        items = packet.items
+        for item in items:
+            if first is None:
+                first = time.time() - start
+            item.seccode
+            count += 1
+    else:
+        with open(path, 'rb') as f:
+            for item in structures.SecurityPacket.stream(f, compact=mode.endswith('compact')):
+                if first is None:
+                    first = time.time() - start
+                item.seccode
+                count += 1
+    total = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print "%-18s%-10d%-14.1f%-14.3f%-14.3f" % (mode, count, peak, first, total)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3:
+        # Фикстуру тоже готовим в отдельном процессе, чтобы ее пик памяти
+        # не достался по наследству замерам
+        open(sys.argv[2], 'wb').write(fixture('securities.xml', int(sys.argv[3])))
+        sys.exit()
+    if len(sys.argv) > 2:
+        run(sys.argv[1], sys.argv[2])
+        sys.exit()
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    os.close(fd)
+    try:
+        subprocess.check_call([sys.executable, __file__, 'prepare', path, str(items)])
+        print "SecurityPacket, %d бумаг, %.1f Мб" % (items, os.path.getsize(path) / 1048576.)
+        print "%-18s%-10s%-14s%-14s%-14s" % ("mode", "items", "peak RSS, Mb", "first item, s", "total, s")
+        for mode in modes:
+            sys.stdout.flush()
+            subprocess.check_call([sys.executable, __file__, mode, path])
+    finally:
+        os.remove(path)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк сквозной пропускной способности: симулятор коннектора проигрывает
+пачки из фикстур без ограничения частоты, Connector разбирает их и отдает
+хэндлеру. Сравниваются режимы доставки: объекты eulxml, компактные записи,
+компактные записи через очередь с рабочим потоком. Поля объектов eulxml
+вычисляются лениво, хэндлер их не читает, так что для них это только
+стоимость построения дерева.
+"""
+import shutil, tempfile, threading
+from timeit import default_timer as timer
+from common import burst_fixtures, report
+from commands import Connector
+from transport import SimulatedTransport
+from dispatch import DispatchQueue
+
+
+def run(messages, repeat, **options):
+    # Сообщений в секунду и МБ в секунду для одного режима
+    total = len(messages) * repeat
+    done = threading.Event()
+    got = [0]
+
+    def handler(obj):
+        if obj.ROOT_NAME != 'server_status':
+            got[0] += 1
+            if got[0] == total:
+                done.set()
+    sim = SimulatedTransport(messages, repeat=repeat)
+    conn = Connector(library=sim)
+    logdir = tempfile.mkdtemp()
+    try:
+        conn.initialize(logdir, 1, handler, **options)
+        try:
+            start = timer()
+            conn.connect("login", "password", "localhost:3900")
+            done.wait()
+            elapsed = timer() - start
+        finally:
+            conn.uninitialize()
+    finally:
+        shutil.rmtree(logdir, ignore_errors=True)
+    size = sum(len(xml) for xml in messages) * repeat
+    return total / elapsed, size / elapsed / 1e6
+
+
+if __name__ == '__main__':
+    messages = [xml for name, xml in burst_fixtures()]
+    rows = []
+    for title, options in [("eulxml", {}), ("compact", {'compact': True}),
+                           ("compact + queue", {'compact': True, 'queue': DispatchQueue(workers=1)})]:
+        rows.append((title,) + run(messages, 5, **options))
+    report("Пропускная способность (пачки из фикстур)", rows, ("mode", "msgs/s", "MB/s"))
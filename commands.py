@@ -5,55 +5,51 @@
 
 .. note::
     Практически все команды асинхронны!
-    Это означает что они возвращают структуру CmdResult, которая говорит лишь
-    об успешности отправки команды на сервер, но не её исполнения там.
+    Это означает что они возвращают CmdResult (компактной записью, см. structures.Record),
+    который говорит лишь об успешности отправки команды на сервер, но не её исполнения там.
     Результат исполнения приходит позже в зарегистрированный командой *initialize()* хэндлер.
     Синхронные вспомогательные команды помечены отдельно.
+
+Сессия коннектора - объект Connector со своей библиотекой, коллбэком и
+состоянием, так что в одном процессе можно держать несколько подключений
+(например, поделив подписки между логинами). Функции модуля работают
+с сессией по умолчанию, которая создается при первом обращении.
+
+.. note::
+    Одна и та же dll, загруженная дважды, остается одной библиотекой.
+    Для независимых сессий нужны копии txmlconnector.dll под разными именами.
+
+.. note::
+    Глобальных переменных сессии в модуле больше нет, их заменяют
+    атрибуты сессии по умолчанию:
+
+    * global_handler - default_connector().handler;
+    * connected - default_connector().connected;
+    * txml_dll - default_connector().dll;
+    * callback - default_connector().callback.
 """
 import ctypes, logging
-import platform, os, sys
+import platform, os, re, sys, threading
 import lxml.etree as et
 from structures import *
+import encoders, baskets
+from subscriptions import SubscriptionManager, STREAMS
+from history import HistoryLoader
+from metrics import timer, COPY, PARSE, HANDLER, QUEUE
 log = logging.getLogger("transaq.connector")
 
-callback_func = ctypes.WINFUNCTYPE(ctypes.c_bool, ctypes.c_char_p)
-global_handler = None
+# Сообщение приходит указателем: копируем сами и освобождаем через FreeMemory
+callback_func = getattr(ctypes, 'WINFUNCTYPE', ctypes.CFUNCTYPE)(ctypes.c_bool, ctypes.c_void_p)
+# Служебные сообщения коннектор разбирает всегда
+service_tags = frozenset([Error.ROOT_NAME, ServerStatus.ROOT_NAME])
 path = ""
 if __file__ is not None:
     path = os.path.dirname(__file__)
     if path != "":
         path += os.sep
-
-txml_dll = ctypes.WinDLL(path + ("txmlconnector64.dll" if platform.machine() == 'AMD64' else 'txmlconnector.dll') )
-connected = False
-encoding = sys.stdout.encoding
-
-
-@callback_func
-def callback(msg):
-    """
-    Функция, вызываемая коннектором при входящих сообщениях.
-
-    :param msg:
-        Входящее сообщение Транзака.
-    :return:
-        True если все обработал.
-    """
-    obj = parse(msg.decode('utf8'))
-    if isinstance(obj, Error):
-        log.error(u"Траблы: %s" % obj.text)
-        raise TransaqException(obj.text.encode(encoding))
-    elif isinstance(obj, ServerStatus):
-        log.info(u"Соединен с серваком: %s" % obj.connected)
-        if obj.connected == 'error':
-            log.warn(u"Ёпта, ошибка соединения: %s" % obj.text)
-        log.debug(obj)
-    else:
-        log.info(u"Получил объект типа %s" % str(type(obj)))
-        log.debug(obj)
-    if global_handler:
-        global_handler(obj)
-    return True
+# Библиотека по умолчанию
+dll_path = path + ("txmlconnector64.dll" if platform.machine() == 'AMD64' else 'txmlconnector.dll')
+encoding = sys.stdout.encoding or 'utf-8'
 
 
 class TransaqException(Exception):
@@ -63,443 +59,746 @@ class TransaqException(Exception):
     pass
 
 
-def __get_message(ptr):
-    # Достать сообщение из нативной памяти.
-    msg = ctypes.string_at(ptr)
-    txml_dll.FreeMemory(ptr)
-    return unicode(msg, 'utf8')
-
-
-def __elem(tag, text):
+def _elem(tag, text):
     # Создать элемент с заданным текстом.
     elem = et.Element(tag)
     elem.text = text
     return elem
 
 
-def __send_command(cmd):
-    # Отправить команду и проверить на ошибки.
-    msg = __get_message(txml_dll.SendCommand(cmd))
-    err = Error.parse(msg)
-    if err.text:
-        raise TransaqException(err.text.encode(encoding))
-    else:
-        return CmdResult.parse(msg)
+# Типовой ответ на команду: <result success=".." [transactionid=".."]/> с необязательным
+# <message>, либо <error>текст</error>. Все остальное (сущности, другой порядок атрибутов)
+# разбирает lxml.
+_reply_re = re.compile(r'\s*<(?:result\s+success="(true|false)"(?:\s+transactionid="(\d+)")?\s*'
+                       r'(?:/>|>\s*(?:<message>([^<&]*)</message>\s*)?</result>)|'
+                       r'(error)>([^<&]*)</error>)\s*\Z')
 
 
-def initialize(logdir, loglevel, msg_handler):
+def _reply(msg):
     """
-    Инициализация коннектора (синхронная).
-
-    :param logdir:
-    :param loglevel:
-    :param msg_handler:
-    """
-    global global_handler
-    global_handler = msg_handler
-    if not os.path.exists(logdir):
-        os.mkdir(logdir)
-    err = txml_dll.Initialize(logdir + "\0", loglevel)
-    if err != 0:
-        msg = __get_message(err)
-        raise TransaqException(Error.parse(msg).text.encode(encoding))
-    if not txml_dll.SetCallback(callback):
-        raise TransaqException(u"Коллбэк не установился")
-
-
-def uninitialize():
-    """
-    Де-инициализация коннектора (синхронная).
+    Разобрать ответ на команду за один проход, без eulxml.
 
+    :param msg:
+        Ответ в байтах.
     :return:
+        Пара (текст ошибки или None, запись CmdResult или None при ошибке).
     """
-    if connected:
-        disconnect()
-    err = txml_dll.UnInitialize()
-    if err != 0:
-        msg = __get_message(err)
-        raise TransaqException(Error.parse(msg).text.encode(encoding))
-
+    m = _reply_re.match(msg)
+    if m is None:
+        root = et.fromstring(msg)
+        if root.tag == Error.ROOT_NAME and root.text:
+            return root.text, None
+        # Как и раньше, пустая ошибка или незнакомый ответ дают пустой результат
+        return None, CmdResult.decode(root)
+    if m.group(4):
+        text = m.group(5)
+        return (text.decode('utf-8'), None) if text else (None, _result())
+    text, id = m.group(3), m.group(2)
+    return None, _result(m.group(1) == 'true', text.decode('utf-8') if text is not None else None,
+                         int(id) if id else None)
 
-def connect(login, password, server, min_delay=100):
-    host, port = server.split(':')
-    root = et.Element("command", {"id": "connect"})
-    root.append(__elem("login", login))
-    root.append(__elem("password", password))
-    root.append(__elem("host", host))
-    root.append(__elem("port", port))
-    root.append(__elem("rqdelay", str(min_delay)))
-    return __send_command(et.tostring(root, encoding="utf-8"))
 
+_result = CmdResult.record_class()
+# id команды для планировщика
+_command_id_re = re.compile(r'<command\b[^>]*?\bid="([^"]*)"')
 
-def disconnect():
-    global connected
-    root = et.Element("command", {"id": "disconnect"})
-    return __send_command(et.tostring(root, encoding="utf-8"))
-    # connected = False
-
-
-def server_status():
-    root = et.Element("command", {"id": "server_status"})
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def get_instruments():
-    root = et.Element("command", {"id": "get_securities"})
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def __subscribe_helper(board, tickers, cmd, mode):
-    root = et.Element("command", {"id": cmd})
-    trades = et.Element(mode)
-    for t in tickers:
-        sec = et.Element("security")
-        sec.append(__elem("board", board))
-        sec.append(__elem("seccode", t))
-        trades.append(sec)
-    root.append(trades)
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def subscribe_ticks(board, tickers):
-    return __subscribe_helper(board, tickers, "subscribe", "alltrades")
-
-
-def unsubscribe_ticks(board, tickers):
-    return __subscribe_helper(board, tickers, "unsubscribe", "alltrades")
-
-
-def subscribe_quotations(board, tickers):
-    return __subscribe_helper(board, tickers, "subscribe", "quotations")
-
-
-def unsubscribe_quotations(board, tickers):
-    return __subscribe_helper(board, tickers, "unsubscribe", "quotations")
-
-
-def subscribe_bidasks(board, tickers):
-    return __subscribe_helper(board, tickers, "subscribe", "quotes")
 
-
-def unsubscribe_bidasks(board, tickers):
-    return __subscribe_helper(board, tickers, "unsubscribe", "quotes")
-
-
-def new_order(board, ticker, client, buysell, quantity, price=0,
-              bymarket=True, usecredit=True):
-    # Add hidden, unfilled, nosplit
-    root = et.Element("command", {"id": "neworder"})
-    sec = et.Element("security")
-    sec.append(__elem("board", board))
-    sec.append(__elem("seccode", ticker))
-    root.append(sec)
-    root.append(__elem("client", client))
-    root.append(__elem("buysell", buysell.upper()))
-    root.append(__elem("quantity", str(quantity)))
-    if not bymarket:
-        root.append(__elem("price", str(price)))
-    else:
-        root.append(et.Element("bymarket"))
-    if usecredit:
-        root.append(et.Element("usecredit"))
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def new_stoploss(board, ticker, client, buysell, quantity, trigger_price, price=0,
-                 bymarket=True, usecredit=True, linked_order=None, valid_for=None):
-    root = et.Element("command", {"id": "newstoporder"})
-    sec = et.Element("security")
-    sec.append(__elem("board", board))
-    sec.append(__elem("seccode", ticker))
-    root.append(sec)
-    root.append(__elem("client", client))
-    root.append(__elem("buysell", buysell.upper()))
-    if linked_order:
-        root.append(__elem("linkedorderno", str(linked_order)))
-    if valid_for:
-        root.append(__elem("validfor", valid_for.strftime(timeformat)))
-
-    sl = et.Element("stoploss")
-    sl.append(__elem("quantity", str(quantity)))
-    sl.append(__elem("activationprice", str(trigger_price)))
-    if not bymarket:
-        sl.append(__elem("orderprice", str(price)))
-    else:
-        sl.append(et.Element("bymarket"))
-    if usecredit:
-        sl.append(et.Element("usecredit"))
-
-    root.append(sl)
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def new_takeprofit(board, ticker, client, buysell, quantity, trigger_price,
-                   correction=0, use_credit=True, linked_order=None, valid_for=None):
-    root = et.Element("command", {"id": "newstoporder"})
-    sec = et.Element("security")
-    sec.append(__elem("board", board))
-    sec.append(__elem("seccode", ticker))
-    root.append(sec)
-    root.append(__elem("client", client))
-    root.append(__elem("buysell", buysell.upper()))
-    if linked_order:
-        root.append(__elem("linkedorderno", str(linked_order)))
-    if valid_for:
-        root.append(__elem("validfor", valid_for.strftime(timeformat)))
-
-    tp = et.Element("takeprofit")
-    tp.append(__elem("quantity", str(quantity)))
-    tp.append(__elem("activationprice", str(trigger_price)))
-    tp.append(et.Element("bymarket"))
-    if use_credit:
-        tp.append(et.Element("usecredit"))
-    if correction:
-        tp.append(__elem("correction", str(correction)))
-    root.append(tp)
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def cancel_order(id):
-    root = et.Element("command", {"id": "cancelorder"})
-    root.append(__elem("transactionid", str(id)))
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def cancel_stoploss(id):
-    root = et.Element("command", {"id": "cancelstoporder"})
-    root.append(__elem("transactionid", str(id)))
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def cancel_takeprofit(id):
-    cancel_stoploss(id)
-
-
-def get_portfolio(client):
-    root = et.Element("command", {"id": "get_portfolio", "client": client})
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def get_markets():
+def load_library(path):
     """
-    Получить список рынков.
+    Загрузить библиотеку коннектора и описать сигнатуры ее функций.
 
+    :param path:
+        Путь к txmlconnector(64).dll.
     :return:
-        Результат отправки команды.
-    """
-    root = et.Element("command", {"id": "get_markets"})
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def get_history(board, seccode, period, count, reset=True):
-    """
-    Выдать последние N свечей заданного периода, по заданному инструменту.
-
-    :param board:
-        Идентификатор режима торгов.
-    :param seccode:
-        Код инструмента.
-    :param period:
-        Идентификатор периода.
-    :param count:
-        Количество свечей.
-    :param reset:
-        Параметр reset="true" говорит, что нужно выдавать самые свежие данные, в
-        противном случае будут выданы свечи в продолжение предыдущего запроса.
-    :return:
-        Результат отправки команды.
-    """
-    root = et.Element("command", {"id": "gethistorydata"})
-    sec = et.Element("security")
-    sec.append(__elem("board", board))
-    sec.append(__elem("seccode", seccode))
-    root.append(sec)
-    root.append(__elem("period", str(period)))
-    root.append(__elem("count", str(count)))
-    root.append(__elem("reset", "true" if reset else "false"))
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-# TODO Доделать условные заявки
-def new_condorder(board, ticker, client, buysell, quantity, price,
-                  cond_type, cond_val, valid_after, valid_before,
+        Библиотека ctypes.
+    """
+    dll = getattr(ctypes, 'WinDLL', ctypes.CDLL)(path)
+    # Функции возвращают указатели на сообщения, на 64 битах int их обрезает
+    for name in ('Initialize', 'UnInitialize', 'SendCommand'):
+        getattr(dll, name).restype = ctypes.c_void_p
+    dll.FreeMemory.argtypes = [ctypes.c_void_p]
+    dll.SetCallback.argtypes = [callback_func]
+    dll.SetCallback.restype = ctypes.c_bool
+    return dll
+
+
+class Connector(object):
+    """
+    Сессия Транзак Коннектора: своя библиотека, коллбэк и состояние.
+
+    :param path:
+        Путь к библиотеке коннектора (по умолчанию dll_path).
+    :param library:
+        Уже загруженная библиотека (или объект с теми же функциями:
+        Initialize, SetCallback, SendCommand, FreeMemory, UnInitialize).
+    """
+
+    def __init__(self, path=None, library=None):
+        self.path = path or dll_path
+        self._dll = library
+        self.handler = None
+        self.connected = False
+        # Отдавать хэндлеру компактные записи вместо объектов eulxml
+        self.compact = False
+        # Корневые теги нужных сообщений (None - все) и теги, отдаваемые без разбора
+        self.wanted_tags = None
+        self.raw_tags = frozenset()
+        # Разбор тяжелых сообщений в пуле процессов (см. offload.Offloader)
+        self.offloader = None
+        # Очередь между коллбэком и хэндлером (см. dispatch.DispatchQueue)
+        self.dispatch_queue = None
+        # Фьючерсы заявок по номеру транзакции (см. orders.OrderTracker)
+        self.order_tracker = None
+        # Метрики приема по тегам (см. metrics.Metrics)
+        self.metrics = None
+        # Справочник инструментов для проверки заявок (см. secmaster.SecurityMaster)
+        self.security_master = None
+        # Очередность и темп отправки команд (см. scheduler.CommandScheduler)
+        self.scheduler = None
+        # Подписки со счетчиком ссылок (см. subscriptions.SubscriptionManager)
+        self.subscriptions = SubscriptionManager(self)
+        # Загрузка истории постранично (см. history.HistoryLoader)
+        self.history = HistoryLoader(self)
+        # Ссылку на коллбэк надо держать, пока он установлен в библиотеке
+        self.callback = callback_func(self._callback)
+
+    @property
+    def dll(self):
+        """
+        Библиотека коннектора (загружается при первом обращении).
+        """
+        if self._dll is None:
+            self._dll = load_library(self.path)
+        return self._dll
+
+    def _callback(self, ptr):
+        # Функция, вызываемая коннектором при входящих сообщениях.
+        # Принимает указатель на сообщение (байты в utf-8), возвращает
+        # True если все обработал.
+        metrics = self.metrics
+        # uninitialize может обнулить очередь из другого потока
+        queue = self.dispatch_queue
+        if metrics is not None:
+            start = timer()
+            msg = self._get_message(ptr)
+            copied = timer() - start
+        else:
+            msg = self._get_message(ptr)
+        tag = None
+        if self.wanted_tags is not None or self.raw_tags or self.offloader is not None \
+                or queue is not None or metrics is not None:
+            # Дешевая проверка по сырому тексту, без парсинга
+            tag = root_tag(msg)
+            if self.wanted_tags is not None and tag not in self.wanted_tags:
+                return True
+        timed = metrics is not None and metrics.count(tag, len(msg))
+        if timed:
+            metrics.observe(tag, COPY, copied)
+        if queue is not None:
+            # Разбор и хэндлер в рабочих потоках, библиотеку не держим
+            queue.put(tag, msg, timed)
+            return True
+        self._process(tag, msg, timed)
+        return True
+
+    def _process_queued(self, tag, msg, waited):
+        # Обработка в рабочем потоке очереди
+        if waited is not None:
+            self.metrics.observe(tag, QUEUE, waited)
+        self._process(tag, msg, waited is not None)
+
+    def _process(self, tag, msg, timed=False):
+        # Разобрать сообщение и отдать хэндлеру, с замерами если timed.
+        if tag in self.raw_tags:
+            obj = RawMessage(tag, msg)
+            log.debug(obj)
+            if self.handler:
+                self.handler(obj)
+            return
+        if self.offloader is not None and tag not in service_tags:
+            if self.offloader.wants(tag, msg):
+                self.offloader.submit(tag, msg)
+            else:
+                self.offloader.deliver(tag, parse(msg, self.compact))
+            return
+        if not timed:
+            self._dispatch(parse(msg, self.compact))
+            return
+        start = timer()
+        obj = parse(msg, self.compact)
+        parsed = timer()
+        self.metrics.observe(tag, PARSE, parsed - start)
+        try:
+            self._dispatch(obj)
+        finally:
+            self.metrics.observe(tag, HANDLER, timer() - parsed)
+
+    def _dispatch(self, obj):
+        # Обработать разобранное сообщение и отдать хэндлеру.
+        # У записей и объектов eulxml корневой тег общий
+        kind = getattr(obj, 'ROOT_NAME', None)
+        if kind == Error.ROOT_NAME:
+            log.error(u"Траблы: %s", obj.text)
+            raise TransaqException(obj.text.encode(encoding))
+        elif kind == ServerStatus.ROOT_NAME:
+            log.info(u"Соединен с серваком: %s", obj.connected)
+            connected = obj.connected == 'true'
+            if connected != self.connected:
+                self.subscriptions.on_status(connected)
+            self.connected = connected
+            if obj.connected == 'error':
+                log.warn(u"Ёпта, ошибка соединения: %s", obj.text)
+            log.debug(obj)
+        else:
+            # Одна проверка уровня на сообщение, форматирование только если пишем
+            if log.isEnabledFor(logging.INFO):
+                log.info(u"Получил объект типа %s", type(obj))
+                log.debug(obj)
+            if self.order_tracker is not None:
+                self.order_tracker.on_message(obj)
+            if self.security_master is not None:
+                self.security_master.on_message(obj)
+            if kind == HistoryCandlePacket.ROOT_NAME:
+                self.history.on_message(obj)
+        if self.handler:
+            self.handler(obj)
+
+    def _get_message(self, ptr):
+        # Достать сообщение из нативной памяти. Отдаем байты как есть,
+        # lxml сам разберет utf-8 без промежуточной unicode-копии.
+        try:
+            return ctypes.string_at(ptr)
+        finally:
+            self.dll.FreeMemory(ptr)
+
+    def _send_command(self, cmd):
+        # Отправить команду и проверить на ошибки.
+        if self.scheduler is not None:
+            m = _command_id_re.match(cmd)
+            self.scheduler.acquire(self.scheduler.lane(m.group(1) if m else None))
+        err, result = _reply(self._get_message(self.dll.SendCommand(cmd)))
+        if err:
+            raise TransaqException(err.encode(encoding))
+        return result
+
+    def initialize(self, logdir, loglevel, msg_handler, compact=False, tags=None, raw=(),
+                   offload=None, queue=None, tracker=None, metrics=None, scheduler=None,
+                   master=None):
+        """
+        Инициализация коннектора (синхронная).
+
+        :param logdir:
+        :param loglevel:
+        :param msg_handler:
+        :param compact:
+            Отдавать хэндлеру компактные записи (см. structures.Record)
+            вместо объектов eulxml.
+        :param tags:
+            Корневые теги сообщений, которые нужны хэндлеру (None - все).
+            Остальные выкидываются прямо в коллбэке без разбора.
+            Ошибки и статус сервера приходят всегда.
+        :param raw:
+            Теги, которые отдаются хэндлеру без разбора, как RawMessage
+            (байты и тег, разбор по требованию).
+        :param offload:
+            Offloader для разбора тяжелых сообщений в пуле процессов.
+            Разобранные в пуле сообщения приходят компактными записями.
+        :param queue:
+            DispatchQueue: коллбэк только кладет сообщения в очередь,
+            разбор и хэндлер выполняются в ее рабочих потоках.
+            Ошибки Транзака в этом режиме только логируются.
+        :param tracker:
+            OrderTracker, получающий пакеты заявок до хэндлера.
+        :param metrics:
+            Metrics для замеров приема по тегам.
+        :param scheduler:
+            CommandScheduler, через который проходят команды сессии.
+        :param master:
+            SecurityMaster: наполняется пакетами securities до хэндлера,
+            по нему проверяются заявки перед отправкой.
+        """
+        self.handler = msg_handler
+        self.compact = compact
+        self.wanted_tags = None if tags is None else frozenset(tags) | frozenset(raw) | service_tags
+        self.raw_tags = frozenset(raw) - service_tags
+        self.metrics = metrics
+        if offload is not None:
+            offload.start(self._dispatch)
+        self.offloader = offload
+        if queue is not None:
+            queue.start(self._process_queued)
+        self.dispatch_queue = queue
+        self.order_tracker = tracker
+        self.scheduler = scheduler
+        self.security_master = master
+        if not os.path.exists(logdir):
+            os.mkdir(logdir)
+        err = self.dll.Initialize(logdir + "\0", loglevel)
+        if err:
+            msg = self._get_message(err)
+            raise TransaqException(Error.parse(msg).text.encode(encoding))
+        if not self.dll.SetCallback(self.callback):
+            raise TransaqException(u"Коллбэк не установился")
+
+    def uninitialize(self):
+        """
+        Де-инициализация коннектора (синхронная).
+
+        :return:
+        """
+        if self.connected:
+            self.disconnect()
+        if self.dispatch_queue is not None:
+            self.dispatch_queue.shutdown()
+            self.dispatch_queue = None
+        if self.offloader is not None:
+            self.offloader.shutdown()
+            self.offloader = None
+        err = self.dll.UnInitialize()
+        if err:
+            msg = self._get_message(err)
+            raise TransaqException(Error.parse(msg).text.encode(encoding))
+
+    def connect(self, login, password, server, min_delay=100):
+        host, port = server.split(':')
+        root = et.Element("command", {"id": "connect"})
+        root.append(_elem("login", login))
+        root.append(_elem("password", password))
+        root.append(_elem("host", host))
+        root.append(_elem("port", port))
+        root.append(_elem("rqdelay", str(min_delay)))
+        if self.scheduler is not None:
+            self.scheduler.set_delay(min_delay)
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def disconnect(self):
+        root = et.Element("command", {"id": "disconnect"})
+        result = self._send_command(et.tostring(root, encoding="utf-8"))
+        self.connected = False
+        self.subscriptions.on_status(False)
+        return result
+
+    def server_status(self):
+        root = et.Element("command", {"id": "server_status"})
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def get_instruments(self):
+        root = et.Element("command", {"id": "get_securities"})
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def _subscribe_helper(self, board, tickers, cmd, mode):
+        return self.send_subscriptions(cmd, {mode: [(board, t) for t in tickers]})
+
+    def send_subscriptions(self, cmd, streams):
+        """
+        Подписаться или отписаться одной командой сразу по нескольким
+        потокам и доскам (без учета ссылок, см. subscriptions).
+
+        :param cmd:
+            "subscribe" или "unsubscribe".
+        :param streams:
+            Словарь поток ("alltrades", "quotations", "quotes") -> список пар (доска, код).
+        :return:
+            Результат отправки команды.
+        """
+        root = et.Element("command", {"id": cmd})
+        for mode in STREAMS:
+            if mode in streams:
+                section = et.Element(mode)
+                for board, seccode in streams[mode]:
+                    sec = et.Element("security")
+                    sec.append(_elem("board", board))
+                    sec.append(_elem("seccode", seccode))
+                    section.append(sec)
+                root.append(section)
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def subscribe_ticks(self, board, tickers):
+        return self._subscribe_helper(board, tickers, "subscribe", "alltrades")
+
+    def unsubscribe_ticks(self, board, tickers):
+        return self._subscribe_helper(board, tickers, "unsubscribe", "alltrades")
+
+    def subscribe_quotations(self, board, tickers):
+        return self._subscribe_helper(board, tickers, "subscribe", "quotations")
+
+    def unsubscribe_quotations(self, board, tickers):
+        return self._subscribe_helper(board, tickers, "unsubscribe", "quotations")
+
+    def subscribe_bidasks(self, board, tickers):
+        return self._subscribe_helper(board, tickers, "subscribe", "quotes")
+
+    def unsubscribe_bidasks(self, board, tickers):
+        return self._subscribe_helper(board, tickers, "unsubscribe", "quotes")
+
+    def new_order(self, board, ticker, client, buysell, quantity, price=0,
                   bymarket=True, usecredit=True):
-    """
-    Новая условная заявка.
-
-    :param board:
-    :param ticker:
-    :param client:
-    :param buysell:
-    :param quantity:
-    :param price:
-    :param cond_type:
-    :param cond_val:
-    :param valid_after:
-    :param valid_before:
-    :param bymarket:
-    :param usecredit:
-    :return:
-    """
-    root = et.Element("command", {"id": "newcondorder"})
-    return NotImplemented
-
-
-def get_forts_position(client):
-    """
-    Запрос позиций клиента по FORTS.
-
-    :param client:
-        Идентификатор клиента.
-    :return:
-        Результат отправки команды.
-    """
-    root = et.Element("command", {"id": "get_forts_position", "client": client})
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def get_limits_forts(client):
-    """
-    Запрос лимитов клиента ФОРТС.
-
-    :param client:
-        Идентификатор клиента.
-    :return:
-        Результат отправки команды.
-    """
-    root = et.Element("command", {"id": "get_client_limits", "client": client})
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def get_servtime_diff():
-    """
-    Получить разницу между серверным временем и временем на компьютере пользователя (синхронная).
-
-    :return:
-        Результат команды с разницей времени.
-    """
-    return NotImplemented
-
-
-def change_pass(oldpass, newpass):
-    """
-    Смена пароля (синхронная).
-
-    :param oldpass:
-        Старый пароль.
-    :param newpass:
-        Новый пароль.
-    :return:
-        Результат команды.
-    """
-    root = et.Element("command", {"id": "change_pass", "oldpass": oldpass, "newpass": newpass})
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def get_version():
-    """
-    Получить версию коннектора (синхронная).
-
-    :return:
-        Версия коннектора.
-    """
-    root = et.Element("command", {"id": "get_connector_version"})
-    return ConnectorVersion.parse(__get_message(txml_dll.SendCommand(et.tostring(root, encoding="utf-8")))).version
-
-
-def get_sec_info(market, seccode):
-    """
-    Запрос на получение информации по инструменту.
-
-    :param market:
-        Внутренний код рынка.
-    :param seccode:
-        Код инструмента.
-    :return:
-        Результат отправки команды.
-    """
-    root = et.Element("command", {"id": "get_securities_info"})
-    sec = et.Element("security")
-    sec.append(__elem("market", str(market)))
-    sec.append(__elem("seccode", seccode))
-    root.append(sec)
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def move_order(id, price, quantity=0, moveflag=0):
-    """
-    Отредактировать заявку.
-
-    :param id:
-        Идентификатор заменяемой заявки FORTS.
-    :param price:
-        Цена.
-    :param quantity:
-        Количество, лотов.
-    :param moveflag:
-        0: не менять количество;
-        1: изменить количество;
-        2: при несовпадении количества с текущим – снять заявку.
-    :return:
-        Результат отправки команды.
-    """
-    root = et.Element("command", {"id": "moveorder"})
-    root.append(__elem("transactionid", str(id)))
-    root.append(__elem("price", str(price)))
-    root.append(__elem("quantity", str(quantity)))
-    root.append(__elem("moveflag", str(moveflag)))
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def get_limits_tplus(client, securities):
-    """
-    Получить лимиты Т+.
-
-    :param client:
-        Идентификатор клиента.
-    :param securities:
-        Список пар (market, seccode) на которые нужны лимиты.
-    :return:
-        Результат отправки команды.
-    """
-    root = et.Element("command", {"id": "get_max_buy_sell_tplus", "client": client})
-    for (market, code) in securities:
+        # Add hidden, unfilled, nosplit
+        if self.security_master is not None:
+            quantity, price, _ = self.security_master.check_order(board, ticker, buysell, quantity,
+                                                                  price, bymarket, usecredit)
+        return self._send_command(encoders.new_order(board, ticker, client, buysell, quantity,
+                                                     price, bymarket, usecredit))
+
+    def new_stoploss(self, board, ticker, client, buysell, quantity, trigger_price, price=0,
+                     bymarket=True, usecredit=True, linked_order=None, valid_for=None):
+        if self.security_master is not None:
+            quantity, price, trigger_price = self.security_master.check_order(
+                board, ticker, buysell, quantity, price, bymarket, usecredit, trigger_price)
+        return self._send_command(encoders.new_stoploss(board, ticker, client, buysell, quantity,
+                                                        trigger_price, price, bymarket, usecredit,
+                                                        linked_order, valid_for))
+
+    def new_takeprofit(self, board, ticker, client, buysell, quantity, trigger_price,
+                       correction=0, use_credit=True, linked_order=None, valid_for=None):
+        if self.security_master is not None:
+            # Тейк-профит всегда исполняется по рынку
+            quantity, _, trigger_price = self.security_master.check_order(
+                board, ticker, buysell, quantity, 0, True, use_credit, trigger_price)
+        root = et.Element("command", {"id": "newstoporder"})
         sec = et.Element("security")
-        sec.append(__elem("market", str(market)))
-        sec.append(__elem("seccode", code))
+        sec.append(_elem("board", board))
+        sec.append(_elem("seccode", ticker))
         root.append(sec)
-    return __send_command(et.tostring(root, encoding="utf-8"))
-
-
-def get_portfolio_mct(client):
-    """
-    Получить портфель МСТ/ММА. Не реализован пока.
+        root.append(_elem("client", client))
+        root.append(_elem("buysell", buysell.upper()))
+        if linked_order:
+            root.append(_elem("linkedorderno", str(linked_order)))
+        if valid_for:
+            root.append(_elem("validfor", valid_for.strftime(timeformat)))
+
+        tp = et.Element("takeprofit")
+        tp.append(_elem("quantity", str(quantity)))
+        tp.append(_elem("activationprice", str(trigger_price)))
+        tp.append(et.Element("bymarket"))
+        if use_credit:
+            tp.append(et.Element("usecredit"))
+        if correction:
+            tp.append(_elem("correction", str(correction)))
+        root.append(tp)
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def cancel_order(self, id):
+        return self._send_command(encoders.cancel_order(id))
+
+    def cancel_stoploss(self, id):
+        return self._send_command(encoders.cancel_stoploss(id))
+
+    def cancel_takeprofit(self, id):
+        return self.cancel_stoploss(id)
+
+    def submit_basket(self, orders, workers=8, executor=None):
+        """
+        Выставить пачку заявок. Команды кодируются заранее и отправляются
+        параллельно, ошибка одной заявки не прерывает остальные.
+
+        :param orders:
+            Параметры new_order для каждой заявки: словари или кортежи.
+        :param workers:
+            Число потоков отправки.
+        :param executor:
+            Свой экзекьютор вместо временного пула.
+        :return:
+            baskets.BasketResult с результатами по номерам заявок в пачке
+            и по transactionid (by_transaction); заявки, не прошедшие
+            проверку по справочнику, - в failed.
+
+        Команды пачки ограничиваются по темпу, только если сессии задан
+        планировщик (см. initialize, scheduler). Без него все workers
+        потоков шлют команды без пауз.
+        """
+        return baskets.execute(self._send_command,
+                               baskets.encode_orders(orders, self.security_master),
+                               workers=workers, executor=executor)
+
+    def cancel_basket(self, ids, stop=False, workers=8, executor=None):
+        """
+        Снять пачку заявок, см. submit_basket.
+
+        :param ids:
+            Номера транзакций снимаемых заявок.
+        :param stop:
+            Снимать условные заявки.
+        :return:
+            baskets.BasketResult с результатами по снимаемым номерам.
+
+        Темп, как и в submit_basket, держит только планировщик сессии.
+        """
+        ids = list(ids)
+        return baskets.execute(self._send_command, baskets.encode_cancels(ids, stop),
+                               keys=ids, workers=workers, executor=executor)
+
+    def get_portfolio(self, client):
+        root = et.Element("command", {"id": "get_portfolio", "client": client})
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def get_markets(self):
+        """
+        Получить список рынков.
+
+        :return:
+            Результат отправки команды.
+        """
+        root = et.Element("command", {"id": "get_markets"})
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def get_history(self, board, seccode, period, count, reset=True):
+        """
+        Выдать последние N свечей заданного периода, по заданному инструменту.
+
+        :param board:
+            Идентификатор режима торгов.
+        :param seccode:
+            Код инструмента.
+        :param period:
+            Идентификатор периода.
+        :param count:
+            Количество свечей.
+        :param reset:
+            Параметр reset="true" говорит, что нужно выдавать самые свежие данные, в
+            противном случае будут выданы свечи в продолжение предыдущего запроса.
+        :return:
+            Результат отправки команды.
+        """
+        root = et.Element("command", {"id": "gethistorydata"})
+        sec = et.Element("security")
+        sec.append(_elem("board", board))
+        sec.append(_elem("seccode", seccode))
+        root.append(sec)
+        root.append(_elem("period", str(period)))
+        root.append(_elem("count", str(count)))
+        root.append(_elem("reset", "true" if reset else "false"))
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def load_history(self, seccodes, period, count=None, since=None, board=None):
+        """
+        Загрузить историю свечей по инструментам целиком, подкачивая страницы
+        get_history (синхронная, см. history.HistoryLoader).
+
+        :param seccodes:
+            Коды инструментов, пары (доска, код) или None - все инструменты доски
+            из справочника сессии.
+        :param period:
+            Идентификатор периода.
+        :param count:
+            Сколько последних свечей нужно.
+        :param since:
+            Начиная с какого времени (datetime) нужны свечи.
+        :param board:
+            Доска для кодов без доски.
+        :return:
+            Упорядоченный словарь код -> history.CandleArrays.
+        """
+        return self.history.load(seccodes, period, count, since, board)
+
+    # TODO Доделать условные заявки
+    def new_condorder(self, board, ticker, client, buysell, quantity, price,
+                      cond_type, cond_val, valid_after, valid_before,
+                      bymarket=True, usecredit=True):
+        """
+        Новая условная заявка.
+
+        :param board:
+        :param ticker:
+        :param client:
+        :param buysell:
+        :param quantity:
+        :param price:
+        :param cond_type:
+        :param cond_val:
+        :param valid_after:
+        :param valid_before:
+        :param bymarket:
+        :param usecredit:
+        :return:
+        """
+        root = et.Element("command", {"id": "newcondorder"})
+        return NotImplemented
+
+    def get_forts_position(self, client):
+        """
+        Запрос позиций клиента по FORTS.
+
+        :param client:
+            Идентификатор клиента.
+        :return:
+            Результат отправки команды.
+        """
+        root = et.Element("command", {"id": "get_forts_position", "client": client})
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def get_limits_forts(self, client):
+        """
+        Запрос лимитов клиента ФОРТС.
+
+        :param client:
+            Идентификатор клиента.
+        :return:
+            Результат отправки команды.
+        """
+        root = et.Element("command", {"id": "get_client_limits", "client": client})
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def get_servtime_diff(self):
+        """
+        Получить разницу между серверным временем и временем на компьютере пользователя (синхронная).
+
+        :return:
+            Результат команды с разницей времени.
+        """
+        return NotImplemented
+
+    def change_pass(self, oldpass, newpass):
+        """
+        Смена пароля (синхронная).
+
+        :param oldpass:
+            Старый пароль.
+        :param newpass:
+            Новый пароль.
+        :return:
+            Результат команды.
+        """
+        root = et.Element("command", {"id": "change_pass", "oldpass": oldpass, "newpass": newpass})
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def get_version(self):
+        """
+        Получить версию коннектора (синхронная).
+
+        :return:
+            Версия коннектора.
+        """
+        root = et.Element("command", {"id": "get_connector_version"})
+        return ConnectorVersion.parse(self._get_message(self.dll.SendCommand(et.tostring(root, encoding="utf-8")))).version
+
+    def get_sec_info(self, market, seccode):
+        """
+        Запрос на получение информации по инструменту.
+
+        :param market:
+            Внутренний код рынка.
+        :param seccode:
+            Код инструмента.
+        :return:
+            Результат отправки команды.
+        """
+        root = et.Element("command", {"id": "get_securities_info"})
+        sec = et.Element("security")
+        sec.append(_elem("market", str(market)))
+        sec.append(_elem("seccode", seccode))
+        root.append(sec)
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def move_order(self, id, price, quantity=0, moveflag=0):
+        """
+        Отредактировать заявку.
+
+        :param id:
+            Идентификатор заменяемой заявки FORTS.
+        :param price:
+            Цена.
+        :param quantity:
+            Количество, лотов.
+        :param moveflag:
+            0: не менять количество;
+            1: изменить количество;
+            2: при несовпадении количества с текущим – снять заявку.
+        :return:
+            Результат отправки команды.
+        """
+        return self._send_command(encoders.move_order(id, price, quantity, moveflag))
+
+    def get_limits_tplus(self, client, securities):
+        """
+        Получить лимиты Т+.
+
+        :param client:
+            Идентификатор клиента.
+        :param securities:
+            Список пар (market, seccode) на которые нужны лимиты.
+        :return:
+            Результат отправки команды.
+        """
+        root = et.Element("command", {"id": "get_max_buy_sell_tplus", "client": client})
+        for (market, code) in securities:
+            sec = et.Element("security")
+            sec.append(_elem("market", str(market)))
+            sec.append(_elem("seccode", code))
+            root.append(sec)
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+    def get_portfolio_mct(self, client):
+        """
+        Получить портфель МСТ/ММА. Не реализован пока.
+
+        :param client:
+            Идентификатор клиента.
+        :return:
+            Результат отправки команды.
+        """
+        return NotImplemented
+
+    def get_united_portfolio(self, client, union=None):
+        """
+        Получить единый портфель.
+        В команде необходимо задать только один из параметров (client или union).
+
+        :param client:
+            Идентификатор клиента.
+        :param union:
+            Идентификатор юниона.
+        :return:
+            Результат отправки команды.
+        """
+        params = {"id": "get_united_portfolio"}
+        if client is not None:
+            params["client"] = client
+        elif union is not None:
+            params["union"] = union
+        else:
+            raise ValueError("please specify client OR union")
+        root = et.Element("command", params)
+        return self._send_command(et.tostring(root, encoding="utf-8"))
+
+
+## Функции модуля - команды сессии по умолчанию
+
+# Команды Connector, доступные функциями модуля
+COMMANDS = ('initialize', 'uninitialize', 'connect', 'disconnect', 'server_status', 'get_instruments',
+            'subscribe_ticks', 'unsubscribe_ticks', 'subscribe_quotations', 'unsubscribe_quotations',
+            'subscribe_bidasks', 'unsubscribe_bidasks', 'new_order', 'new_stoploss', 'new_takeprofit',
+            'cancel_order', 'cancel_stoploss', 'cancel_takeprofit', 'submit_basket', 'cancel_basket',
+            'get_portfolio', 'get_markets', 'get_history', 'load_history', 'new_condorder',
+            'get_forts_position', 'get_limits_forts', 'get_servtime_diff', 'change_pass', 'get_version',
+            'get_sec_info', 'move_order', 'get_limits_tplus', 'get_portfolio_mct', 'get_united_portfolio')
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_connector():
+    """
+    Сессия по умолчанию, с которой работают функции модуля (потокобезопасно).
 
-    :param client:
-        Идентификатор клиента.
     :return:
-        Результат отправки команды.
+        Connector.
     """
-    return NotImplemented
+    global _default
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                _default = Connector()
+    return _default
 
-def get_united_portfolio(client, union=None):
-    """
-    Получить единый портфель.
-    В команде необходимо задать только один из параметров (client или union).
 
-    :param client:
-        Идентификатор клиента.
-    :param union:
-        Идентификатор юниона.
-    :return:
-        Результат отправки команды.
-    """
-    params = {"id": "get_united_portfolio"}
-    if client is not None:
-        params["client"] = client
-    elif union is not None:
-        params["union"] = union
-    else:
-        raise ValueError("please specify client OR union")
-    root = et.Element("command", params)
-    return __send_command(et.tostring(root, encoding="utf-8"))
\ No newline at end of file
+def _delegate(name):
+    # Функция модуля, вызывающая команду сессии по умолчанию
+    def command(*args, **kwargs):
+        return getattr(default_connector(), name)(*args, **kwargs)
+    command.__name__ = name
+    command.__doc__ = getattr(Connector, name).__doc__
+    return command
+
+
+for _name in COMMANDS:
+    globals()[_name] = _delegate(_name)
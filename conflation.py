@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Склейка обновлений котировок (quotations) по инструментам.
+
+Транзак присылает в quotation только изменившиеся поля, и для ликвидных
+бумаг обновления идут быстрее, чем их успевают обработать медленные
+потребители. QuotationConflator вливает каждое обновление в текущее
+состояние инструмента (по secid), а потребитель забирает только последнее
+состояние тех инструментов, что изменились с прошлого раза::
+
+    conflator = QuotationConflator(handler)
+    initialize(logdir, loglevel, conflator)
+    ...
+    for quotation in conflator.take():
+        ...
+
+Склеиваются только quotations, остальные сообщения (в том числе заявки
+и сделки) передаются хэндлеру как есть.
+"""
+import logging, threading
+from structures import QuotationPacket, Record
+
+log = logging.getLogger("transaq.connector")
+
+
+def _copy(rec):
+    # Копия записи без pickle-протокола
+    new = object.__new__(type(rec))
+    new.__setstate__(rec.__getstate__())
+    return new
+
+
+class QuotationConflator(object):
+    """
+    Склейка обновлений котировок по secid.
+
+    :param handler:
+        Хэндлер для остальных сообщений.
+    :param notify:
+        Вызывается с secid, когда у инструмента появилось
+        непрочитанное состояние (один раз до следующего take()).
+    """
+
+    def __init__(self, handler=None, notify=None):
+        self.handler = handler
+        self.notify = notify
+        # Число обновлений и сколько из них влиты в непрочитанное состояние
+        self.updates = 0
+        self.merged = 0
+        self._states = {}
+        self._dirty = []
+        self._dirty_set = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, obj):
+        self.on_message(obj)
+
+    def on_message(self, obj):
+        """
+        Обработать входящее сообщение.
+        """
+        if getattr(obj, 'ROOT_NAME', None) != QuotationPacket.ROOT_NAME:
+            if self.handler:
+                self.handler(obj)
+            return
+        fresh = []
+        with self._lock:
+            for item in obj.items:
+                if not isinstance(item, Record):
+                    item = item.to_record()
+                secid = item.secid
+                self.updates += 1
+                state = self._states.get(secid)
+                if state is None:
+                    self._states[secid] = _copy(item)
+                else:
+                    for name, val in zip(item.__slots__, item.__getstate__()):
+                        if val is not None:
+                            setattr(state, name, val)
+                if secid in self._dirty_set:
+                    self.merged += 1
+                else:
+                    self._dirty_set.add(secid)
+                    self._dirty.append(secid)
+                    fresh.append(secid)
+        if self.notify:
+            for secid in fresh:
+                self.notify(secid)
+
+    def get(self, secid):
+        """
+        Текущее состояние инструмента (копия) или None.
+        Не сбрасывает признак непрочитанного.
+        """
+        with self._lock:
+            state = self._states.get(secid)
+            return None if state is None else _copy(state)
+
+    def take(self, secid=None):
+        """
+        Забрать состояния изменившихся инструментов.
+
+        :param secid:
+            Только этот инструмент (None - все).
+        :return:
+            Список записей Quotation в порядке первого изменения
+            (для одного secid - запись или None).
+        """
+        with self._lock:
+            if secid is not None:
+                if secid not in self._dirty_set:
+                    return None
+                self._dirty_set.discard(secid)
+                self._dirty.remove(secid)
+                return _copy(self._states[secid])
+            result = [_copy(self._states[secid]) for secid in self._dirty]
+            self._dirty = []
+            self._dirty_set.clear()
+            return result
+
+    @property
+    def pending(self):
+        """
+        Число инструментов с непрочитанным состоянием.
+        """
+        return len(self._dirty)
+
+    def reset(self, secid=None):
+        """
+        Забыть состояние инструмента (None - всех), например после
+        переподписки, когда Транзак пришлет полный снимок.
+        """
+        with self._lock:
+            if secid is None:
+                self._states.clear()
+                self._dirty = []
+                self._dirty_set.clear()
+            else:
+                self._states.pop(secid, None)
+                if secid in self._dirty_set:
+                    self._dirty_set.discard(secid)
+                    self._dirty.remove(secid)
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Генератор специализированных декодеров для структур Транзака.
+
+По объявлениям полей класса (IntegerField('@secid'), FloatField('price'),
+DateTimeField('time', timeformat), SimpleBooleanField('opmask/@usecredit', ...))
+собирается одна линейная функция, которая за один проход по дочерним
+элементам раскладывает значения в компактную запись (см. structures.Record).
+XPath при этом не вычисляется вовсе. Классы с путями или полями, которые
+генератор не понимает, разбираются через eulxml.
+
+Результат совпадает со значениями, которые вернул бы eulxml.
+"""
+import re
+import lxml.etree as et
+from eulxml.xmlmap.fields import SingleNodeManager, NodeListManager, \
+    StringMapper, IntegerMapper, FloatMapper, SimpleBooleanMapper, DateTimeMapper, NodeMapper
+
+# Шаг пути, который умеем разбирать: простое имя без префиксов и предикатов
+_step_re = re.compile(r'^[A-Za-z_][\w.\-]*$')
+# Число в смысле XPath number()
+_number_re = re.compile(r'^[ \t\r\n]*-?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?[ \t\r\n]*$')
+_string_value = et.XPath('string()')
+_nan = float('nan')
+# Кэш декодеров по классам
+_decoders = {}
+
+
+class Unsupported(Exception):
+    """
+    Поле, которое генератор не умеет декодировать.
+    """
+    pass
+
+
+def decoder(cls):
+    """
+    Декодер элемента в компактную запись для класса структуры.
+    Генерируется при первом обращении и кэшируется.
+
+    :param cls:
+        Класс структуры (наследник MyXmlObject).
+    :return:
+        Функция element -> запись.
+    """
+    func = _decoders.get(cls)
+    if func is None:
+        try:
+            func = _compile(cls)
+        except Unsupported:
+            func = _fallback(cls)
+        _decoders[cls] = func
+    return func
+
+
+def compiled(cls):
+    """
+    Удалось ли сгенерировать декодер для класса (иначе работает eulxml).
+
+    :param cls:
+        Класс структуры.
+    :return:
+        True если декодер сгенерирован.
+    """
+    return not getattr(decoder(cls), 'fallback', False)
+
+
+def _fallback(cls):
+    # Запасной путь через eulxml
+    def decode(node):
+        return cls.from_element(node).to_record()
+    decode.fallback = True
+    return decode
+
+
+## Помощники, которые вызывает сгенерированный код
+
+def _plain(val):
+    # Отвязать строку-результат XPath от дерева
+    if val is None:
+        return None
+    return unicode(val) if isinstance(val, unicode) else str(val)
+
+
+def _string(elem):
+    # string() элемента
+    if len(elem):
+        return _plain(_string_value(elem))
+    return elem.text or ''
+
+
+def _number(text):
+    # number() строки
+    if _number_re.match(text):
+        return float(text)
+    return _nan
+
+
+def _int(text):
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+
+def _float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _int_number(elem):
+    try:
+        return int(_number(_string(elem)))
+    except ValueError:
+        return None
+
+
+def _float_number(elem):
+    return float(_number(_string(elem)))
+
+
+def _first_text(node):
+    # Первый текстовый узел (text())
+    if node.text is not None:
+        return node.text
+    for child in node:
+        if child.tail is not None:
+            return child.tail
+    return None
+
+
+def _path(node, steps, attr):
+    # Первое совпадение пути steps[/@attr] в порядке документа
+    if not steps:
+        return node.get(attr) if attr else node
+    for child in node.iterchildren(steps[0]):
+        found = _path(child, steps[1:], attr)
+        if found is not None:
+            return found
+    return None
+
+
+## Генерация
+
+def _split(xpath):
+    # Путь -> (шаги по элементам, атрибут или None, text())
+    if xpath == 'text()':
+        return (), None, True
+    steps = xpath.split('/')
+    attr = None
+    if steps[-1].startswith('@'):
+        attr = steps.pop()[1:]
+        if not _step_re.match(attr):
+            raise Unsupported(xpath)
+    for step in steps:
+        if not _step_re.match(step):
+            raise Unsupported(xpath)
+    return tuple(steps), attr, False
+
+
+def _is_plain(mapper):
+    # Мэппер без normalize
+    return 'XPATH' not in mapper.__dict__
+
+
+def _convert(field, raw, is_elem, env, n):
+    # Выражение, переводящее сырое значение raw в питоновое
+    mapper = field.mapper
+    if isinstance(mapper, NodeMapper):
+        if not is_elem:
+            raise Unsupported(field.xpath)
+        env['dec%d' % n] = decoder(mapper.node_class)
+        return "None if %s is None else dec%d(%s)" % (raw, n, raw)
+    if type(mapper) is StringMapper and _is_plain(mapper):
+        if is_elem:
+            return "None if %s is None else _string(%s)" % (raw, raw)
+        return raw
+    if type(mapper) is IntegerMapper:
+        if is_elem:
+            return "None if %s is None else _int_number(%s)" % (raw, raw)
+        return "None if %s is None else _int(%s)" % (raw, raw)
+    if type(mapper) is FloatMapper:
+        if is_elem:
+            return "None if %s is None else _float_number(%s)" % (raw, raw)
+        return "None if %s is None else _float(%s)" % (raw, raw)
+    if type(mapper) is SimpleBooleanMapper or \
+            (isinstance(mapper, DateTimeMapper) and _is_plain(mapper)):
+        # Мэпперы eulxml сами понимают строковое значение
+        env['conv%d' % n] = mapper.to_python
+        if is_elem:
+            return "conv%d(None if %s is None else _string(%s))" % (n, raw, raw)
+        return "conv%d(%s)" % (n, raw)
+    raise Unsupported(field.xpath)
+
+
+def _field_code(field, env, n):
+    # Строки кода, вычисляющие значение поля в переменную vN
+    steps, attr, text = _split(field.xpath)
+    var = 'v%d' % n
+    if isinstance(field.manager, NodeListManager):
+        # Списки только из прямых потомков
+        if len(steps) != 1 or attr or text:
+            raise Unsupported(field.xpath)
+        item = _convert(field, 'x', True, env, n)
+        return ["%s = [%s for x in node.iterchildren(%r)]" % (var, item, steps[0])]
+    if type(field.manager) is not SingleNodeManager or field.manager.instantiate_on_get:
+        raise Unsupported(field.xpath)
+    if text:
+        raw = "_first_text(node)"
+    elif not steps:
+        raw = "attrib(%r)" % attr
+    elif len(steps) == 1 and not attr:
+        raw = "children.get(%r)" % steps[0]
+    else:
+        raw = "_path(node, %r, %r)" % (steps, attr)
+    return ["e = " + raw,
+            "%s = %s" % (var, _convert(field, 'e', bool(steps) and not attr, env, n))]
+
+
+def _compile(cls):
+    # Собрать исходник декодера и выполнить его
+    rec = cls.record_class()
+    env = {'_string': _string, '_int': _int, '_float': _float, '_int_number': _int_number,
+           '_float_number': _float_number, '_first_text': _first_text, '_path': _path,
+           'Rec': rec, 'new': object.__new__}
+    lines = ["def decode(node):",
+             "    attrib = node.attrib.get",
+             "    children = {}",
+             "    for child in reversed(node):",
+             "        children[child.tag] = child",
+             "    r = new(Rec)"]
+    # Поля-синонимы (id = secid = ...) считаем один раз
+    seen = {}
+    for name in rec.__slots__:
+        field = cls._fields.get(name) if name in cls.field_names() else None
+        if field is None:
+            # Поле не из xml (items пакета с самописным разбором)
+            raise Unsupported(name)
+        if id(field) not in seen:
+            n = seen[id(field)] = len(seen)
+            lines.extend("    " + line for line in _field_code(field, env, n))
+        lines.append("    r.%s = v%d" % (name, seen[id(field)]))
+    lines.append("    return r")
+    source = "\n".join(lines) + "\n"
+    exec compile(source, "<decoder %s>" % cls.__name__, "exec") in env
+    func = env['decode']
+    func.__name__ = '_decode_%s' % cls.__name__
+    func.source = source
+    return func
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Очередь между коллбэком коннектора и хэндлером.
+
+Коллбэк кладет сырое сообщение в ограниченную очередь и сразу возвращает
+управление библиотеке, а разбор и вызов хэндлера выполняют рабочие потоки.
+Что делать при заполнении очереди, задается политикой для корневого тега:
+
+* BLOCK - коллбэк ждет свободного места (по умолчанию);
+* DROP_OLDEST - выкидывается самое старое сообщение с такой же политикой;
+* CONFLATE - в очереди остается только последнее сообщение с этим тегом
+  (для сообщений, где новое целиком заменяет старое: портфель, лимиты).
+  Если заменить нечего, место освобождается за счет самого старого
+  сообщения с DROP_OLDEST, а без таких коллбэк ждет: новое состояние
+  не теряется.
+
+Заявки, сделки, позиции и служебные сообщения терять нельзя, для них
+допустима только BLOCK. Такие сообщения с одним тегом обрабатываются
+строго по очереди, даже если рабочих потоков несколько.
+"""
+import itertools, logging, threading
+from collections import deque
+from timeit import default_timer as timer
+from structures import *
+from offload import ORDERED_TAGS
+
+log = logging.getLogger("transaq.connector")
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+CONFLATE = 'conflate'
+POLICIES = (BLOCK, DROP_OLDEST, CONFLATE)
+# Теги, которые нельзя терять и склеивать
+LOSSLESS_TAGS = ORDERED_TAGS | frozenset([Error.ROOT_NAME, ServerStatus.ROOT_NAME])
+
+
+class DispatchQueue(object):
+    """
+    Ограниченная очередь сырых сообщений с рабочими потоками.
+
+    :param maxsize:
+        Максимальное число сообщений в очереди.
+    :param workers:
+        Число рабочих потоков.
+    :param policies:
+        Словарь тег -> политика при заполнении очереди.
+    :param default:
+        Политика для остальных тегов.
+    """
+
+    def __init__(self, maxsize=10000, workers=1, policies=None, default=BLOCK):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.default = default
+        self.policies = {}
+        for tag, policy in (policies or {}).items():
+            self.set_policy(tag, policy)
+        self._check(None, default)
+        # Счетчики
+        self.max_depth = 0
+        self.processed = 0
+        self.dropped = {}
+        self.conflated = {}
+        # Записи [тег, сообщение, время, номер] в порядке прихода.
+        # У забранных и выкинутых записей номер None, из очереди они
+        # убираются, когда доходят до головы
+        self._queue = deque()
+        self._size = 0
+        self._counter = itertools.count()
+        # Записи с политикой DROP_OLDEST в порядке прихода
+        self._droppable = deque()
+        # Отложенные записи упорядоченных тегов, пока тег в обработке
+        self._parked = {}
+        # Последнее сообщение в очереди по тегу (для CONFLATE)
+        self._latest = {}
+        # Теги без потерь, сообщения которых сейчас в обработке
+        self._busy = set()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._threads = []
+        self._running = False
+
+    @staticmethod
+    def _check(tag, policy):
+        if policy not in POLICIES:
+            raise ValueError("unknown policy %r" % policy)
+        if policy != BLOCK and tag in LOSSLESS_TAGS:
+            raise ValueError("messages <%s> can not be dropped" % tag)
+
+    def set_policy(self, tag, policy):
+        """
+        Задать политику для корневого тега.
+        """
+        self._check(tag, policy)
+        self.policies[tag] = policy
+
+    def policy(self, tag):
+        """
+        Политика для корневого тега.
+        """
+        if tag in LOSSLESS_TAGS:
+            return BLOCK
+        return self.policies.get(tag, self.default)
+
+    @property
+    def depth(self):
+        """
+        Текущее число сообщений в очереди.
+        """
+        return self._size
+
+    def start(self, process):
+        """
+        Запустить рабочие потоки.
+
+        :param process:
+            Функция (tag, msg, waited), которая разбирает и доставляет сообщение.
+            waited - время в очереди в секундах для сообщений,
+            положенных с timed, иначе None.
+        """
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(process,),
+                                      name="transaq-dispatch-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def shutdown(self, wait=True):
+        """
+        Остановить рабочие потоки. Сообщения, уже лежащие в очереди,
+        обрабатываются до конца.
+        """
+        with self._lock:
+            self._running = False
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def put(self, tag, msg, timed=False):
+        """
+        Положить сообщение в очередь (вызывается из коллбэка).
+
+        :param timed:
+            Замерить время ожидания в очереди.
+        :return:
+            False если сообщение выкинуто.
+        """
+        policy = self.policy(tag)
+        with self._lock:
+            while True:
+                if policy == CONFLATE:
+                    entry = self._latest.get(tag)
+                    if entry is not None:
+                        # Заменяем сообщение на месте, очередь не растет,
+                        # время ожидания считается от нового сообщения
+                        entry[1] = msg
+                        entry[2] = timer() if timed else None
+                        self.conflated[tag] = self.conflated.get(tag, 0) + 1
+                        return True
+                if self._size < self.maxsize:
+                    break
+                if policy != BLOCK and self._drop_oldest():
+                    continue
+                if policy == DROP_OLDEST:
+                    # Выкидывать нечего - выкидываем пришедшее
+                    self.dropped[tag] = self.dropped.get(tag, 0) + 1
+                    return False
+                if not self._running:
+                    return False
+                # BLOCK и CONFLATE без места ждут
+                self._not_full.wait()
+            if len(self._queue) + len(self._droppable) > 4 * self.maxsize:
+                self._compact()
+            entry = [tag, msg, timer() if timed else None, next(self._counter)]
+            self._queue.append(entry)
+            self._size += 1
+            if policy == CONFLATE:
+                self._latest[tag] = entry
+            elif policy == DROP_OLDEST:
+                self._droppable.append(entry)
+            self.max_depth = max(self.max_depth, self._size)
+            self._not_empty.notify()
+        return True
+
+    def _drop_oldest(self):
+        # Выкинуть самое старое сообщение с политикой DROP_OLDEST
+        droppable = self._droppable
+        while droppable:
+            entry = droppable.popleft()
+            if entry[3] is None:
+                # Уже забрано рабочим потоком
+                continue
+            entry[1] = entry[3] = None
+            self._size -= 1
+            self.dropped[entry[0]] = self.dropped.get(entry[0], 0) + 1
+            return True
+        return False
+
+    def _compact(self):
+        # Убрать забранные и выкинутые записи, которые еще лежат в очередях
+        self._queue = deque(entry for entry in self._queue if entry[3] is not None)
+        self._droppable = deque(entry for entry in self._droppable if entry[3] is not None)
+
+    def _take(self):
+        # Первое сообщение, которое можно обрабатывать сейчас
+        queue = self._queue
+        busy = self._busy
+        # С головы очереди убираем забранные и выкинутые записи,
+        # а записи занятых тегов без потерь откладываем
+        while queue and (queue[0][3] is None or queue[0][0] in busy):
+            entry = queue.popleft()
+            if entry[3] is not None:
+                self._parked.setdefault(entry[0], deque()).append(entry)
+        source = queue if queue else None
+        # Отложенные записи старше головы очереди (тегов не больше LOSSLESS_TAGS)
+        for tag, parked in self._parked.items():
+            if tag not in busy and (source is None or parked[0][3] < source[0][3]):
+                source = parked
+        if source is None:
+            return None
+        entry = source.popleft()
+        tag = entry[0]
+        if source is not queue and not source:
+            del self._parked[tag]
+        if tag in LOSSLESS_TAGS:
+            busy.add(tag)
+        entry[3] = None
+        self._size -= 1
+        if self._latest.get(tag) is entry:
+            del self._latest[tag]
+        self._not_full.notify()
+        return entry
+
+    def _run(self, process):
+        # Цикл рабочего потока
+        while True:
+            with self._lock:
+                entry = self._take()
+                while entry is None:
+                    if not self._running and not self._size:
+                        return
+                    self._not_empty.wait()
+                    entry = self._take()
+            tag, msg, stamp = entry[:3]
+            try:
+                process(tag, msg, None if stamp is None else timer() - stamp)
+            except Exception:
+                log.exception(u"Ошибка при обработке сообщения <%s>" % tag)
+            finally:
+                with self._lock:
+                    self.processed += 1
+                    if tag in self._busy:
+                        self._busy.discard(tag)
+                        # Следующее сообщение с этим тегом могло ждать
+                        self._not_empty.notify_all()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Кодировщик команд выставления и снятия заявок по готовым байтовым шаблонам.
+
+Вместо построения дерева lxml на каждую заявку заполняются заранее
+подготовленные шаблоны, экранируются только переданные пользователем
+строки. Результат побайтно совпадает с et.tostring(root, encoding="utf-8")
+для тех же значений (см. tests/encoding.py).
+"""
+import re
+from structures import timeformat
+
+# Что экранирует lxml в тексте элемента
+_escape_re = re.compile(u'[&<>\r]')
+_escapes = {u'&': u'&amp;', u'<': u'&lt;', u'>': u'&gt;', u'\r': u'&#13;'}
+# Символы, недопустимые в xml (lxml на них падает)
+_invalid_re = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+# Байтовая строка, которую можно вставить как есть
+_special_re = re.compile(r'[\x00-\x1f&<>\x80-\xff]')
+
+
+def _text(val):
+    # Текст элемента в utf-8 с экранированием
+    if isinstance(val, str):
+        if not _special_re.search(val):
+            return val
+        val = val.decode('utf-8')
+    elif not isinstance(val, unicode):
+        if val is None:
+            raise ValueError("element text is required")
+        return _text(str(val))
+    if _invalid_re.search(val):
+        raise ValueError("All strings must be XML compatible")
+    if _escape_re.search(val):
+        val = _escape_re.sub(lambda m: _escapes[m.group()], val)
+    return val.encode('utf-8')
+
+
+_NEWORDER = ('<command id="neworder"><security><board>%s</board><seccode>%s</seccode>'
+             '</security><client>%s</client><buysell>%s</buysell>'
+             '<quantity>%s</quantity>%s%s</command>')
+_NEWSTOPORDER = ('<command id="newstoporder"><security><board>%s</board><seccode>%s</seccode>'
+                 '</security><client>%s</client><buysell>%s</buysell>%s%s'
+                 '<stoploss><quantity>%s</quantity><activationprice>%s</activationprice>'
+                 '%s%s</stoploss></command>')
+_CANCEL = '<command id="%s"><transactionid>%s</transactionid></command>'
+_MOVEORDER = ('<command id="moveorder"><transactionid>%s</transactionid><price>%s</price>'
+              '<quantity>%s</quantity><moveflag>%s</moveflag></command>')
+
+
+def new_order(board, ticker, client, buysell, quantity, price=0, bymarket=True, usecredit=True):
+    """
+    Команда neworder (параметры как у Connector.new_order).
+
+    :return:
+        Байты команды.
+    """
+    return _NEWORDER % (_text(board), _text(ticker), _text(client), _text(buysell.upper()),
+                        _text(str(quantity)),
+                        '<bymarket/>' if bymarket else '<price>%s</price>' % _text(str(price)),
+                        '<usecredit/>' if usecredit else '')
+
+
+def new_stoploss(board, ticker, client, buysell, quantity, trigger_price, price=0,
+                 bymarket=True, usecredit=True, linked_order=None, valid_for=None):
+    """
+    Команда newstoporder со стоп-лоссом (параметры как у Connector.new_stoploss).
+
+    :return:
+        Байты команды.
+    """
+    return _NEWSTOPORDER % (
+        _text(board), _text(ticker), _text(client), _text(buysell.upper()),
+        '<linkedorderno>%s</linkedorderno>' % _text(str(linked_order)) if linked_order else '',
+        '<validfor>%s</validfor>' % _text(valid_for.strftime(timeformat)) if valid_for else '',
+        _text(str(quantity)), _text(str(trigger_price)),
+        '<bymarket/>' if bymarket else '<orderprice>%s</orderprice>' % _text(str(price)),
+        '<usecredit/>' if usecredit else '')
+
+
+def cancel_order(id):
+    """
+    Команда cancelorder.
+
+    :return:
+        Байты команды.
+    """
+    return _CANCEL % ('cancelorder', _text(str(id)))
+
+
+def cancel_stoploss(id):
+    """
+    Команда cancelstoporder.
+
+    :return:
+        Байты команды.
+    """
+    return _CANCEL % ('cancelstoporder', _text(str(id)))
+
+
+def move_order(id, price, quantity=0, moveflag=0):
+    """
+    Команда moveorder (параметры как у Connector.move_order).
+
+    :return:
+        Байты команды.
+    """
+    return _MOVEORDER % (_text(str(id)), _text(str(price)), _text(str(quantity)), _text(str(moveflag)))
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Загрузка истории свечей с автоматической подкачкой страниц.
+
+get_history отдает одну порцию свечей, а что история еще есть, сообщает
+status пакета candles:
+
+* 0 - данных больше нет;
+* 1 - заказанное количество выдано, за следующей порцией нужен новый запрос;
+* 2 - продолжение следует (придут еще пакеты по этому же запросу);
+* 3 - данные сейчас недоступны, стоит запросить позже.
+
+HistoryLoader запрашивает страницы с reset=False, пока не наберет нужное
+количество или не дойдет до заданной даты, качает несколько инструментов
+параллельно (темп команд задает планировщик сессии, см. scheduler),
+выкидывает повторы свечей и отдает по каждому инструменту сплошные
+массивы::
+
+    since = datetime.datetime.now() - datetime.timedelta(days=365)
+    series = conn.load_history(None, period=1, since=since, board="TQBR")
+    series["SBER"].close  # array('d')
+
+Свечи приходят в хэндлер сессии как обычно. Если сессии заданы теги
+(см. initialize), среди них должен быть candles.
+"""
+import array, calendar, logging, threading, time
+from collections import OrderedDict
+from Queue import Queue, Empty
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Под вторым питоном нужен бэкпорт futures
+    ThreadPoolExecutor = None
+from structures import HistoryCandlePacket
+
+log = logging.getLogger("transaq.connector")
+
+# Статусы пакета candles
+NO_MORE = 0
+DONE = 1
+CONTINUED = 2
+UNAVAILABLE = 3
+
+
+class HistoryError(Exception):
+    """
+    Историю по инструменту не удалось загрузить до конца.
+    """
+    pass
+
+
+class CandleArrays(object):
+    """
+    Свечи инструмента сплошными массивами по возрастанию времени.
+    Время - секунды эпохи по времени сервера (без поправки на таймзону),
+    остальные поля - array('d').
+
+    :ivar error:
+        HistoryError, если загрузка прервалась (в массивах то, что успело прийти).
+    """
+    FIELDS = ('date', 'open', 'high', 'low', 'close', 'volume', 'open_interest')
+
+    def __init__(self, board, seccode, period, candles=(), error=None):
+        self.board = board
+        self.seccode = seccode
+        self.period = period
+        self.error = error
+        for name in self.FIELDS:
+            setattr(self, name, array.array('d'))
+        for candle in candles:
+            self.date.append(calendar.timegm(candle.date.timetuple()))
+            for name in self.FIELDS[1:]:
+                val = getattr(candle, name)
+                getattr(self, name).append(float('nan') if val is None else val)
+
+    def __len__(self):
+        return len(self.date)
+
+    def __repr__(self):
+        return "CandleArrays(%s:%s, period=%s, %d candles%s)" % (
+            self.board, self.seccode, self.period, len(self), ", failed" if self.error else "")
+
+
+class _Job(object):
+    # Загрузка одного инструмента
+    def __init__(self, board, seccode, period, count, since):
+        self.board = board
+        self.seccode = seccode
+        self.period = period
+        self.count = count
+        self.since = since
+        self.packets = Queue()
+        # Свечи по времени, повторы перекрываются
+        self.candles = {}
+        self.oldest = None
+
+    def merge(self, items):
+        # Влить свечи, вернуть число новых
+        before = len(self.candles)
+        for candle in items:
+            self.candles[candle.date] = candle
+            if self.oldest is None or candle.date < self.oldest:
+                self.oldest = candle.date
+        return len(self.candles) - before
+
+    def enough(self):
+        if self.count is not None and len(self.candles) >= self.count:
+            return True
+        return self.since is not None and self.oldest is not None and self.oldest <= self.since
+
+    def result(self, error=None):
+        candles = [self.candles[date] for date in sorted(self.candles)
+                   if self.since is None or date >= self.since]
+        if self.count is not None:
+            candles = candles[-self.count:]
+        return CandleArrays(self.board, self.seccode, self.period, candles, error)
+
+
+class HistoryLoader(object):
+    """
+    Загрузчик истории сессии (см. Connector.history).
+
+    :param connector:
+        Connector, через который отправляются запросы.
+    :param page:
+        Свечей в одном запросе.
+    :param workers:
+        Сколько инструментов качать одновременно.
+    :param timeout:
+        Сколько ждать очередной пакет, секунд.
+    :param retries:
+        Сколько раз повторять запрос при статусе 3.
+    :param retry_delay:
+        Пауза перед повтором, секунд.
+    """
+
+    def __init__(self, connector, page=1000, workers=4, timeout=30, retries=3, retry_delay=1.0):
+        self.connector = connector
+        self.page = page
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # Активные загрузки по (доска, код, период)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, obj):
+        self.on_message(obj)
+
+    def on_message(self, obj):
+        """
+        Обработать входящее сообщение: пакеты candles отдаются своим загрузкам.
+        """
+        if getattr(obj, 'ROOT_NAME', None) != HistoryCandlePacket.ROOT_NAME:
+            return
+        job = self._jobs.get((obj.board, obj.seccode, obj.period))
+        if job is not None:
+            job.packets.put(obj)
+
+    def load(self, seccodes, period, count=None, since=None, board=None):
+        """
+        Загрузить историю по инструментам (синхронно).
+
+        :param seccodes:
+            Коды инструментов, пары (доска, код) или None - все инструменты
+            доски из справочника сессии (см. secmaster).
+        :param period:
+            Идентификатор периода.
+        :param count:
+            Сколько последних свечей нужно.
+        :param since:
+            Начиная с какого времени (datetime) нужны свечи.
+        :param board:
+            Доска для кодов без доски.
+        :return:
+            Упорядоченный словарь код -> CandleArrays (ключ - пара (доска, код),
+            если в seccodes были пары).
+        """
+        if ThreadPoolExecutor is None:
+            raise ImportError("concurrent.futures is required for history loading")
+        if count is None and since is None:
+            raise ValueError("count or since is required")
+        if seccodes is None:
+            master = self.connector.security_master
+            if master is None or board is None:
+                raise ValueError("seccodes are required without a security master and board")
+            seccodes = master.seccodes(board)
+        period = int(period)
+        keys = list(seccodes)
+        jobs = [_Job(key[0], key[1], period, count, since) if isinstance(key, tuple)
+                else _Job(board, key, period, count, since) for key in keys]
+        with self._lock:
+            for job in jobs:
+                if (job.board, job.seccode, period) in self._jobs:
+                    raise ValueError("history of %s:%s is already loading" % (job.board, job.seccode))
+            for job in jobs:
+                self._jobs[(job.board, job.seccode, period)] = job
+        pool = ThreadPoolExecutor(max(1, min(self.workers, len(jobs))))
+        try:
+            results = list(pool.map(self._run, jobs))
+        finally:
+            pool.shutdown(wait=False)
+            with self._lock:
+                for job in jobs:
+                    del self._jobs[(job.board, job.seccode, job.period)]
+        return OrderedDict(zip(keys, results))
+
+    def _run(self, job):
+        # Подкачивать страницы по одному инструменту
+        reset = True
+        failures = 0
+        try:
+            while True:
+                result = self.connector.get_history(job.board, job.seccode, job.period,
+                                                    self.page, reset)
+                if result is not None and result.success is False:
+                    raise HistoryError(u"Запрос истории %s:%s не прошел: %s"
+                                       % (job.board, job.seccode, result.text))
+                added = 0
+                while True:
+                    try:
+                        packet = job.packets.get(timeout=self.timeout)
+                    except Empty:
+                        raise HistoryError(u"Нет истории %s:%s за %s с"
+                                           % (job.board, job.seccode, self.timeout))
+                    added += job.merge(packet.items or ())
+                    if packet.status != CONTINUED:
+                        break
+                if packet.status == UNAVAILABLE:
+                    failures += 1
+                    if failures > self.retries:
+                        raise HistoryError(u"История %s:%s недоступна" % (job.board, job.seccode))
+                    time.sleep(self.retry_delay)
+                    continue
+                reset = False
+                # Больше данных нет, набрали сколько нужно или новых свечей не пришло
+                if packet.status == NO_MORE or job.enough() or not added:
+                    return job.result()
+        except HistoryError as e:
+            log.error(e.args[0])
+            return job.result(e)
+        except Exception as e:
+            log.exception(u"Ошибка загрузки истории %s:%s", job.board, job.seccode)
+            return job.result(HistoryError(e))
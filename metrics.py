@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Метрики пути приема сообщений.
+
+Для каждого корневого тега считаются сообщения и байты, а времена стадий
+(копирование из памяти коннектора, разбор, хэндлер, ожидание в очереди)
+раскладываются по гистограммам с фиксированными корзинами. Замеряется
+каждое sample-е сообщение тега, так что метрики можно не выключать::
+
+    metrics = Metrics(sample=10)
+    initialize(logdir, loglevel, handler, metrics=metrics)
+    ...
+    metrics.histogram('quotes', PARSE).percentile(99)
+
+Счетчики обновляются без блокировок и при нескольких рабочих потоках
+могут чуть отставать от реальности.
+"""
+from bisect import bisect_left
+from timeit import default_timer as timer
+
+# Стадии приема
+COPY = 'copy'
+PARSE = 'parse'
+HANDLER = 'handler'
+QUEUE = 'queue'
+STAGES = (COPY, PARSE, HANDLER, QUEUE)
+# Верхние границы корзин в микросекундах, последняя корзина - все остальное
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+           10000, 20000, 50000, 100000, 200000, 500000, 1000000)
+
+
+class Histogram(object):
+    """
+    Гистограмма времен с фиксированными корзинами.
+
+    :param bounds:
+        Верхние границы корзин в микросекундах.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """
+        Добавить замер.
+
+        :param seconds:
+            Время в секундах.
+        """
+        micros = seconds * 1e6
+        self.counts[bisect_left(self.bounds, micros)] += 1
+        self.count += 1
+        self.total += micros
+        if micros > self.max:
+            self.max = micros
+
+    @property
+    def mean(self):
+        """
+        Среднее время в микросекундах.
+        """
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """
+        Оценка перцентиля сверху (граница корзины) в микросекундах.
+
+        :param q:
+            Перцентиль от 0 до 100.
+        """
+        if not self.count:
+            return 0.0
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(float(bound), self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        Словарь со значениями гистограммы.
+        """
+        return {'count': self.count, 'mean': self.mean, 'max': self.max,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'buckets': zip(self.bounds + (None,), self.counts)}
+
+
+class TagMetrics(object):
+    """
+    Метрики одного корневого тега.
+    """
+    __slots__ = ('count', 'bytes', 'sampled', 'stages')
+
+    def __init__(self, bounds=BUCKETS):
+        self.count = 0
+        self.bytes = 0
+        self.sampled = 0
+        self.stages = dict((stage, Histogram(bounds)) for stage in STAGES)
+
+    def snapshot(self):
+        result = dict((stage, hist.snapshot()) for stage, hist in self.stages.items())
+        result.update(count=self.count, bytes=self.bytes, sampled=self.sampled)
+        return result
+
+
+class Metrics(object):
+    """
+    Метрики приема по корневым тегам.
+
+    :param sample:
+        Замерять время каждого sample-го сообщения тега
+        (сообщения и байты считаются всегда).
+    :param bounds:
+        Границы корзин гистограмм в микросекундах.
+    """
+
+    def __init__(self, sample=1, bounds=BUCKETS):
+        self.sample = sample
+        self.bounds = tuple(bounds)
+        self.tags = {}
+
+    def _tag(self, tag):
+        metrics = self.tags.get(tag)
+        if metrics is None:
+            metrics = self.tags[tag] = TagMetrics(self.bounds)
+        return metrics
+
+    def count(self, tag, size):
+        """
+        Учесть сообщение.
+
+        :param tag:
+            Корневой тег.
+        :param size:
+            Размер в байтах.
+        :return:
+            True если время этого сообщения надо замерить.
+        """
+        metrics = self.tags.get(tag) or self._tag(tag)
+        metrics.count += 1
+        metrics.bytes += size
+        if metrics.count % self.sample:
+            return False
+        metrics.sampled += 1
+        return True
+
+    def observe(self, tag, stage, seconds):
+        """
+        Добавить замер стадии.
+        """
+        (self.tags.get(tag) or self._tag(tag)).stages[stage].add(seconds)
+
+    def histogram(self, tag, stage):
+        """
+        Гистограмма стадии для тега (None если тег не встречался).
+        """
+        metrics = self.tags.get(tag)
+        return None if metrics is None else metrics.stages[stage]
+
+    def snapshot(self):
+        """
+        Все метрики в виде словаря тег -> значения.
+        """
+        return dict((tag, metrics.snapshot()) for tag, metrics in self.tags.items())
+
+    def reset(self):
+        """
+        Обнулить метрики.
+        """
+        self.tags = {}
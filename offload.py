@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Разбор тяжелых сообщений Транзака в пуле процессов.
+
+Большие разовые ответы (securities, candles, ticks, полный снапшот orders)
+надолго занимают поток коллбэка, и котировки копятся за ними. Offloader
+отправляет такие сообщения (по размеру или по корневому тегу) в пул
+concurrent.futures, а мелкие сообщения разбираются в коллбэке как раньше.
+
+Из пула возвращаются компактные записи (см. structures.Record) - они
+легко пиклятся. Сообщения с тегами, где важен порядок (заявки, сделки,
+позиции), отдаются хэндлеру строго в порядке прихода: пока впереди
+разбирается такое сообщение, следующие за ним ждут своей очереди.
+Остальные результаты отдаются по мере готовности.
+
+Все результаты пула отдает хэндлеру один поток доставки, а с доставкой
+из коллбэка он не пересекается: хэндлер никогда не вызывается параллельно.
+"""
+import logging, threading
+from collections import deque
+from structures import *
+import structures
+
+try:
+    from concurrent.futures import Future, ProcessPoolExecutor
+except ImportError:
+    # Под вторым питоном нужен бэкпорт futures
+    Future = ProcessPoolExecutor = None
+
+log = logging.getLogger("transaq.connector")
+
+# Теги, для которых важен порядок доставки
+ORDERED_TAGS = frozenset([ClientOrderPacket.ROOT_NAME, ClientTradePacket.ROOT_NAME,
+                          PositionPacket.ROOT_NAME])
+
+
+def _decode(data):
+    # Выполняется в процессе пула
+    return structures.parse(data, compact=True)
+
+
+class Offloader(object):
+    """
+    Отправка тяжелых сообщений на разбор в пул процессов.
+
+    :param min_size:
+        Сообщения от этого размера (в байтах) разбираются в пуле.
+        None - только по тегам.
+    :param tags:
+        Корневые теги, которые всегда разбираются в пуле.
+    :param workers:
+        Число процессов пула (None - по числу ядер).
+    :param ordered_tags:
+        Теги, для которых сохраняется порядок прихода.
+    """
+
+    def __init__(self, min_size=256 * 1024, tags=(), workers=None, ordered_tags=ORDERED_TAGS):
+        self.min_size = min_size
+        self.tags = frozenset(tags)
+        self.workers = workers
+        self.ordered_tags = frozenset(ordered_tags)
+        self.submitted = 0
+        self._deliver = None
+        self._pool = None
+        self._thread = None
+        # Очередь упорядоченной доставки: фьючерсы в порядке прихода
+        self._pending = deque()
+        # Готовые неупорядоченные фьючерсы и сколько их еще в пуле
+        self._ready = deque()
+        self._unordered = 0
+        self._cond = threading.Condition()
+        # Хэндлер вызывается по одному: из потока доставки или из коллбэка
+        self._handler_lock = threading.Lock()
+        self._running = False
+
+    def start(self, deliver):
+        """
+        Запустить пул и поток доставки.
+
+        :param deliver:
+            Функция, получающая готовые объекты.
+        """
+        if ProcessPoolExecutor is None:
+            raise ImportError("concurrent.futures is required for offloading")
+        self._deliver = deliver
+        self._pool = ProcessPoolExecutor(self.workers)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="transaq-offload")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self, wait=True):
+        """
+        Остановить пул. Уже отправленные сообщения доставляются.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown(wait)
+            self._pool = None
+
+    def wants(self, tag, msg):
+        """
+        Нужно ли разбирать сообщение в пуле.
+
+        :param tag:
+            Корневой тег сообщения.
+        :param msg:
+            Сообщение (байты).
+        """
+        return tag in self.tags or (self.min_size is not None and len(msg) >= self.min_size)
+
+    def submit(self, tag, msg):
+        """
+        Отправить сообщение на разбор в пул.
+        """
+        future = self._pool.submit(_decode, msg)
+        ordered = tag in self.ordered_tags
+        with self._cond:
+            self.submitted += 1
+            if ordered:
+                self._pending.append(future)
+            else:
+                self._unordered += 1
+        future.add_done_callback(self._wake if ordered else self._done)
+        return future
+
+    def deliver(self, tag, obj):
+        """
+        Доставить разобранное в коллбэке сообщение, не обгоняя
+        упорядоченные сообщения в пуле.
+        """
+        if tag in self.ordered_tags:
+            with self._cond:
+                if self._pending:
+                    ready = Future()
+                    ready.set_result(obj)
+                    self._pending.append(ready)
+                    self._cond.notify()
+                    return
+        with self._handler_lock:
+            self._deliver(obj)
+
+    def _wake(self, future):
+        # Упорядоченный фьючерс готов: разбудить поток доставки
+        with self._cond:
+            self._cond.notify()
+
+    def _done(self, future):
+        # Неупорядоченный результат - в очередь потока доставки
+        with self._cond:
+            self._unordered -= 1
+            self._ready.append(future)
+            self._cond.notify()
+
+    def _run(self):
+        # Поток доставки результатов пула
+        while True:
+            with self._cond:
+                while True:
+                    if self._ready:
+                        future, ordered = self._ready.popleft(), False
+                        break
+                    if self._pending and self._pending[0].done():
+                        future, ordered = self._pending[0], True
+                        break
+                    if not (self._running or self._pending or self._unordered):
+                        return
+                    self._cond.wait()
+            try:
+                obj = future.result()
+            except Exception:
+                log.exception(u"Не удалось разобрать сообщение в пуле")
+                obj = None
+            try:
+                if obj is not None:
+                    with self._handler_lock:
+                        self._deliver(obj)
+            except Exception:
+                log.exception(u"Ошибка в хэндлере")
+            finally:
+                # Убираем из очереди только после доставки, иначе
+                # следующее сообщение из коллбэка может обогнать
+                if ordered:
+                    with self._cond:
+                        self._pending.popleft()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Отслеживание заявок по номеру транзакции.
+
+Команды new_order, new_stoploss, move_order и т.п. возвращают лишь
+CmdResult с transactionid, а состояние заявки приходит позже
+в пакетах orders. OrderTracker сопоставляет их и отдает по каждой
+команде фьючерс, который обновляется с каждым новым состоянием заявки
+и завершается, когда заявка дошла до нужного статуса::
+
+    tracker = OrderTracker()
+    initialize(logdir, loglevel, handler, tracker=tracker)
+    future = tracker.track(new_order(...), statuses=['matched'], timeout=30)
+    order = future.result()
+
+В пути доставки на каждую заявку пакета - один поиск в словаре.
+"""
+import heapq, itertools, logging, threading
+from collections import OrderedDict
+from structures import ClientOrderPacket
+from metrics import timer
+
+try:
+    from concurrent.futures import Future, TimeoutError
+except ImportError:
+    # Под вторым питоном нужен бэкпорт futures
+    Future = TimeoutError = None
+
+log = logging.getLogger("transaq.connector")
+
+# Конечные статусы обычных и условных заявок
+FINAL_STATUSES = frozenset(['cancelled', 'denied', 'disabled', 'expired', 'failed', 'matched',
+                            'refused', 'rejected', 'removed', 'sl_executed', 'tp_executed'])
+
+
+class OrderError(Exception):
+    """
+    Команда по заявке не принята сервером.
+    """
+    pass
+
+
+class OrderTimeout(TimeoutError or Exception):
+    """
+    Заявка не дошла до нужного статуса за отведенное время.
+    """
+    pass
+
+
+class OrderFuture(Future or object):
+    """
+    Фьючерс заявки. Результат - состояние заявки (Order, StopLoss, TakeProfit
+    или их записи) в одном из целевых статусов.
+
+    :param id:
+        Номер транзакции.
+    :param statuses:
+        Целевые статусы.
+    """
+
+    def __init__(self, id, statuses):
+        super(OrderFuture, self).__init__()
+        self.id = id
+        self.statuses = frozenset(statuses)
+        # Последнее известное состояние заявки и число обновлений
+        self.order = None
+        self.updates = 0
+        self._update_callbacks = []
+
+    def add_update_callback(self, fn):
+        """
+        Вызывать fn(future) при каждом новом состоянии заявки.
+        """
+        self._update_callbacks.append(fn)
+
+    def _update(self, order):
+        # Новое состояние заявки, True если фьючерс завершен.
+        # Отмененный пользователем фьючерс больше не трогаем.
+        if self.done():
+            return True
+        self.order = order
+        self.updates += 1
+        for fn in self._update_callbacks:
+            try:
+                fn(self)
+            except Exception:
+                log.exception(u"Ошибка в обработчике заявки %s" % self.id)
+        if order.status in self.statuses:
+            self.set_result(order)
+            return True
+        return False
+
+
+class OrderTracker(object):
+    """
+    Сопоставление команд и состояний заявок по transactionid.
+
+    :param statuses:
+        Целевые статусы по умолчанию.
+    :param history:
+        Сколько последних состояний заявок помнить. Пакет с заявкой
+        может прийти раньше, чем вызвано track().
+    """
+
+    def __init__(self, statuses=FINAL_STATUSES, history=1000):
+        if Future is None:
+            raise ImportError("concurrent.futures is required for order tracking")
+        self.statuses = frozenset(statuses)
+        self.history = history
+        # transactionid -> фьючерсы
+        self._futures = {}
+        # Последние состояния заявок
+        self._last = OrderedDict()
+        # Куча (срок, номер, фьючерс) для таймаутов
+        # и число еще не завершенных фьючерсов в ней
+        self._deadlines = []
+        self._timed = 0
+        self._counter = itertools.count()
+        # Колбэки фьючерсов могут снова звать трекер
+        self._lock = threading.RLock()
+        # Поток, завершающий просроченные фьючерсы (пока есть незавершенные со сроком)
+        self._wakeup = threading.Condition(self._lock)
+        self._reaper = None
+
+    @property
+    def pending(self):
+        """
+        Число отслеживаемых заявок.
+        """
+        return len(self._futures)
+
+    def track(self, result, statuses=None, timeout=None):
+        """
+        Отслеживать заявку.
+
+        :param result:
+            CmdResult команды (объект или запись) либо номер транзакции.
+        :param statuses:
+            Статусы, на которых фьючерс завершается (по умолчанию конечные).
+        :param timeout:
+            Через сколько секунд завершить фьючерс с OrderTimeout.
+            Сроки отслеживает фоновый поток трекера, даже если
+            заявки больше не приходят.
+        :return:
+            OrderFuture.
+        """
+        if isinstance(result, (int, long)):
+            id = result
+        else:
+            if not result.success:
+                future = OrderFuture(result.id, ())
+                future.set_exception(OrderError(result.text))
+                return future
+            id = result.id
+        future = OrderFuture(id, self.statuses if statuses is None else statuses)
+        with self._lock:
+            order = self._last.get(id)
+            if order is not None and future._update(order):
+                return future
+            self._futures.setdefault(id, []).append(future)
+            if timeout is not None:
+                heapq.heappush(self._deadlines, (timer() + timeout, next(self._counter), future))
+                self._timed += 1
+                future.add_done_callback(self._untime)
+                if self._reaper is None:
+                    self._reaper = threading.Thread(target=self._reap, name="transaq-order-timeouts")
+                    self._reaper.daemon = True
+                    self._reaper.start()
+                elif self._deadlines[0][2] is future:
+                    self._wakeup.notify()
+        return future
+
+    def on_message(self, obj):
+        """
+        Обработать входящее сообщение (вызывается в пути доставки).
+        """
+        if getattr(obj, 'ROOT_NAME', None) != ClientOrderPacket.ROOT_NAME:
+            return
+        with self._lock:
+            futures = self._futures
+            for order in obj.items:
+                self._remember(order)
+                waiting = futures.get(order.id)
+                if waiting is None:
+                    continue
+                waiting = [future for future in waiting if not future._update(order)]
+                if waiting:
+                    futures[order.id] = waiting
+                else:
+                    del futures[order.id]
+            if self._deadlines:
+                self._expire(timer())
+
+    def expire(self, now=None):
+        """
+        Завершить просроченные фьючерсы.
+
+        :param now:
+            Текущее время по metrics.timer (по умолчанию сейчас).
+        """
+        with self._lock:
+            self._expire(timer() if now is None else now)
+
+    def _remember(self, order):
+        last = self._last
+        last.pop(order.id, None)
+        last[order.id] = order
+        if len(last) > self.history:
+            last.popitem(last=False)
+
+    def _untime(self, future):
+        # Фьючерс со сроком завершился (в том числе отменой снаружи)
+        with self._lock:
+            self._timed -= 1
+            if not self._timed:
+                del self._deadlines[:]
+                self._wakeup.notify()
+
+    def _reap(self):
+        # Цикл фонового потока: спит до ближайшего срока,
+        # выходит, когда ждать больше нечего
+        with self._lock:
+            while self._timed:
+                now = timer()
+                self._expire(now)
+                if self._timed:
+                    self._wakeup.wait(self._deadlines[0][0] - now)
+            self._reaper = None
+
+    def _expire(self, now):
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            future = heapq.heappop(deadlines)[2]
+            if future.done():
+                continue
+            waiting = self._futures.get(future.id, [])
+            if future in waiting:
+                waiting.remove(future)
+                if not waiting:
+                    del self._futures[future.id]
+            future.set_exception(OrderTimeout("order %s: no status in %s"
+                                              % (future.id, sorted(future.statuses))))
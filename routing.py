@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Раздача сообщений хэндлерам по подпискам.
+
+Вместо одного хэндлера с цепочкой isinstance на каждое сообщение
+хэндлеры подписываются на корневой тег и, при желании, на конкретный
+инструмент или клиента. Router сам является хэндлером, его передают
+в initialize()::
+
+    router = Router()
+    router.subscribe(on_quotes, 'quotes', seccode='SBER')
+    router.subscribe(on_orders, 'orders', client='c1')
+    initialize(logdir, loglevel, router)
+
+Подписки хранятся в готовых словарях: на каждый элемент пакета -
+один поиск по каждому используемому для тега ключу, вне зависимости от
+числа подписчиков.
+"""
+import logging, threading
+from structures import message_tag
+
+log = logging.getLogger("transaq.connector")
+
+# Поля элементов, по которым можно подписываться
+KEYS = ('secid', 'seccode', 'client')
+
+
+class Router(object):
+    """
+    Маршрутизатор сообщений по тегам и инструментам.
+    Хэндлеры, подписанные только на тег, получают сообщение целиком,
+    подписанные на ключ - список подходящих элементов пакета
+    (для одиночных сообщений - список из него самого).
+    """
+
+    def __init__(self):
+        # Список подписок (handler, tag, key, value)
+        self._subs = []
+        # Готовые индексы, меняются целиком под блокировкой
+        self._whole = {}
+        self._keyed = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, handler, tag=None, **key):
+        """
+        Подписать хэндлер.
+
+        :param handler:
+            Функция от одного аргумента.
+        :param tag:
+            Корневой тег сообщений (None - все сообщения).
+        :param key:
+            Не больше одного из secid, seccode, client.
+        :return:
+            handler (удобно для декоратора).
+        """
+        if len(key) > 1 or (key and key.keys()[0] not in KEYS):
+            raise ValueError("one of %s expected, got %s" % (KEYS, key.keys()))
+        if key and tag is None:
+            raise ValueError("key subscription needs a tag")
+        field, value = key.items()[0] if key else (None, None)
+        with self._lock:
+            self._subs.append((handler, tag, field, value))
+            self._rebuild()
+        return handler
+
+    def unsubscribe(self, handler, tag=None):
+        """
+        Отписать хэндлер от тега (None - от всего).
+        """
+        with self._lock:
+            self._subs = [sub for sub in self._subs
+                          if sub[0] != handler or (tag is not None and sub[1] != tag)]
+            self._rebuild()
+
+    def _rebuild(self):
+        whole, keyed = {}, {}
+        for handler, tag, field, value in self._subs:
+            if field is None:
+                whole.setdefault(tag, []).append(handler)
+            else:
+                fields, index = keyed.setdefault(tag, ([], {}))
+                if field not in fields:
+                    fields.append(field)
+                index.setdefault((field, value), []).append(handler)
+        self._whole = whole
+        self._keyed = dict((tag, (tuple(fields), index)) for tag, (fields, index) in keyed.items())
+
+    def __call__(self, obj):
+        self.route(obj)
+
+    def route(self, obj):
+        """
+        Раздать сообщение подписчикам.
+        """
+        tag = message_tag(obj)
+        whole = self._whole
+        for handler in whole.get(tag, ()):
+            handler(obj)
+        for handler in whole.get(None, ()):
+            handler(obj)
+        keyed = self._keyed.get(tag)
+        if keyed is None:
+            return
+        fields, index = keyed
+        items = getattr(obj, 'items', None)
+        if items is None:
+            items = [obj]
+        # Элементы по хэндлерам, в порядке первого совпадения
+        batches = {}
+        handlers = []
+        for item in items:
+            for field in fields:
+                for handler in index.get((field, getattr(item, field, None)), ()):
+                    batch = batches.get(handler)
+                    if batch is None:
+                        batches[handler] = [item]
+                        handlers.append(handler)
+                    elif batch[-1] is not item:
+                        batch.append(item)
+        for handler in handlers:
+            handler(batches[handler])
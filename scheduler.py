@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Очередность и темп отправки команд.
+
+Команды из разных потоков проходят через CommandScheduler: каждая
+встает в свою полосу, и следующей уходит первая команда самой важной
+непустой полосы. Темп держит корзина токенов, пополняемая раз в rqdelay
+(тот же, что задан в connect), с запасом на короткие всплески::
+
+    scheduler = CommandScheduler(burst=5)
+    initialize(logdir, loglevel, handler, scheduler=scheduler)
+    connect(login, password, server, min_delay=100)
+    ...
+    scheduler.lanes[CANCEL].wait.percentile(99)
+
+Полосы: снятие и перестановка заявок, новые заявки, все остальное
+(запросы, история, подписки). Команду отправляет сам вызвавший поток,
+отдельного потока у планировщика нет.
+"""
+import threading, time
+from collections import deque
+from timeit import default_timer as timer
+from metrics import Histogram, BUCKETS
+
+CANCEL = 0
+ORDER = 1
+QUERY = 2
+LANE_NAMES = ('cancel', 'order', 'query')
+# Полосы команд по id, остальные идут в QUERY
+COMMAND_LANES = {
+    'cancelorder': CANCEL,
+    'cancelstoporder': CANCEL,
+    'moveorder': CANCEL,
+    'neworder': ORDER,
+    'newstoporder': ORDER,
+    'newcondorder': ORDER,
+}
+
+
+class LaneMetrics(object):
+    """
+    Метрики полосы: глубина очереди и время ожидания отправки.
+    """
+    __slots__ = ('depth', 'max_depth', 'sent', 'wait')
+
+    def __init__(self, bounds=BUCKETS):
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.wait = Histogram(bounds)
+
+    def snapshot(self):
+        return {'depth': self.depth, 'max_depth': self.max_depth, 'sent': self.sent,
+                'wait': self.wait.snapshot()}
+
+
+class CommandScheduler(object):
+    """
+    Планировщик отправки команд по полосам с корзиной токенов.
+
+    :param rqdelay:
+        Интервал пополнения корзины в миллисекундах (rqdelay из connect),
+        0 - без ограничения темпа.
+    :param burst:
+        Емкость корзины: сколько команд можно отправить подряд без ожидания.
+    :param lanes:
+        Словарь id команды -> полоса вместо COMMAND_LANES.
+    :param bounds:
+        Границы корзин гистограмм ожидания в микросекундах.
+    """
+
+    def __init__(self, rqdelay=100, burst=5, lanes=None, bounds=BUCKETS):
+        self.burst = burst
+        self.command_lanes = dict(COMMAND_LANES if lanes is None else lanes)
+        self.lanes = [LaneMetrics(tuple(bounds)) for name in LANE_NAMES]
+        self._queues = [deque() for name in LANE_NAMES]
+        self.rqdelay = rqdelay
+        self.rate = _rate(rqdelay)
+        self._tokens = float(burst)
+        self._stamp = timer()
+        self._cond = threading.Condition(threading.Lock())
+
+    def set_delay(self, rqdelay):
+        """
+        Задать интервал пополнения корзины (вызывается из connect).
+
+        :param rqdelay:
+            Миллисекунды, 0 - без ограничения темпа.
+        """
+        rate = _rate(rqdelay)
+        with self._cond:
+            self._refill(timer())
+            self.rqdelay = rqdelay
+            self.rate = rate
+
+    def lane(self, command):
+        """
+        Полоса команды по ее id.
+        """
+        return self.command_lanes.get(command, QUERY)
+
+    def acquire(self, lane):
+        """
+        Дождаться очереди на отправку (потокобезопасно).
+        Команда уходит, когда она первая в самой важной непустой полосе
+        и в корзине есть токен.
+
+        :param lane:
+            CANCEL, ORDER или QUERY.
+        :return:
+            Время ожидания в секундах.
+        """
+        ticket = object()
+        start = timer()
+        queue = self._queues[lane]
+        stats = self.lanes[lane]
+        self._cond.acquire()
+        queue.append(ticket)
+        stats.depth = len(queue)
+        stats.max_depth = max(stats.max_depth, stats.depth)
+        try:
+            while True:
+                if self._head() is not ticket:
+                    self._cond.wait()
+                    continue
+                now = timer()
+                self._refill(now)
+                if self._tokens >= 1:
+                    break
+                # Спим до токена вне блокировки: за это время может прийти
+                # команда важнее, и после сна первой будет она
+                delay = (1 - self._tokens) / self.rate
+                self._cond.release()
+                try:
+                    time.sleep(delay)
+                finally:
+                    self._cond.acquire()
+            self._tokens -= 1
+            stats.sent += 1
+            waited = timer() - start
+            stats.wait.add(waited)
+            return waited
+        finally:
+            # Уходим из очереди и при прерванном ожидании, чтобы не держать остальных
+            queue.remove(ticket)
+            stats.depth = len(queue)
+            self._cond.notify_all()
+            self._cond.release()
+
+    def snapshot(self):
+        """
+        Метрики полос словарем имя полосы -> значения.
+        """
+        with self._cond:
+            return dict((name, stats.snapshot()) for name, stats in zip(LANE_NAMES, self.lanes))
+
+    def reset(self):
+        """
+        Сбросить счетчики и гистограммы (глубина очередей остается).
+        """
+        with self._cond:
+            for stats in self.lanes:
+                stats.max_depth = stats.depth
+                stats.sent = 0
+                stats.wait.reset()
+
+    def _head(self):
+        # Первая команда самой важной непустой полосы
+        for queue in self._queues:
+            if queue:
+                return queue[0]
+        return None
+
+    def _refill(self, now):
+        if self.rate is None:
+            self._tokens = float(self.burst)
+        else:
+            self._tokens = min(float(self.burst), self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+
+def _rate(rqdelay):
+    # Токенов в секунду, None - без ограничения
+    if rqdelay < 0:
+        raise ValueError("negative rqdelay %r" % rqdelay)
+    return 1000.0 / rqdelay if rqdelay else None
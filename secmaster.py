@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Справочник инструментов для проверки заявок до отправки.
+
+SecurityMaster собирает из пакетов securities (приходят после подключения)
+индекс (доска, код) -> шаг цены, знаки, лот и разрешенные типы заявок.
+Коннектор с таким справочником проверяет new_order, new_stoploss и
+new_takeprofit локально и не тратит круг до сервера на заведомый отказ::
+
+    master = SecurityMaster(snap=True)
+    initialize(logdir, loglevel, handler, master=master)
+    ...
+    new_order("TQBR", "SBER", client, "B", 10, 250.123, bymarket=False)  # уйдет по 250.12
+
+Количество в командах Транзака задается в лотах, поэтому проверяется,
+что это целое положительное число лотов. Перевести штуки в лоты
+с проверкой кратности лоту можно через lots().
+
+Проверка одной заявки - поиск в словаре и немного арифметики.
+Инструменты, которых нет в справочнике, пропускаются как есть
+(или отвергаются при strict).
+"""
+import math
+from structures import SecurityPacket
+
+# Допуск при проверке попадания цены в шаг, в долях шага
+_EPS = 1e-6
+
+
+class ValidationError(ValueError):
+    """
+    Заявка не проходит проверку по справочнику.
+    """
+    pass
+
+
+class SecuritySpec(object):
+    """
+    Параметры инструмента, нужные для проверки заявок.
+    """
+    __slots__ = ('board', 'seccode', 'active', 'minstep', 'decimals', 'lotsize',
+                 'bymarket_allowed', 'credit_allowed')
+
+    def __init__(self, sec):
+        for name in self.__slots__:
+            setattr(self, name, getattr(sec, name))
+
+    def __repr__(self):
+        return "SecuritySpec(%s:%s, minstep=%s, lotsize=%s)" % (
+            self.board, self.seccode, self.minstep, self.lotsize)
+
+
+class SecurityMaster(object):
+    """
+    Справочник инструментов по доске и коду.
+
+    :param snap:
+        Подгонять цены к шагу и количество к целым лотам вместо ошибки.
+    :param strict:
+        Отвергать заявки по инструментам, которых нет в справочнике.
+    """
+
+    def __init__(self, snap=False, strict=False):
+        self.snap = snap
+        self.strict = strict
+        self._specs = {}
+
+    def __len__(self):
+        return len(self._specs)
+
+    def __call__(self, obj):
+        self.on_message(obj)
+
+    def on_message(self, obj):
+        """
+        Обработать входящее сообщение: пакеты securities пополняют справочник.
+        """
+        if getattr(obj, 'ROOT_NAME', None) == SecurityPacket.ROOT_NAME:
+            for sec in obj.items:
+                self.add(sec)
+
+    def add(self, sec):
+        """
+        Добавить или обновить инструмент.
+
+        :param sec:
+            Security (объект eulxml или запись).
+        """
+        spec = SecuritySpec(sec)
+        self._specs[(spec.board, spec.seccode)] = spec
+
+    def get(self, board, seccode):
+        """
+        Параметры инструмента.
+
+        :return:
+            SecuritySpec или None.
+        """
+        return self._specs.get((board, seccode))
+
+    def seccodes(self, board):
+        """
+        Коды инструментов доски.
+
+        :return:
+            Отсортированный список.
+        """
+        return sorted(code for brd, code in self._specs.keys() if brd == board)
+
+    def check_order(self, board, seccode, buysell, quantity, price=0, bymarket=True,
+                    usecredit=True, trigger_price=None):
+        """
+        Проверить заявку и при snap подогнать цены и количество.
+        Цена лимитной заявки подгоняется в пассивную сторону (покупка вниз,
+        продажа вверх), цена активации - к ближайшему шагу.
+
+        :param quantity:
+            Количество в лотах.
+        :param price:
+            Цена заявки (не проверяется для bymarket).
+        :param trigger_price:
+            Цена активации условной заявки.
+        :return:
+            Тройка (quantity, price, trigger_price) для отправки.
+        :raises ValidationError:
+            Заявка не проходит проверку.
+        """
+        spec = self._specs.get((board, seccode))
+        if spec is None:
+            if self.strict:
+                raise ValidationError("unknown security %s:%s" % (board, seccode))
+            return quantity, price, trigger_price
+        if spec.active is False:
+            raise ValidationError("security %s:%s is not active" % (board, seccode))
+        if bymarket and spec.bymarket_allowed is False:
+            raise ValidationError("market orders are not allowed for %s:%s" % (board, seccode))
+        if usecredit and spec.credit_allowed is False:
+            raise ValidationError("credit is not allowed for %s:%s" % (board, seccode))
+        quantity = self._lots(spec, quantity)
+        if not bymarket:
+            price = self._price(spec, price, -1 if buysell.upper() == 'B' else 1)
+        if trigger_price is not None:
+            trigger_price = self._price(spec, trigger_price, 0)
+        return quantity, price, trigger_price
+
+    def lots(self, board, seccode, shares):
+        """
+        Перевести количество в штуках в лоты.
+
+        :return:
+            Число лотов (при snap - округленное вниз).
+        :raises ValidationError:
+            Количество не кратно лоту или инструмент неизвестен.
+        """
+        spec = self._specs.get((board, seccode))
+        if spec is None or not spec.lotsize:
+            raise ValidationError("no lot size for %s:%s" % (board, seccode))
+        lots, rest = divmod(shares, spec.lotsize)
+        if rest and not self.snap:
+            raise ValidationError("%s is not a multiple of lot size %d for %s:%s"
+                                  % (shares, spec.lotsize, board, seccode))
+        if lots <= 0:
+            raise ValidationError("%s is less than one lot for %s:%s" % (shares, board, seccode))
+        return int(lots)
+
+    def _lots(self, spec, quantity):
+        # Целое положительное число лотов
+        whole = int(math.floor(quantity))
+        if whole != quantity and not self.snap:
+            raise ValidationError("quantity %s is not a whole number of lots for %s:%s"
+                                  % (quantity, spec.board, spec.seccode))
+        if whole <= 0:
+            raise ValidationError("quantity %s is not positive for %s:%s"
+                                  % (quantity, spec.board, spec.seccode))
+        return whole
+
+    def _price(self, spec, price, direction):
+        # Цена в шаге; direction: -1 вниз, 1 вверх, 0 к ближайшему
+        step = spec.minstep
+        if not step:
+            return price
+        steps = float(price) / step
+        nearest = round(steps)
+        if abs(steps - nearest) <= _EPS:
+            return price
+        if not self.snap:
+            raise ValidationError("price %s is off the %s step for %s:%s"
+                                  % (price, step, spec.board, spec.seccode))
+        n = math.floor(steps) if direction < 0 else math.ceil(steps) if direction > 0 else nearest
+        return round(n * step, spec.decimals if spec.decimals is not None else 10)
@@ -7,44 +7,219 @@
 @author: Roma
 """
 from eulxml.xmlmap import *
-from eulxml.xmlmap.fields import Field, DateTimeMapper
-import sys, inspect, logging
+from eulxml.xmlmap.core import XmlObjectType
+from eulxml.xmlmap.fields import Field, NodeList, DateTimeMapper
+from eulxml import xmlmap
+from datetime import datetime
+import lxml.etree as et
+import copy, io, logging, re, sys
+import decoders
 
 log = logging.getLogger("transaq.connector")
 # Формат дат/времени используемый Транзаком
 timeformat = "%d.%m.%Y %H:%M:%S"
-# Список классов, ленивая инициализация при парсинге
-_my_classes = []
+# Кэш недавних дат для parse_datetime: 'дд.мм.гггг' -> (год, месяц, день)
+_dates = {}
+_dates_limit = 64
+# Реестр классов по корневому тегу, заполняется при объявлении классов
+_registry = {}
+# Корневой тег в начале сообщения (с необязательной xml-декларацией)
+_root_tag_re = re.compile(r'\s*(?:<\?.*?\?>\s*)?<([^\s/>]+)', re.S)
 
 
-def parse(xml):
+def parse(xml, compact=False):
     """
     Общая функция парсинга xml-структур.
 
     :param xml:
-        Текст XML.
+        Текст XML, лучше сразу байтами в utf-8: так lxml не перекодирует его.
+    :param compact:
+        Вернуть вместо объекта eulxml компактную запись (см. Record),
+        все поля которой посчитаны сразу и не ссылаются на xml.
     :return:
         Распарсенный объект. None если не распознан.
     """
-    global _my_classes
-    # Корневой тег достанем
-    root = parseString(xml).tag
-    # Пройдемся по всем классам модуля и найдем подходящий
-    if not len(_my_classes):
-        _my_classes = filter(lambda o: inspect.isclass(o) and issubclass(o, MyXmlObject),
-                             sys.modules[__name__].__dict__.values())
-    for cls in _my_classes:
-        if root == cls.ROOT_NAME:
-            return cls.parse(xml)
+    # Разбираем текст один раз, дальше работаем с корневым элементом
+    root = parseString(xml)
+    cls = _registry.get(root.tag)
+    if cls is not None:
+        return cls.decode(root) if compact else cls.from_element(root)
     # Лабуда какая-то пришла
-    log.error(u"Неподдерживаемый xml, не распарсился нихрена! Типа %s" % xml[:10])
+    log.error(u"Неподдерживаемый xml, не распарсился нихрена! Типа %s" % root.tag)
     log.debug(xml)
     return None
 
 
+def register(cls=None, root_name=None):
+    """
+    Зарегистрировать класс для корневого тега, перекрывая уже имеющийся.
+    Можно использовать как декоратор, в т.ч. для своих классов под теги,
+    которые библиотека пока не знает.
+
+    :param cls:
+        Класс структуры, наследник MyXmlObject.
+    :param root_name:
+        Корневой тег, по умолчанию ROOT_NAME класса.
+    :return:
+        Сам класс (или декоратор, если класс не передан).
+    """
+    if cls is None:
+        return lambda c: register(c, root_name)
+    tag = root_name or cls.ROOT_NAME
+    if not tag:
+        raise ValueError("no root tag for %s" % cls.__name__)
+    _registry[tag] = cls
+    return cls
+
+
+def registered_class(tag):
+    """
+    Класс, которым будет распарсен xml с данным корневым тегом.
+
+    :param tag:
+        Корневой тег.
+    :return:
+        Класс структуры или None.
+    """
+    return _registry.get(tag)
+
+
+def root_tag(xml):
+    """
+    Корневой тег по сырому тексту, без парсинга.
+
+    :param xml:
+        Текст XML.
+    :return:
+        Имя тега или None, если не нашелся.
+    """
+    m = _root_tag_re.match(xml)
+    return m.group(1) if m else None
+
+
+def message_tag(obj):
+    """
+    Корневой тег сообщения (объекта eulxml, записи или RawMessage).
+    """
+    return getattr(obj, 'ROOT_NAME', None) or getattr(obj, 'tag', None)
+
+
+def iterparse(xml, compact=True):
+    """
+    Потоковый разбор пакета по корневому тегу (см. Packet.stream).
+
+    :param xml:
+        Текст XML.
+    :param compact:
+        Отдавать компактные записи вместо объектов eulxml.
+    :return:
+        PacketStream или None, если пакет не распознан.
+    """
+    cls = _registry.get(root_tag(xml))
+    if cls is None or not issubclass(cls, Packet):
+        log.error(u"Неподдерживаемый для потокового разбора xml! Типа %s" % root_tag(xml))
+        return None
+    return cls.stream(xml, compact)
+
+
+def parse_datetime(text):
+    """
+    Быстрый разбор даты/времени в формате Транзака (timeformat).
+    Результат тот же, что у strptime(text, timeformat), но разбор даты
+    кэшируется: в сессии почти все сообщения приходят за один день.
+    Все, что не похоже на "дд.мм.гггг чч:мм:сс", отдается strptime.
+
+    :param text:
+        Строка с датой.
+    :return:
+        datetime.
+    """
+    return _fast_datetime(text) or datetime.strptime(text, timeformat)
+
+
+def _fast_datetime(text):
+    # Разбор строго "дд.мм.гггг чч:мм:сс", None если строка не такая
+    if len(text) != 19 or text[10] != ' ' or text[13] != ':' or text[16] != ':':
+        return None
+    date = _dates.get(text[:10])
+    if date is None:
+        if text[2] != '.' or text[5] != '.' or not \
+                (text[:2].isdigit() and text[3:5].isdigit() and text[6:10].isdigit()):
+            return None
+        date = (int(text[6:10]), int(text[3:5]), int(text[:2]))
+        try:
+            datetime(*date)
+        except ValueError:
+            return None
+        if len(_dates) >= _dates_limit:
+            _dates.clear()
+        _dates[text[:10]] = date
+    if not (text[11:13].isdigit() and text[14:16].isdigit() and text[17:].isdigit()):
+        return None
+    try:
+        return datetime(date[0], date[1], date[2], int(text[11:13]), int(text[14:16]), int(text[17:]))
+    except ValueError:
+        # Пусть strptime сам ругнется
+        return None
+
+
 ## Вспомогательные классы
 
-class NullableDateTimeMapper(DateTimeMapper):
+class RawMessage(object):
+    """
+    Сообщение коннектора, отданное без разбора: корневой тег и сырые байты.
+    Разбирается по требованию.
+    """
+    __slots__ = ('tag', 'data')
+
+    def __init__(self, tag, data):
+        self.tag = tag
+        self.data = data
+
+    def parse(self, compact=False):
+        """
+        Разобрать сообщение (см. parse).
+        """
+        return parse(self.data, compact)
+
+    def stream(self, compact=True):
+        """
+        Разобрать пакет потоково (см. iterparse).
+        """
+        return iterparse(self.data, compact)
+
+    def __repr__(self):
+        return "RawMessage(tag=%s, size=%d)" % (self.tag, len(self.data))
+
+
+class TransaqDateTimeMapper(DateTimeMapper):
+    """
+    DateTimeMapper, разбирающий формат Транзака через parse_datetime.
+    """
+
+    def to_python(self, node):
+        if node is None:
+            return None
+        if isinstance(node, basestring):
+            rep = node
+        else:
+            rep = self.XPATH(node)
+        dt = _fast_datetime(rep) if self.format == timeformat else None
+        return dt or super(TransaqDateTimeMapper, self).to_python(rep)
+
+
+class DateTimeField(xmlmap.DateTimeField):
+    """
+    DateTimeField, который для формата Транзака использует TransaqDateTimeMapper.
+    """
+
+    def __init__(self, xpath, format=None, normalize=False, *args, **kwargs):
+        super(DateTimeField, self).__init__(xpath, format, normalize, *args, **kwargs)
+        if format == timeformat and not normalize:
+            self.mapper = TransaqDateTimeMapper(format)
+
+
+class NullableDateTimeMapper(TransaqDateTimeMapper):
     """
     Оберточный класс вокруг DateTimeMapper,
         возвращающий None для заданных значений, а не вываливающий исключение при обработке даты.
@@ -61,26 +236,252 @@ class NullableDateTimeMapper(DateTimeMapper):
         if rep in self.nones:
             return None
         else:
-            return super(NullableDateTimeMapper, self).to_python(node)
+            return super(NullableDateTimeMapper, self).to_python(rep)
+
+
+class Record(object):
+    """
+    Компактная запись со значениями полей структуры.
+    Классы записей генерируются для каждой структуры (см. MyXmlObject.record_class),
+    имена и типы полей те же, что и у исходного класса.
+    """
+    __slots__ = ()
+    # Класс структуры, по которому сгенерирована запись
+    structure = None
+
+    def __init__(self, *values):
+        for i, name in enumerate(self.__slots__):
+            setattr(self, name, values[i] if i < len(values) else None)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, val in zip(self.__slots__, state):
+            setattr(self, name, val)
+
+    def to_dict(self):
+        """
+        Значения полей словарем, вложенные записи тоже словарями.
+        """
+        return dict((name, _export(getattr(self, name), dict)) for name in self.__slots__)
+
+    def to_tuple(self):
+        """
+        Значения полей кортежем, вложенные записи тоже кортежами.
+        """
+        return tuple(_export(getattr(self, name), tuple) for name in self.__slots__)
+
+    def __reduce__(self):
+        # Классы записей создаются на лету, поэтому pickle ссылается
+        # на структуру (в т.ч. вложенную) по модулю и полному имени
+        return _restore_record, (self.structure.__module__, self.structure._qualname,
+                                 self.__getstate__())
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    # Записи изменяемы и сравниваются по значениям - хэш по адресу
+    # нарушил бы равенство в множествах и словарях
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ["%s=%s" % (name, unicode(val)) for name, val
+                  in zip(self.__slots__, self.__getstate__()) if val]
+        return "%s(%s)" % (self.__class__.__name__, ', '.join(fields))
+
+
+class _RegisteredType(XmlObjectType):
+    """
+    Метакласс, заносящий классы с собственным ROOT_NAME в реестр парсинга.
+    При совпадении тегов остается первый объявленный класс,
+    перекрыть его можно явно через register().
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(_RegisteredType, cls).__init__(name, bases, attrs)
+        if attrs.get('ROOT_NAME'):
+            _registry.setdefault(attrs['ROOT_NAME'], cls)
+        # Полное имя класса с учетом вложенности (Внешний._Вложенный)
+        cls._qualname = name
+        for val in attrs.values():
+            if isinstance(val, _RegisteredType):
+                _nest(val, name)
+
+
+def _nest(cls, outer):
+    # Дописать имя внешнего класса вложенному и его вложенным
+    cls._qualname = outer + '.' + cls._qualname
+    for val in cls.__dict__.values():
+        if isinstance(val, _RegisteredType) and val is not cls:
+            _nest(val, outer)
+
+
+def _restore_record(module, qualname, state):
+    # Восстановить запись из pickle (см. Record.__reduce__)
+    __import__(module)
+    cls = sys.modules[module]
+    for name in qualname.split('.'):
+        cls = getattr(cls, name)
+    rec = object.__new__(cls.record_class())
+    rec.__setstate__(state)
+    return rec
+
+
+def _export(val, how):
+    # Значение поля для to_dict/to_tuple: how - dict или tuple
+    if isinstance(val, (MyXmlObject, Record)):
+        return val.to_dict() if how is dict else val.to_tuple()
+    if isinstance(val, (NodeList, list)):
+        return [_export(v, how) for v in val]
+    return val
+
+
+def _record_value(val):
+    # Значение поля для записи: вложенные структуры тоже в записи,
+    # списки в обычные списки, строки XPath и голые элементы отвязываем от дерева.
+    if isinstance(val, unicode):
+        return unicode(val)
+    if isinstance(val, str):
+        return str(val)
+    if isinstance(val, MyXmlObject):
+        return val.to_record()
+    if isinstance(val, (NodeList, list)):
+        return [_record_value(v) for v in val]
+    if isinstance(val, et._Element):
+        return copy.deepcopy(val)
+    return val
 
 
 class MyXmlObject(XmlObject):
     """
     Расширение eulxml.XmlObject с методом само-парсинга и наглядным представлением.
     """
+    __metaclass__ = _RegisteredType
 
     @classmethod
     def parse(cls, xml):
-        return load_xmlobject_from_string(xml, cls)
+        return cls.from_element(parseString(xml))
+
+    @classmethod
+    def from_element(cls, root):
+        """
+        Создать объект из уже распарсенного корневого элемента.
+
+        :param root:
+            Элемент lxml.
+        :return:
+            Объект структуры.
+        """
+        return cls(root)
+
+    @classmethod
+    def field_names(cls):
+        """
+        Имена полей класса в порядке объявления (кэшируется на класс).
+
+        :return:
+            Кортеж имен.
+        """
+        names = cls.__dict__.get('_field_names')
+        if names is None:
+            fields = [(field.creation_counter, name) for name, field in cls._fields.items()
+                      if isinstance(getattr(cls, name, None), Field)]
+            names = cls._field_names = tuple(name for _, name in sorted(fields))
+        return names
+
+    @classmethod
+    def value_names(cls):
+        """
+        Имена всех значений структуры: поля и _record_extras
+        (например items пакетов с самописным парсингом). Кэшируется на класс.
+
+        :return:
+            Кортеж имен.
+        """
+        names = cls.__dict__.get('_value_names')
+        if names is None:
+            names = cls.field_names()
+            names += tuple(n for n in getattr(cls, '_record_extras', ()) if n not in names)
+            cls._value_names = names
+        return names
+
+    @classmethod
+    def record_class(cls):
+        """
+        Класс компактной записи для этой структуры (генерируется один раз).
+
+        :return:
+            Наследник Record со слотами под каждое поле.
+        """
+        rec = cls.__dict__.get('_record_class')
+        if rec is None:
+            rec = cls._record_class = type(cls.__name__, (Record,), {
+                '__slots__': cls.value_names(), 'structure': cls, 'ROOT_NAME': cls.ROOT_NAME})
+        return rec
+
+    @classmethod
+    def decode(cls, root):
+        """
+        Разобрать элемент сразу в компактную запись сгенерированным декодером
+        (см. модуль decoders), минуя eulxml.
+
+        :param root:
+            Элемент lxml.
+        :return:
+            Экземпляр record_class().
+        """
+        return decoders.decoder(cls)(root)
+
+    def to_record(self):
+        """
+        Посчитать все поля и сложить в компактную запись без ссылок на xml.
+
+        :return:
+            Экземпляр record_class().
+        """
+        rec = self.record_class()
+        return rec(*[_record_value(getattr(self, name)) for name in rec.__slots__])
+
+    def to_dict(self):
+        """
+        Значения полей словарем, вложенные структуры тоже словарями.
+
+        :return:
+            Словарь имя -> значение.
+        """
+        return dict((name, _export(getattr(self, name), dict)) for name in self.value_names())
+
+    def to_tuple(self):
+        """
+        Значения полей кортежем в порядке value_names(),
+        вложенные структуры тоже кортежами.
+
+        :return:
+            Кортеж значений.
+        """
+        return tuple(_export(getattr(self, name), tuple) for name in self.value_names())
+
+    def __eq__(self, other):
+        # Равны объекты одного класса с равными полями
+        return type(self) == type(other) and self.to_tuple() == other.to_tuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    # Объекты изменяемы и сравниваются по значениям, см. Record
+    __hash__ = None
 
     def __repr__(self):
-        cls = self.__class__
         fields = []
-        for (name, val) in filter(lambda (name, val): isinstance(val, Field), inspect.getmembers(cls)):
-            val = self.__getattribute__(name)
+        for name in self.field_names():
+            val = getattr(self, name)
             if val:
                 fields.append("%s=%s" % (name, unicode(val)))
-        return "%s(%s)" % (cls.__name__, ', '.join(fields))
+        return "%s(%s)" % (self.__class__.__name__, ', '.join(fields))
 
 
 class Entity(MyXmlObject):
@@ -93,12 +494,77 @@ class Entity(MyXmlObject):
     def __eq__(self, other):
         return type(self) == type(other) and self.id == other.id
 
+    def __hash__(self):
+        return hash((type(self), self.id))
+
 
 class Packet(MyXmlObject):
     """
     Абстрактный пакет сущностей присланный серваком.
     """
     items = []
+    # Пакеты с самописным парсингом хранят items обычным списком
+    _record_extras = ('items',)
+
+    @classmethod
+    def stream(cls, source, compact=True):
+        """
+        Потоковый разбор пакета: элементы отдаются по одному сразу по мере
+        чтения, уже обработанные вырезаются из дерева. Для огромных пакетов
+        (бумаги, свечки, тики) память не растет с размером пакета.
+
+        :param source:
+            Текст XML или файлоподобный объект.
+        :param compact:
+            Отдавать компактные записи вместо объектов eulxml.
+        :return:
+            PacketStream.
+        """
+        field = cls._fields.get('items')
+        if not isinstance(field, NodeListField) or '/' in field.xpath:
+            raise ValueError("%s can't be streamed" % cls.__name__)
+        return PacketStream(cls, field.xpath, field.node_class, source, compact)
+
+
+class PacketStream(object):
+    """
+    Итератор по элементам пакета, разбираемого через lxml.iterparse.
+    Атрибуты самого пакета (secid, board, status...) доступны в packet
+    с момента получения первого элемента.
+    """
+
+    def __init__(self, cls, item_tag, item_class, source, compact=True):
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        if isinstance(source, str):
+            source = io.BytesIO(source)
+        self.packet_class = cls
+        self.item_tag = item_tag
+        self.item_class = item_class
+        self.source = source
+        self.compact = compact
+        # Пакет без элементов, только с атрибутами корня
+        self.packet = None
+
+    def __iter__(self):
+        cls, item_tag = self.packet_class, self.item_tag
+        convert = self.item_class.decode if self.compact else self.item_class.from_element
+        root = None
+        for event, elem in et.iterparse(self.source, events=('start', 'end'),
+                                        tag=(cls.ROOT_NAME, item_tag)):
+            if root is None:
+                # Первым всегда приходит начало корня
+                if event != 'start' or elem.tag != cls.ROOT_NAME:
+                    raise ValueError("root tag is not %s" % cls.ROOT_NAME)
+                root = elem
+                header = et.Element(elem.tag, elem.attrib)
+                self.packet = cls.decode(header) if self.compact else cls.from_element(header)
+            elif event == 'end' and elem.tag == item_tag and elem.getparent() is root:
+                # Предыдущие элементы уже отданы: вырезаем их из дерева, дальше они
+                # живут только в результатах. Текущий трогать нельзя, парсер еще на нем.
+                while elem.getprevious() is not None:
+                    del root[0]
+                yield convert(elem)
 
 
 class Error(MyXmlObject):
@@ -635,6 +1101,7 @@ class TakeProfit(StopOrder):
     quantity = IntegerField('takeprofit/quantity')
 
 
+@register
 class ClientOrderPacket(Packet):
     """
     Пакет текущих заявок клиента.
@@ -642,10 +1109,9 @@ class ClientOrderPacket(Packet):
     ROOT_NAME = 'orders'
 
     @classmethod
-    def parse(cls, xml):
+    def from_element(cls, root):
         result = ClientOrderPacket()
         result.items = []
-        root = parseString(xml)
         assert root.tag == ClientOrderPacket.ROOT_NAME
         for child in root:
             if child.tag == Order.ROOT_NAME:
@@ -658,6 +1124,21 @@ class ClientOrderPacket(Packet):
                         result.items.append(TakeProfit(child))
         return result
 
+    @classmethod
+    def decode(cls, root):
+        assert root.tag == ClientOrderPacket.ROOT_NAME
+        items = []
+        for child in root:
+            if child.tag == Order.ROOT_NAME:
+                items.append(Order.decode(child))
+            elif child.tag == StopOrder.ROOT_NAME:
+                for subchild in child:
+                    if subchild.tag == 'stoploss':
+                        items.append(StopLoss.decode(child))
+                    elif subchild.tag == 'takeprofit':
+                        items.append(TakeProfit.decode(child))
+        return cls.record_class()(items)
+
 
 class ClientTrade(Entity):
     """
@@ -779,6 +1260,7 @@ class FortCollaterals(ClientPositionForts):
     pass
 
 
+@register
 class PositionPacket(Packet):
     """
     Пакет со списком позиций по инструментам.
@@ -786,10 +1268,9 @@ class PositionPacket(Packet):
     ROOT_NAME = 'positions'
 
     @classmethod
-    def parse(cls, xml):
+    def from_element(cls, root):
         result = PositionPacket()
         result.items = []
-        root = parseString(xml)
         assert root.tag == PositionPacket.ROOT_NAME
         for child in root:
             if child.tag == 'money_position':
@@ -798,6 +1279,17 @@ class PositionPacket(Packet):
                 result.items.append(SecurityPosition(child))
         return result
 
+    @classmethod
+    def decode(cls, root):
+        assert root.tag == PositionPacket.ROOT_NAME
+        items = []
+        for child in root:
+            if child.tag == 'money_position':
+                items.append(MoneyPosition.decode(child))
+            elif child.tag == 'sec_position':
+                items.append(SecurityPosition.decode(child))
+        return cls.record_class()(items)
+
 
 class ClientLimitsForts(Entity):
     """
@@ -1309,3 +1801,9 @@ class UnitedPortfolio(MyXmlObject):
         securities = NodeListField('security', _Security)
 
     assets = NodeListField('asset', _Asset)
+
+
+# Декодеры известных структур генерируем сразу при импорте
+for _cls in _registry.values():
+    decoders.decoder(_cls)
+del _cls
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Подписки на потоки сделок, котировок и стаканов со счетчиком ссылок.
+
+SubscriptionManager считает, сколько раз подписан каждый инструмент
+(доска, код, поток), и отправляет на сервер только чистую разницу:
+повторная подписка на уже подписанный инструмент трафика не дает,
+отписка уходит, когда инструмент больше никому не нужен. Изменения
+разных досок и потоков упаковываются в одну команду subscribe/unsubscribe,
+очень большие списки режутся на команды не больше max_size инструментов::
+
+    subs = conn.subscriptions
+    subs.subscribe(TICKS, "TQBR", ["SBER", "GAZP"])
+    with subs.batch():
+        # Ребалансировка: уйдет только разница между старым и новым списком
+        subs.unsubscribe(QUOTES, "TQBR", old)
+        subs.subscribe(QUOTES, "TQBR", new)
+
+Пока соединения нет, подписки только запоминаются. После (пере)подключения
+текущий набор отправляется заново.
+"""
+import logging, threading
+from contextlib import contextmanager
+
+log = logging.getLogger("transaq.connector")
+
+TICKS = 'alltrades'
+QUOTATIONS = 'quotations'
+QUOTES = 'quotes'
+STREAMS = (TICKS, QUOTATIONS, QUOTES)
+
+
+class SubscriptionManager(object):
+    """
+    Подписки сессии коннектора со счетчиком ссылок.
+
+    :param connector:
+        Connector, через который отправляются команды.
+    :param max_size:
+        Максимальное число инструментов в одной команде.
+    """
+
+    def __init__(self, connector, max_size=1000):
+        self.connector = connector
+        self.max_size = max_size
+        # Счетчики ссылок (поток, доска, код) -> сколько раз подписан
+        self._refs = {}
+        # Что сейчас подписано на сервере
+        self._active = set()
+        self._batch = 0
+        self._replay = None
+        # Номер соединения: после переподключения ответы старых команд не учитываются
+        self._generation = 0
+        # _lock защищает состояние и не держится во время отправки команд
+        # (on_status берет его в потоке коллбэка), _send_lock не дает
+        # двум синхронизациям отправить одну и ту же разницу
+        self._lock = threading.RLock()
+        self._send_lock = threading.Lock()
+
+    def subscribe(self, stream, board, tickers):
+        """
+        Подписаться на поток по инструментам доски.
+
+        :param stream:
+            TICKS, QUOTATIONS или QUOTES.
+        :return:
+            Результаты отправленных команд (пусто, если отправлять нечего).
+        """
+        self._check(stream)
+        with self._lock:
+            for seccode in tickers:
+                key = (stream, board, seccode)
+                self._refs[key] = self._refs.get(key, 0) + 1
+        return self._changed()
+
+    def unsubscribe(self, stream, board, tickers):
+        """
+        Снять подписку. Отписка уходит на сервер, когда счетчик инструмента
+        доходит до нуля. Лишние отписки игнорируются.
+
+        :return:
+            Результаты отправленных команд.
+        """
+        self._check(stream)
+        with self._lock:
+            for seccode in tickers:
+                key = (stream, board, seccode)
+                count = self._refs.get(key, 0)
+                if count > 1:
+                    self._refs[key] = count - 1
+                elif count:
+                    del self._refs[key]
+                else:
+                    log.warn(u"Отписка от неподписанного %s %s:%s", stream, board, seccode)
+        return self._changed()
+
+    @contextmanager
+    def batch(self):
+        """
+        Контекст, внутри которого изменения только копятся,
+        а на выходе отправляется их чистая разница.
+        """
+        with self._lock:
+            self._batch += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch -= 1
+            self._changed()
+
+    def refcount(self, stream, board, seccode):
+        """
+        Сколько раз подписан инструмент.
+        """
+        return self._refs.get((stream, board, seccode), 0)
+
+    def wanted(self):
+        """
+        Нужные подписки.
+
+        :return:
+            Множество (поток, доска, код).
+        """
+        with self._lock:
+            return set(self._refs)
+
+    def active(self):
+        """
+        Подписки, которые сейчас отправлены на сервер.
+
+        :return:
+            Множество (поток, доска, код).
+        """
+        with self._lock:
+            return set(self._active)
+
+    def sync(self):
+        """
+        Отправить разницу между нужными и активными подписками:
+        сначала отписки, потом подписки. Разница считается под блокировкой,
+        команды отправляются без нее.
+
+        :return:
+            Результаты отправленных команд.
+        """
+        with self._send_lock:
+            with self._lock:
+                generation = self._generation
+                removed = sorted(self._active - set(self._refs))
+                added = sorted(set(self._refs) - self._active)
+            results = []
+            for cmd, keys in (("unsubscribe", removed), ("subscribe", added)):
+                for i in range(0, len(keys), self.max_size):
+                    chunk = keys[i:i + self.max_size]
+                    result = self.connector.send_subscriptions(cmd, _streams(chunk))
+                    results.append(result)
+                    if result is not None and result.success is False:
+                        log.error(u"Команда %s не прошла: %s", cmd, result.text)
+                        continue
+                    with self._lock:
+                        # Соединение сменилось: набор заново отправит переподписка
+                        if generation != self._generation:
+                            return results
+                        if cmd == "subscribe":
+                            self._active.update(chunk)
+                        else:
+                            self._active.difference_update(chunk)
+            return results
+
+    def on_status(self, connected):
+        """
+        Смена состояния соединения (вызывается коннектором).
+        После подключения текущий набор отправляется из отдельного потока,
+        чтобы не слать команды из коллбэка библиотеки.
+        """
+        with self._lock:
+            self._generation += 1
+            self._active.clear()
+            if connected and self._refs:
+                self._replay = threading.Thread(target=self._resubscribe,
+                                                name="transaq-resubscribe")
+                self._replay.daemon = True
+                self._replay.start()
+
+    def join(self, timeout=None):
+        """
+        Дождаться переотправки подписок после подключения.
+
+        :return:
+            True если переотправка закончена (или ее не было).
+        """
+        replay = self._replay
+        if replay is not None:
+            replay.join(timeout)
+            return not replay.is_alive()
+        return True
+
+    def _resubscribe(self):
+        try:
+            self.sync()
+        except Exception:
+            log.exception(u"Не удалось восстановить подписки")
+
+    def _changed(self):
+        # Отправить разницу, если не внутри batch() и есть соединение.
+        # Вызывается без блокировки
+        if self._batch or not self.connector.connected:
+            return []
+        return self.sync()
+
+    @staticmethod
+    def _check(stream):
+        if stream not in STREAMS:
+            raise ValueError("unknown stream %r" % stream)
+
+
+def _streams(keys):
+    # Отсортированные ключи -> словарь поток -> [(доска, код)]
+    streams = {}
+    for stream, board, seccode in keys:
+        streams.setdefault(stream, []).append((board, seccode))
+    return streams
@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+"""
+Несколько сессий коннектора на подставных библиотеках, симулятор коннектора.
+"""
+
+import shutil, tempfile, threading, time
+from datetime import datetime, timedelta
+import unittest as ut
+import lxml.etree as et
+from structures import *
+import commands
+from commands import Connector, TransaqException, _reply
+from transport import *
+from subscriptions import *
+from scheduler import *
+from baskets import BasketResult
+from secmaster import *
+from history import CandleArrays
+
+
+class FakeLibrary(MemoryTransport):
+    """
+    Подставная библиотека, запоминающая команды.
+    """
+
+    def __init__(self, reply='<result success="true"/>'):
+        super(FakeLibrary, self).__init__()
+        self.reply = reply
+        self.commands = []
+        self.init_error = None
+
+    def Initialize(self, logdir, loglevel):
+        return self.message(self.init_error) if self.init_error else None
+
+    def SendCommand(self, cmd):
+        self.commands.append(et.fromstring(cmd))
+        return self.message(self.reply)
+
+
+class ConnectorTestCase(ut.TestCase):
+    """
+    Сессии на подставных библиотеках с общим временным каталогом логов.
+    Сессии деинициализируются, а каталог удаляется после теста.
+    """
+
+    def setUp(self):
+        self.logdir = tempfile.mkdtemp()
+        self.sessions = []
+
+    def tearDown(self):
+        for conn in self.sessions:
+            conn.uninitialize()
+        shutil.rmtree(self.logdir, ignore_errors=True)
+
+    def session(self, lib, handler=None, **kwargs):
+        # Инициализированная сессия, которую закроет tearDown
+        conn = Connector(library=lib)
+        conn.initialize(self.logdir, 2, handler, **kwargs)
+        self.sessions.append(conn)
+        return conn
+
+
+class TestConnector(ConnectorTestCase):
+    def setUp(self):
+        super(TestConnector, self).setUp()
+        self.libs = [FakeLibrary(), FakeLibrary('<result success="true" transactionid="7"/>')]
+        self.got = [[], []]
+        self.conns = [self.session(lib, got.append) for lib, got in zip(self.libs, self.got)]
+
+    def test_sessions(self):
+        self.assertTrue(self.libs[0].push(open('tests/quotes.xml').read()))
+        self.libs[1].push(open('tests/orders.xml').read())
+        self.libs[1].push('<server_status connected="true"/>')
+        self.assertIsInstance(self.got[0][0], QuotePacket)
+        self.assertEqual([type(obj) for obj in self.got[1]], [ClientOrderPacket, ServerStatus])
+        self.assertFalse(self.conns[0].connected)
+        self.assertTrue(self.conns[1].connected)
+        # Вся отданная память освобождена
+        self.assertEqual(self.libs[0].buffers, {})
+        self.assertEqual(self.libs[1].buffers, {})
+
+    def test_commands(self):
+        self.conns[0].subscribe_bidasks("TQBR", ["SBER", "GAZP"])
+        result = self.conns[1].new_order("TQBR", "SBER", "c1", "b", 10)
+        self.assertEqual(result.id, 7)
+        self.assertEqual(len(self.libs[0].commands), 1)
+        cmd = self.libs[1].commands[0]
+        self.assertEqual((cmd.get('id'), cmd.findtext('buysell'), cmd.findtext('security/seccode')),
+                         ('neworder', 'B', 'SBER'))
+
+    def test_errors(self):
+        lib = FakeLibrary('<error>Нет связи</error>')
+        conn = self.session(lib)
+        self.assertRaises(TransaqException, conn.server_status)
+        lib.init_error = '<error>Уже</error>'
+        self.assertRaises(TransaqException, conn.initialize, self.logdir, 2, None)
+        self.assertEqual(lib.buffers, {})
+        # Память освобождается и когда ответ не разобрался
+        lib.reply = '<result success='
+        self.assertRaises(et.XMLSyntaxError, conn.server_status)
+        self.assertEqual(lib.buffers, {})
+
+    def test_default(self):
+        # Сессия по умолчанию создается один раз и при обращении из многих потоков
+        got = []
+        threads = [threading.Thread(target=lambda: got.append(commands.default_connector()))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, got))), 1)
+        self.assertIs(got[0], commands.default_connector())
+
+    def test_replies(self):
+        for xml in ['<result success="true"/>', '<result success="false" transactionid="12345"/>',
+                    '<result success="true" transactionid="7" />\r\n',
+                    '<result transactionid="7" success="true"/>', '<result/>',
+                    '<result success="false"><message>Нет денег</message></result>',
+                    '<result success="false"><message>a &amp; b</message></result>',
+                    '<result success="true"><message></message></result>',
+                    '<result success="true"><message/></result>',
+                    "<?xml version='1.0' encoding='utf-8'?>\n<result success=\"true\"/>"]:
+            err, result = _reply(xml)
+            self.assertIsNone(err)
+            self.assertEqual(result, CmdResult.decode(et.fromstring(xml)), xml)
+            self.assertEqual(result.to_tuple(), CmdResult.parse(xml).to_tuple(), xml)
+        for xml in ['<error>Нет связи</error>', '<error>a &lt; b</error>', '<error>x</error>\n']:
+            self.assertEqual(_reply(xml), (Error.parse(xml).text, None))
+        for xml in ['<error/>', '<error></error>']:
+            self.assertEqual(_reply(xml), (None, CmdResult.record_class()()))
+
+
+class TestSubscriptions(ConnectorTestCase):
+    def setUp(self):
+        super(TestSubscriptions, self).setUp()
+        self.lib = FakeLibrary()
+        self.conn = self.session(self.lib)
+        self.subs = self.conn.subscriptions
+        self.lib.push('<server_status connected="true"/>')
+
+    def sent(self):
+        # Отправленные команды: (id, [(поток, доска, код)])
+        result = [(cmd.get('id'), [(section.tag, sec.findtext('board'), sec.findtext('seccode'))
+                                   for section in cmd for sec in section])
+                  for cmd in self.lib.commands]
+        del self.lib.commands[:]
+        return result
+
+    def test_refcount(self):
+        self.subs.subscribe(TICKS, "TQBR", ["SBER", "GAZP"])
+        self.subs.subscribe(TICKS, "TQBR", ["SBER", "LKOH"])
+        self.assertEqual(self.sent(), [('subscribe', [(TICKS, "TQBR", "GAZP"), (TICKS, "TQBR", "SBER")]),
+                                       ('subscribe', [(TICKS, "TQBR", "LKOH")])])
+        self.assertEqual(self.subs.refcount(TICKS, "TQBR", "SBER"), 2)
+        self.assertEqual(self.subs.unsubscribe(TICKS, "TQBR", ["SBER"]), [])
+        self.subs.unsubscribe(TICKS, "TQBR", ["SBER", "GAZP", "MTSS"])
+        self.assertEqual(self.sent(), [('unsubscribe', [(TICKS, "TQBR", "GAZP"), (TICKS, "TQBR", "SBER")])])
+        self.assertEqual(self.subs.active(), set([(TICKS, "TQBR", "LKOH")]))
+        self.assertRaises(ValueError, self.subs.subscribe, "trades", "TQBR", ["SBER"])
+
+    def test_batch(self):
+        old = ["S%d" % i for i in range(1000)]
+        self.subs.subscribe(QUOTES, "TQBR", old)
+        self.sent()
+        with self.subs.batch():
+            self.subs.unsubscribe(QUOTES, "TQBR", old)
+            self.subs.subscribe(QUOTES, "TQBR", old[2:] + ["NEW"])
+            self.subs.subscribe(QUOTATIONS, "FUT", ["RIH5"])
+            self.subs.subscribe(TICKS, "EQOB", ["SU26"])
+            self.assertEqual(self.lib.commands, [])
+        # Одна отписка и одна подписка сразу по нескольким доскам и потокам
+        self.assertEqual(self.sent(), [
+            ('unsubscribe', [(QUOTES, "TQBR", "S0"), (QUOTES, "TQBR", "S1")]),
+            ('subscribe', [(TICKS, "EQOB", "SU26"), (QUOTATIONS, "FUT", "RIH5"), (QUOTES, "TQBR", "NEW")])])
+
+    def test_split(self):
+        self.subs.max_size = 300
+        results = self.subs.subscribe(TICKS, "TQBR", ["S%04d" % i for i in range(1000)])
+        self.assertEqual(len(results), 4)
+        self.assertEqual([len(keys) for _, keys in self.sent()], [300, 300, 300, 100])
+        self.assertEqual(len(self.subs.active()), 1000)
+
+    def test_reconnect(self):
+        self.lib.push('<server_status connected="false"/>')
+        self.subs.subscribe(TICKS, "TQBR", ["SBER"])
+        self.subs.subscribe(QUOTES, "TQBR", ["SBER"])
+        # Без соединения только запоминаем
+        self.assertEqual(self.sent(), [])
+        self.assertEqual(self.subs.active(), set())
+        self.lib.push('<server_status connected="true"/>')
+        self.assertTrue(self.subs.join(5))
+        self.assertEqual(self.sent(), [('subscribe', [(TICKS, "TQBR", "SBER"), (QUOTES, "TQBR", "SBER")])])
+        self.assertEqual(self.subs.active(), self.subs.wanted())
+        self.conn.disconnect()
+        self.assertEqual(self.subs.active(), set())
+
+    def test_status_while_sending(self):
+        # Смена статуса в потоке коллбэка не ждет отправки подписки
+        send = self.lib.SendCommand
+        statuses = []
+
+        def slow(cmd):
+            thread = threading.Thread(target=self.lib.push, args=('<server_status connected="false"/>',))
+            thread.start()
+            thread.join(5)
+            statuses.append(thread.is_alive())
+            return send(cmd)
+        self.lib.SendCommand = slow
+        self.subs.subscribe(TICKS, "TQBR", ["SBER"])
+        self.assertEqual(statuses, [False])
+        # Ответ пришел уже после разрыва и в активные не попал
+        self.assertEqual(self.subs.active(), set())
+        self.assertEqual(self.subs.wanted(), set([(TICKS, "TQBR", "SBER")]))
+
+    def test_failed(self):
+        self.lib.reply = '<result success="false"><message>Нельзя</message></result>'
+        self.subs.subscribe(TICKS, "TQBR", ["SBER"])
+        self.assertEqual(self.subs.active(), set())
+        # Следующая синхронизация повторит подписку
+        self.lib.reply = '<result success="true"/>'
+        self.subs.sync()
+        self.assertEqual(self.subs.active(), set([(TICKS, "TQBR", "SBER")]))
+
+
+class TestScheduler(ConnectorTestCase):
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.lib = FakeLibrary()
+        self.scheduler = CommandScheduler(rqdelay=1000, burst=1)
+        self.conn = self.session(self.lib, scheduler=self.scheduler)
+
+    def start(self, func, *args):
+        thread = threading.Thread(target=func, args=args)
+        thread.start()
+        return thread
+
+    def until(self, lane, depth):
+        while self.scheduler.lanes[lane].depth < depth:
+            time.sleep(0.001)
+
+    def test_priority(self):
+        self.scheduler.set_delay(200)
+        self.conn.server_status()
+        # Токен потрачен: запросы встают в очередь, снятие заявки их обгоняет
+        threads = [self.start(self.conn.get_history, "TQBR", "SBER", 1, 10) for i in range(3)]
+        self.until(QUERY, 3)
+        threads.append(self.start(self.conn.new_order, "TQBR", "SBER", "c1", "b", 1))
+        self.until(ORDER, 1)
+        threads.append(self.start(self.conn.cancel_order, 4581))
+        self.until(CANCEL, 1)
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual([cmd.get('id') for cmd in self.lib.commands],
+                         ['server_status', 'cancelorder', 'neworder', 'gethistorydata',
+                          'gethistorydata', 'gethistorydata'])
+        stats = self.scheduler.snapshot()
+        self.assertEqual(stats['query']['max_depth'], 3)
+        self.assertEqual(stats['query']['sent'], 4)
+        self.assertEqual(stats['cancel']['depth'], 0)
+        self.assertGreater(stats['cancel']['wait']['max'], 100000)
+        self.assertLess(stats['cancel']['wait']['max'], stats['query']['wait']['max'])
+
+    def test_pacing(self):
+        self.scheduler = self.conn.scheduler = CommandScheduler(rqdelay=20, burst=3)
+        start = time.time()
+        for i in range(3 + 10):
+            self.conn.server_status()
+        # 3 команды из запаса, остальные по одной в rqdelay
+        self.assertGreater(time.time() - start, 0.18)
+        self.assertEqual(self.scheduler.lanes[QUERY].sent, 13)
+        self.conn.connect("login", "password", "localhost:3900", min_delay=10)
+        self.assertEqual(self.scheduler.rqdelay, 10)
+        self.assertEqual(self.scheduler.lane('moveorder'), CANCEL)
+
+    def test_unthrottled(self):
+        self.scheduler.set_delay(0)
+        start = time.time()
+        for i in range(50):
+            self.conn.server_status()
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(self.scheduler.lanes[QUERY].sent, 50)
+        self.assertIsNone(CommandScheduler(rqdelay=0).rate)
+        self.assertRaises(ValueError, self.scheduler.set_delay, -1)
+        self.assertRaises(ValueError, CommandScheduler, -100)
+
+
+class BasketLibrary(FakeLibrary):
+    """
+    Библиотека с задержкой ответа и номерами транзакций по порядку.
+    """
+
+    def __init__(self, delay):
+        super(BasketLibrary, self).__init__()
+        self.delay = delay
+        self.next_id = 100
+        self.lock = threading.Lock()
+
+    def SendCommand(self, cmd):
+        command = et.fromstring(cmd)
+        time.sleep(self.delay)
+        with self.lock:
+            self.commands.append(command)
+            self.next_id += 1
+            id = self.next_id
+        client = command.findtext('client')
+        if client == 'bad':
+            return self.message('<error>Неверный клиент</error>')
+        if client == 'poor':
+            return self.message('<result success="false"><message>Нет денег</message></result>')
+        if command.get('id') == 'neworder' and command.findtext('security/seccode') != 'NOID':
+            return self.message('<result success="true" transactionid="%d"/>' % id)
+        return self.message('<result success="true"/>')
+
+
+class TestBaskets(ConnectorTestCase):
+    def setUp(self):
+        super(TestBaskets, self).setUp()
+        self.lib = BasketLibrary(0.05)
+        self.conn = self.session(self.lib)
+
+    def test_submit(self):
+        orders = [dict(board="TQBR", ticker="S%d" % i, client="c1", buysell="B", quantity=i + 1)
+                  for i in range(20)]
+        orders[3]['client'] = 'bad'
+        orders[5]['client'] = 'poor'
+        orders[7]['ticker'] = 'S\x00'
+        orders[9] = ("TQBR", "GAZP", "c1", "S", 5, 150.5, False)
+        # Ответы без transactionid не перетирают друг друга
+        orders[11]['ticker'] = orders[12]['ticker'] = 'NOID'
+        start = time.time()
+        result = self.conn.submit_basket(orders, workers=10)
+        # Отправка параллельная: 19 команд по 50мс быстрее, чем подряд
+        self.assertLess(time.time() - start, 0.5)
+        self.assertIsInstance(result, BasketResult)
+        self.assertEqual(len(result), 20)
+        self.assertEqual(len(self.lib.commands), 19)
+        self.assertFalse(result.ok)
+        self.assertEqual([i for i, _ in result.failed], [3, 5, 7])
+        self.assertIsInstance(result.failed[0][1], TransaqException)
+        self.assertEqual(result.failed[1][1].text, u'Нет денег')
+        self.assertIsInstance(result.failed[2][1], ValueError)
+        self.assertEqual(len(result.results), 17)
+        self.assertEqual(result.results.keys(), [i for i in range(20) if i not in (3, 5, 7)])
+        self.assertIsNone(result.results[11].id)
+        self.assertIsNone(result.results[12].id)
+        self.assertEqual(len(set(res.id for res in result.results.values())), 16)
+        by_id = result.by_transaction
+        self.assertEqual(len(by_id), 15)
+        for id, res in by_id.items():
+            self.assertEqual(res.id, id)
+        self.assertEqual(by_id.values()[0], result.results[0])
+        self.assertEqual(self.lib.buffers, {})
+
+    def test_cancel(self):
+        result = self.conn.cancel_basket(iter([4581, 4582]))
+        self.assertTrue(result.ok)
+        self.assertEqual(result.results.keys(), [4581, 4582])
+        self.assertEqual(sorted(cmd.findtext('transactionid') for cmd in self.lib.commands),
+                         ['4581', '4582'])
+        self.conn.cancel_basket([4583], stop=True)
+        self.assertEqual(self.lib.commands[-1].get('id'), 'cancelstoporder')
+        self.assertTrue(self.conn.submit_basket([]).ok)
+
+
+class TestSecurityMaster(ConnectorTestCase):
+    def setUp(self):
+        super(TestSecurityMaster, self).setUp()
+        self.lib = FakeLibrary()
+        self.master = SecurityMaster()
+        self.conn = self.session(self.lib, compact=True, master=self.master)
+        self.lib.push(open('tests/securities.xml').read())
+        # Фьючерс без заявок по рынку и кредита
+        self.lib.push('<securities><security secid="9" active="true"><seccode>RIH5</seccode>'
+                      '<board>FUT</board><decimals>0</decimals><minstep>10</minstep><lotsize>1</lotsize>'
+                      '<opmask usecredit="no" bymarket="no"/></security>'
+                      '<security secid="10" active="false"><seccode>OLD</seccode><board>TQBR</board>'
+                      '</security></securities>')
+
+    def sent(self):
+        cmd = self.lib.commands.pop()
+        return cmd.findtext('quantity') or cmd.findtext('*/quantity'), \
+            cmd.findtext('price') or cmd.findtext('*/orderprice'), cmd.findtext('*/activationprice')
+
+    def test_index(self):
+        self.assertEqual(len(self.master), 5)
+        self.assertEqual(self.master.get("TQBR", "VTBR").minstep, 0.0001)
+        self.assertIsNone(self.master.get("TQBR", "SBER"))
+        self.assertEqual(self.master.lots("TQBR", "VTBR", 1500), 15)
+        self.assertRaises(ValidationError, self.master.lots, "TQBR", "VTBR", 150)
+        self.assertRaises(ValidationError, self.master.lots, "TQBR", "VTBR", 50)
+
+    def test_validate(self):
+        self.conn.new_order("TQBR", "GAZP", "c1", "B", 10, 150.57, bymarket=False)
+        self.assertEqual(self.sent(), ('10', '150.57', None))
+        self.conn.new_order("TQBR", "VTBR", "c1", "S", 1, 0.0123, bymarket=False)
+        self.assertEqual(self.sent(), ('1', '0.0123', None))
+        # Неизвестные инструменты уходят как есть
+        self.conn.new_order("TQBR", "SBER", "c1", "B", 1, 250.123, bymarket=False)
+        self.assertEqual(self.sent(), ('1', '250.123', None))
+        for args, kwargs in [(("TQBR", "GAZP", "c1", "B", 10, 150.575), dict(bymarket=False)),
+                             (("TQBR", "GAZP", "c1", "B", 1.5), {}),
+                             (("TQBR", "GAZP", "c1", "B", 0), {}),
+                             (("FUT", "RIH5", "c1", "B", 1), dict(usecredit=False)),
+                             (("FUT", "RIH5", "c1", "B", 1, 150000), dict(bymarket=False)),
+                             (("TQBR", "OLD", "c1", "B", 1), {})]:
+            self.assertRaises(ValidationError, self.conn.new_order, *args, **kwargs)
+        self.assertRaises(ValidationError, self.conn.new_stoploss, "TQBR", "GAZP", "c1", "S", 1, 140.001)
+        self.assertRaises(ValidationError, self.conn.new_takeprofit, "FUT", "RIH5", "c1", "S", 1, 150000,
+                          use_credit=False)
+        self.assertEqual(self.lib.commands, [])
+        self.master.strict = True
+        self.assertRaises(ValidationError, self.conn.new_order, "TQBR", "SBER", "c1", "B", 1)
+
+    def test_snap(self):
+        self.master.snap = True
+        self.conn.new_order("TQBR", "GAZP", "c1", "B", 10.7, 150.578, bymarket=False)
+        self.assertEqual(self.sent(), ('10', '150.57', None))
+        self.conn.new_order("TQBR", "GAZP", "c1", "S", 10, 150.571, bymarket=False)
+        self.assertEqual(self.sent(), ('10', '150.58', None))
+        self.conn.new_stoploss("FUT", "RIH5", "c1", "S", 2, 149996, 149993, bymarket=False, usecredit=False)
+        self.assertEqual(self.sent(), ('2', '150000.0', '150000.0'))
+        self.conn.new_takeprofit("TQBR", "VTBR", "c1", "S", 3, 0.01234)
+        self.assertEqual(self.sent(), ('3', None, '0.0123'))
+        result = self.conn.submit_basket([("TQBR", "GAZP", "c1", "B", 1, 100.001, False),
+                                          ("FUT", "RIH5", "c1", "B", 1)])
+        self.assertEqual([i for i, e in result.failed], [1])
+        self.assertEqual(self.sent(), ('1', '100.0', None))
+
+
+class HistoryLibrary(FakeLibrary):
+    """
+    Библиотека с минутными свечами: страницы перекрываются на одну свечу
+    и приходят двумя пакетами.
+    """
+    start = datetime(2015, 8, 11, 10, 0)
+
+    def __init__(self, size):
+        super(HistoryLibrary, self).__init__()
+        self.size = size
+        self.cursors = {}
+        self.late = set(['LATE'])
+
+    def SendCommand(self, cmd):
+        command = et.fromstring(cmd)
+        self.commands.append(command)
+        board, seccode = command.findtext('security/board'), command.findtext('security/seccode')
+        if seccode == 'FAIL':
+            return self.message('<error>Нет такого инструмента</error>')
+        if command.findtext('reset') == 'true':
+            self.cursors[seccode] = self.size
+        if seccode in self.late:
+            self.late.discard(seccode)
+            packets = [self.packet(board, seccode, 3, [])]
+        else:
+            cursor = self.cursors[seccode]
+            start = max(0, cursor - int(command.findtext('count')))
+            page = range(start, min(self.size, cursor + 1))
+            self.cursors[seccode] = start
+            half = len(page) // 2
+            packets = [self.packet(board, seccode, 2, page[:half]),
+                       self.packet(board, seccode, 0 if start == 0 else 1, page[half:])]
+        threading.Thread(target=lambda: [self.push(xml) for xml in packets]).start()
+        return self.message('<result success="true"/>')
+
+    def packet(self, board, seccode, status, page):
+        candles = ''.join('<candle date="%s" open="%d" high="%d" low="%d" close="%d" volume="%d"/>'
+                          % ((self.start + timedelta(minutes=i)).strftime(timeformat),
+                             i, i + 2, i - 1, i + 1, 10 * i) for i in page)
+        return ('<candles secid="1" board="%s" seccode="%s" period="1" status="%d">%s</candles>'
+                % (board, seccode, status, candles))
+
+
+class TestHistory(ConnectorTestCase):
+    def setUp(self):
+        super(TestHistory, self).setUp()
+        self.lib = HistoryLibrary(1000)
+        self.got = []
+        self.conn = self.session(self.lib, self.got.append)
+        self.conn.history.page = 100
+        self.conn.history.retry_delay = 0.01
+        self.conn.history.timeout = 5
+
+    def check(self, series, first, last):
+        self.assertIsInstance(series, CandleArrays)
+        self.assertIsNone(series.error)
+        self.assertEqual(len(series), last - first + 1)
+        self.assertEqual(list(series.open), range(first, last + 1))
+        self.assertEqual(list(series.volume), [10.0 * i for i in range(first, last + 1)])
+        self.assertEqual(set(b - a for a, b in zip(series.date, series.date[1:])), set([60]))
+
+    def test_count(self):
+        result = self.conn.load_history(["SBER", "GAZP", "LATE", "FAIL"], 1, count=250, board="TQBR")
+        self.assertEqual(result.keys(), ["SBER", "GAZP", "LATE", "FAIL"])
+        for seccode in ("SBER", "GAZP", "LATE"):
+            self.check(result[seccode], 750, 999)
+        self.assertIsNotNone(result["FAIL"].error)
+        self.assertEqual(len(result["FAIL"]), 0)
+        # Три страницы по 100, у LATE еще повтор после статуса 3
+        ids = [(c.findtext('security/seccode'), c.findtext('reset')) for c in self.lib.commands]
+        self.assertEqual([r for code, r in ids if code == "SBER"], ['true', 'false', 'false'])
+        self.assertEqual([r for code, r in ids if code == "LATE"], ['true', 'true', 'false', 'false'])
+        # Хэндлер получает свечи как обычно
+        self.assertTrue(self.got)
+        self.assertEqual(self.conn.history._jobs, {})
+
+    def test_since(self):
+        since = HistoryLibrary.start + timedelta(minutes=400)
+        result = self.conn.load_history([("TQBR", "SBER")], "1", since=since)
+        self.check(result[("TQBR", "SBER")], 400, 999)
+        # Истории меньше, чем просили: остановка по статусу 0
+        self.check(self.conn.load_history(["GAZP"], 1, count=5000, board="TQBR")["GAZP"], 0, 999)
+
+    def test_board(self):
+        master = SecurityMaster()
+        master.on_message(parse(open('tests/securities.xml').read(), compact=True))
+        self.conn.security_master = master
+        result = self.conn.load_history(None, 1, count=10, board="TQBR")
+        self.assertEqual(result.keys(), ["GAZP", "GMKN", "VTBR"])
+        self.assertRaises(ValueError, self.conn.load_history, None, 1, count=10)
+        self.assertRaises(ValueError, self.conn.load_history, ["SBER"], 1, board="TQBR")
+
+
+class TestSimulator(ConnectorTestCase):
+    def test_replay(self):
+        got = []
+        messages = fixtures('tests', 'quotes.xml', 'alltrades.xml', 'orders.xml')
+        sim = SimulatedTransport(messages, rate=2000, repeat=5,
+                                 replies={'get_connector_version':
+                                          '<connector_version>6.5</connector_version>'})
+        conn = Connector(library=sim)
+        conn.initialize(self.logdir, 2, got.append, compact=True)
+        self.assertEqual(conn.get_version(), '6.5')
+        conn.connect("login", "password", "localhost:3900")
+        self.assertTrue(sim.join(10))
+        self.assertEqual(sim.sent, 15)
+        self.assertEqual([r.ROOT_NAME for r in got[:4]], ['server_status', 'quotes', 'alltrades', 'orders'])
+        self.assertEqual(len(got), 16)
+        self.assertTrue(conn.connected)
+        conn.uninitialize()
+        self.assertFalse(conn.connected)
+        self.assertEqual([c.get('id') for c in sim.commands],
+                         ['get_connector_version', 'connect', 'disconnect'])
+        self.assertEqual(sim.buffers, {})
+
+    def test_fixtures(self):
+        messages = fixtures('tests')
+        self.assertGreater(len(messages), len(fixtures('tests', 'quotes.xml', 'orders.xml')))
+        for xml in messages:
+            self.assertIsNotNone(registered_class(root_tag(xml)), xml[:50])
+        self.assertRaises(IOError, fixtures, self.logdir)
+
+
+if __name__ == '__main__':
+    ut.main()
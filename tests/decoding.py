@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Сгенерированные декодеры должны давать то же, что и eulxml.
+"""
+
+import glob, math
+import unittest as ut
+import decoders
+from structures import *
+from datetime import datetime as dt
+
+
+class TestDecoders(ut.TestCase):
+    def assertSame(self, rec, ref):
+        # Сравнение записей, где nan равен nan
+        if isinstance(ref, Record):
+            self.assertIs(type(rec), type(ref))
+            for name in ref.__slots__:
+                self.assertSame(getattr(rec, name), getattr(ref, name))
+        elif isinstance(ref, list):
+            self.assertEqual(len(rec), len(ref))
+            for r, o in zip(rec, ref):
+                self.assertSame(r, o)
+        elif isinstance(ref, float) and math.isnan(ref):
+            self.assertTrue(math.isnan(rec))
+        else:
+            self.assertEqual(rec, ref)
+            self.assertIs(type(rec), type(ref))
+
+    def check(self, xml, cls=None):
+        root = parseString(xml)
+        cls = cls or registered_class(root.tag)
+        self.assertSame(cls.decode(root), cls.from_element(root).to_record())
+
+    def test_fixtures(self):
+        for name in glob.glob('tests/*.xml'):
+            for xml in [open(name).read()] if 'statuses' not in name else open(name).readlines():
+                self.check(xml)
+
+    def test_compiled(self):
+        for cls in (TradePacket, Trade, QuotePacket, Quote, QuotationPacket, Quotation,
+                    Order, ClientTrade, Security, HistoryCandle, CmdResult, Error):
+            self.assertTrue(decoders.compiled(cls), cls.__name__)
+        self.assertFalse(decoders.compiled(MoneyPosition))
+
+    def test_values(self):
+        rec = parse(open('tests/quotations.xml').read(), compact=True)
+        self.assertEqual(len(rec.items), 3)
+        o = rec.items[0]
+        self.assertEqual(o.secid, 1)
+        self.assertEqual(o.best_bid, 171.7)
+        self.assertEqual(o.last_time, dt(2015,8,11,15,43,12))
+        self.assertEqual(rec.items[2].best_bid, None)
+
+    def test_edge_cases(self):
+        self.check('<trade secid=" 7 "><price> 1.5 </price><quantity>1.9</quantity>'
+                   '<tradeno></tradeno><board><![CDATA[TQ]]>BR</board><seccode><x>a</x>b</seccode>'
+                   '<time>08.08.2015 23:06:34</time><period>N</period></trade>', Trade)
+        self.check('<quote secid="x"><price>abc</price><yield>-3</yield><buy>+3</buy><sell>1e3</sell>'
+                   '<source/></quote>', Quote)
+        self.check('<security secid="1" active="false"><opmask/><opmask usecredit="yes" bymarket="no"/>'
+                   '</security>', Security)
+        self.check(u'<error><!-- x -->Ошибка<b/>хвост</error>', Error)
+        self.check('<market id="1"/>', Market)
+        self.check('<order transactionid="1"><withdrawtime>0</withdrawtime><time>10.08.2015 16:11:30</time>'
+                   '<price>1</price><price>2</price></order>', Order)
+
+    def test_bad_boolean(self):
+        root = parseString('<marketord secid="1" permit="maybe"/>')
+        self.assertRaises(Exception, MarketOrderAbility.decode, root)
+
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""
+Доставка сообщений хэндлеру: разбор в пуле процессов, очередь с политиками,
+асинхронный фронтенд, маршрутизация по подпискам, склейка котировок,
+метрики приема.
+"""
+
+import pickle, threading, time
+import unittest as ut
+from structures import *
+from offload import Offloader, ProcessPoolExecutor
+from dispatch import *
+import aio
+from routing import Router
+from conflation import QuotationConflator
+from metrics import *
+
+
+class TestPickling(ut.TestCase):
+    def test_records(self):
+        for name in ['orders', 'positions', 'securities', 'portfolio', 'candles']:
+            rec = parse(open('tests/%s.xml' % name).read(), compact=True)
+            for proto in (0, 2):
+                self.assertEqual(pickle.loads(pickle.dumps(rec, proto)), rec)
+
+    def test_nested(self):
+        self.assertEqual(ClientPortfolio._Money._ValuePart._qualname,
+                         'ClientPortfolio._Money._ValuePart')
+        self.assertEqual(UnitedPortfolio._Asset._Security._qualname,
+                         'UnitedPortfolio._Asset._Security')
+
+
+@ut.skipIf(ProcessPoolExecutor is None, "no concurrent.futures")
+class TestOffloader(ut.TestCase):
+    def setUp(self):
+        self.got = []
+        self.done = threading.Event()
+        self.off = Offloader(min_size=4096, tags=['candles'], workers=1)
+        self.off.start(self.deliver)
+
+    def tearDown(self):
+        self.off.shutdown()
+
+    def deliver(self, obj):
+        self.got.append(obj)
+        if len(self.got) == self.expect:
+            self.done.set()
+
+    def test_wants(self):
+        self.assertTrue(self.off.wants('candles', b'<candles/>'))
+        self.assertTrue(self.off.wants('quotes', b' ' * 4096))
+        self.assertFalse(self.off.wants('quotes', b'<quotes/>'))
+
+    def test_result(self):
+        self.expect = 1
+        xml = open('tests/candles.xml').read()
+        self.off.submit('candles', xml)
+        self.done.wait(10)
+        self.assertEqual(self.got, [parse(xml, compact=True)])
+
+    def test_order(self):
+        # Мелкие заявки не обгоняют большой снапшот заявок из пула
+        self.expect = 3
+        big = open('tests/orders.xml').read()
+        small = ClientOrderPacket.decode(parseString(big))
+        small.items = small.items[:1]
+        quote = parse(open('tests/quotes.xml').read(), compact=True)
+        self.off.submit('orders', big)
+        self.off.deliver('orders', small)
+        self.off.deliver('quotes', quote)
+        self.done.wait(10)
+        self.assertIs(self.got[0], quote)
+        self.assertEqual(self.got[1], parse(big, compact=True))
+        self.assertIs(self.got[2], small)
+
+    def test_single_delivery(self):
+        # Результаты пула приходят из потока доставки и не пересекаются
+        # с доставкой из коллбэка
+        self.expect = 12
+        active = [0, 0]
+        threads = set()
+
+        def deliver(obj):
+            active[0] += 1
+            active[1] = max(active)
+            threads.add(threading.current_thread().name)
+            time.sleep(0.005)
+            active[0] -= 1
+            self.deliver(obj)
+        self.off._deliver = deliver
+        xml = open('tests/candles.xml').read()
+        quote = parse(open('tests/quotes.xml').read(), compact=True)
+        for i in range(6):
+            self.off.submit('candles', xml)
+            self.off.deliver('quotes', quote)
+        self.assertTrue(self.done.wait(10))
+        self.assertEqual(active[1], 1)
+        self.assertEqual(self.off.submitted, 6)
+        self.assertEqual(threads, set([threading.current_thread().name, 'transaq-offload']))
+
+
+class TestDispatchQueue(ut.TestCase):
+    def setUp(self):
+        self.got = []
+        self.gate = threading.Event()
+
+    def process(self, tag, msg, waited):
+        self.gate.wait(10)
+        self.got.append((tag, msg))
+
+    def drain(self, queue):
+        self.gate.set()
+        queue.shutdown()
+
+    def test_policies(self):
+        self.assertRaises(ValueError, DispatchQueue, policies={'orders': CONFLATE})
+        self.assertRaises(ValueError, DispatchQueue, policies={'error': DROP_OLDEST})
+        self.assertRaises(ValueError, DispatchQueue, policies={'quotes': 'whatever'})
+        queue = DispatchQueue(default=DROP_OLDEST)
+        self.assertEqual(queue.policy('quotes'), DROP_OLDEST)
+        self.assertEqual(queue.policy('trades'), BLOCK)
+
+    def test_order(self):
+        queue = DispatchQueue(workers=3)
+        queue.start(self.process)
+        for i in range(20):
+            queue.put('orders', i)
+        self.drain(queue)
+        self.assertEqual([msg for tag, msg in self.got], range(20))
+        self.assertEqual(queue.processed, 20)
+        self.assertEqual(queue.depth, 0)
+
+    def test_drop_oldest(self):
+        queue = DispatchQueue(maxsize=3, policies={'quotes': DROP_OLDEST})
+        for i in range(5):
+            self.assertTrue(queue.put('quotes', i))
+        self.assertEqual(queue.depth, 3)
+        self.assertEqual(queue.dropped, {'quotes': 2})
+        queue.start(self.process)
+        self.drain(queue)
+        self.assertEqual(self.got, [('quotes', 2), ('quotes', 3), ('quotes', 4)])
+
+    def test_conflate(self):
+        queue = DispatchQueue(policies={'portfolio_tplus': CONFLATE})
+        queue.put('portfolio_tplus', 1)
+        queue.put('quotes', 2)
+        queue.put('portfolio_tplus', 3)
+        self.assertEqual(queue.depth, 2)
+        self.assertEqual(queue.conflated, {'portfolio_tplus': 1})
+        queue.start(self.process)
+        self.drain(queue)
+        self.assertEqual(self.got, [('portfolio_tplus', 3), ('quotes', 2)])
+
+    def test_conflate_full(self):
+        # Новое состояние не теряется и в полной очереди
+        conflate = dict((tag, CONFLATE) for tag in ('portfolio_tplus', 'portfolio_mct', 'limits'))
+        queue = DispatchQueue(maxsize=2, policies=dict(conflate, quotes=DROP_OLDEST))
+        # Рабочий поток занят первым сообщением
+        queue.start(self.process)
+        queue.put('quotes', 0)
+        while queue.depth:
+            time.sleep(0.001)
+        queue.put('quotes', 1)
+        queue.put('quotes', 2)
+        # Место освобождается за счет самых старых котировок
+        self.assertTrue(queue.put('portfolio_tplus', 3))
+        self.assertTrue(queue.put('portfolio_tplus', 4))
+        self.assertTrue(queue.put('portfolio_mct', 5))
+        self.assertEqual(queue.dropped, {'quotes': 2})
+        # Выкидывать нечего - коллбэк ждет места
+        thread = threading.Thread(target=queue.put, args=('limits', 6))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.gate.set()
+        thread.join(5)
+        self.drain(queue)
+        self.assertEqual(self.got, [('quotes', 0), ('portfolio_tplus', 4), ('portfolio_mct', 5),
+                                    ('limits', 6)])
+        self.assertEqual(queue.dropped, {'quotes': 2})
+
+    def test_lossless_order(self):
+        # Статусы сервера не обгоняют друг друга и при нескольких потоках
+        active = {'server_status': 0, 'error': 0}
+        overlaps = []
+        got = []
+
+        def process(tag, msg, waited):
+            active[tag] += 1
+            overlaps.append(active[tag] > 1)
+            time.sleep(0.002)
+            got.append(msg)
+            active[tag] -= 1
+        queue = DispatchQueue(workers=4)
+        queue.start(process)
+        for i in range(40):
+            queue.put('server_status', i % 2 == 0)
+            queue.put('error', i)
+        queue.shutdown()
+        self.assertEqual([msg for msg in got if isinstance(msg, bool)], [i % 2 == 0 for i in range(40)])
+        self.assertEqual([msg for msg in got if not isinstance(msg, bool)], range(40))
+        self.assertFalse(any(overlaps))
+
+    def test_conflate_waited(self):
+        # Время в очереди считается от последнего склеенного сообщения
+        waits = []
+        queue = DispatchQueue(policies={'portfolio_tplus': CONFLATE})
+        queue.put('portfolio_tplus', 1, timed=True)
+        time.sleep(0.2)
+        queue.put('portfolio_tplus', 2, timed=True)
+        queue.start(lambda tag, msg, waited: waits.append(waited))
+        queue.shutdown()
+        self.assertEqual(len(waits), 1)
+        self.assertLess(waits[0], 0.1)
+
+    def test_mixed(self):
+        # Занятый упорядоченный тег не задерживает остальные сообщения,
+        # выкидываются только самые старые сообщения с DROP_OLDEST
+        queue = DispatchQueue(maxsize=6, workers=2, policies={'quotes': DROP_OLDEST})
+        queue.put('orders', 0)
+        queue.put('orders', 1)
+        queue.put('alltrades', 2)
+        for i in range(3, 8):
+            queue.put('quotes', i)
+        self.assertEqual(queue.depth, 6)
+        self.assertEqual(queue.dropped, {'quotes': 2})
+        queue.start(self.process)
+        self.drain(queue)
+        self.assertEqual(sorted(msg for tag, msg in self.got), [0, 1, 2, 5, 6, 7])
+        orders = [msg for tag, msg in self.got if tag == 'orders']
+        self.assertEqual(orders, [0, 1])
+        self.assertEqual(queue.depth, 0)
+        self.assertEqual(queue._parked, {})
+
+    def test_compact(self):
+        queue = DispatchQueue(maxsize=10, policies={'quotes': DROP_OLDEST})
+        for i in range(1000):
+            queue.put('quotes', i)
+        self.assertEqual(queue.depth, 10)
+        self.assertLessEqual(len(queue._queue) + len(queue._droppable), 40)
+        queue.start(self.process)
+        self.drain(queue)
+        self.assertEqual([msg for tag, msg in self.got], range(990, 1000))
+
+    def test_block(self):
+        queue = DispatchQueue(maxsize=1)
+        queue.start(self.process)
+        queue.put('quotes', 1)
+        while queue.depth:
+            time.sleep(0.001)
+        queue.put('quotes', 2)
+        putter = threading.Thread(target=queue.put, args=('quotes', 3))
+        putter.start()
+        time.sleep(0.05)
+        # Очередь полна, коллбэк ждет
+        self.assertTrue(putter.is_alive())
+        self.gate.set()
+        putter.join()
+        queue.shutdown()
+        self.assertEqual([msg for tag, msg in self.got], [1, 2, 3])
+        self.assertEqual(queue.max_depth, 1)
+
+    def test_timed(self):
+        waits = []
+        queue = DispatchQueue()
+        queue.put('quotes', 1, timed=True)
+        queue.put('quotes', 2)
+        queue.start(lambda tag, msg, waited: waits.append(waited))
+        queue.shutdown()
+        self.assertGreater(waits[0], 0)
+        self.assertIsNone(waits[1])
+
+
+class FakeConnector(object):
+    # Синхронный коннектор без библиотеки
+    def initialize(self, logdir, loglevel, msg_handler, **kwargs):
+        self.handler = msg_handler
+        self.options = kwargs
+        return True
+
+    def new_order(self, board, ticker, client, buysell, quantity, **kwargs):
+        return (board, ticker, quantity, kwargs)
+
+    def load_history(self, seccodes, period, **kwargs):
+        self.loading.wait(5)
+        return dict((code, period) for code in seccodes)
+
+    def feed(self, objs):
+        # Сообщения приходят из чужого потока, как из библиотеки
+        thread = threading.Thread(target=lambda: [self.handler(obj) for obj in objs])
+        thread.start()
+        thread.join()
+
+
+@ut.skipIf(aio.asyncio is None, "no asyncio")
+class TestAsyncConnector(ut.TestCase):
+    def setUp(self):
+        self.loop = aio.asyncio.new_event_loop()
+        self.fake = FakeConnector()
+        self.fake.loading = threading.Event()
+        self.conn = aio.AsyncConnector(self.fake, loop=self.loop)
+        self.wait(self.conn.initialize("logs", 2, compact=True))
+
+    def tearDown(self):
+        self.fake.loading.set()
+        self.conn.executor.shutdown()
+        self.conn.long_executor.shutdown()
+        self.loop.close()
+
+    def wait(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_command(self):
+        self.assertEqual(self.fake.options, {'compact': True})
+        result = self.wait(self.conn.new_order("TQBR", "SBER", "c1", "B", 10, bymarket=False))
+        self.assertEqual(result, ("TQBR", "SBER", 10, {'bymarket': False}))
+
+    def test_long_command(self):
+        # Загрузка истории не задерживает остальные команды
+        history = self.conn.load_history(["SBER"], 1, count=10)
+        self.wait(self.conn.new_order("TQBR", "SBER", "c1", "B", 10))
+        self.assertFalse(history.done())
+        self.fake.loading.set()
+        self.assertEqual(self.wait(history), {"SBER": 1})
+
+    def test_streams(self):
+        quotes = self.conn.stream(['quotes'])
+        everything = self.conn.stream()
+        quote = parse(open('tests/quotes.xml').read(), compact=True)
+        status = parse(open('tests/server_statuses.xml').readline())
+        self.fake.feed([quote, status, RawMessage('quotes', b'<quotes/>')])
+        self.assertIs(self.wait(quotes.get()), quote)
+        self.assertEqual(self.wait(quotes.get()).tag, 'quotes')
+        self.assertIs(self.wait(everything.get()), quote)
+        self.assertIs(self.wait(everything.get()), status)
+        pending = quotes.get()
+        self.conn.close()
+        self.assertRaises(aio.StopAsyncIteration, self.wait, pending)
+        self.assertEqual(self.conn._streams, {})
+
+    def test_maxsize(self):
+        stream = self.conn.stream(['quotes'], maxsize=1)
+        self.fake.feed([RawMessage('quotes', str(i)) for i in range(3)])
+        # Дать циклу разобрать пришедшие сообщения
+        done = aio.asyncio.Future(loop=self.loop)
+        self.loop.call_soon(done.set_result, None)
+        self.wait(done)
+        self.assertEqual(self.wait(stream.get()).data, '2')
+        self.assertEqual(stream.dropped, 2)
+
+
+class TestRouter(ut.TestCase):
+    def setUp(self):
+        self.router = Router()
+        self.got = {}
+
+    def handler(self, name):
+        return lambda obj: self.got.setdefault(name, []).append(obj)
+
+    def test_route(self):
+        quotes = parse(open('tests/quotes.xml').read(), compact=True)
+        self.router.subscribe(self.handler('all'))
+        self.router.subscribe(self.handler('quotes'), 'quotes')
+        self.router.subscribe(self.handler('lkoh'), 'quotes', seccode='LKOH')
+        self.router.subscribe(self.handler('sber'), 'quotes', seccode='SBER')
+        self.router.subscribe(self.handler('trades'), 'trades')
+        self.router(quotes)
+        self.assertEqual(self.got['all'], [quotes])
+        self.assertEqual(self.got['quotes'], [quotes])
+        self.assertEqual(self.got['lkoh'], [quotes.items[1:]])
+        self.assertNotIn('sber', self.got)
+        self.assertNotIn('trades', self.got)
+
+    def test_keys(self):
+        lkoh = self.handler('lkoh')
+        self.router.subscribe(lkoh, 'quotes', seccode='LKOH')
+        self.router.subscribe(lkoh, 'quotes', secid=3)
+        quotes = parse(open('tests/quotes.xml').read())
+        self.router(quotes)
+        # Каждый элемент хэндлеру один раз
+        self.assertEqual(len(self.got['lkoh']), 1)
+        self.assertEqual([q.seccode for q in self.got['lkoh'][0]], ['LKOH', 'LKOH'])
+        self.router.unsubscribe(lkoh)
+        self.router(quotes)
+        self.assertEqual(len(self.got['lkoh']), 1)
+
+    def test_single(self):
+        # Одиночные сообщения тоже разбираются по ключам
+        self.router.subscribe(self.handler('c1'), 'client', client='c1')
+        self.router(RawMessage('client', b'<client/>'))
+        self.assertNotIn('c1', self.got)
+        self.assertRaises(ValueError, self.router.subscribe, self.handler('x'), 'quotes',
+                          secid=1, client='c1')
+        self.assertRaises(ValueError, self.router.subscribe, self.handler('x'), 'quotes', board='TQBR')
+        self.assertRaises(ValueError, self.router.subscribe, self.handler('x'), secid=1)
+
+
+class TestConflation(ut.TestCase):
+    def setUp(self):
+        self.passed = []
+        self.notified = []
+        self.conflator = QuotationConflator(self.passed.append, self.notified.append)
+
+    def update(self, secid, **fields):
+        xml = "".join("<%s>%s</%s>" % (k, v, k) for k, v in fields.items())
+        self.conflator(parse('<quotations><quotation secid="%d">%s</quotation></quotations>'
+                             % (secid, xml), compact=True))
+
+    def test_merge(self):
+        self.conflator(parse(open('tests/quotations.xml').read()))
+        self.assertEqual(self.notified, [1, 14, 21])
+        self.update(1, bid=171.8)
+        self.update(1, offer=171.9, bid=171.85)
+        self.assertEqual(self.conflator.merged, 2)
+        self.assertEqual(self.conflator.updates, 5)
+        states = self.conflator.take()
+        self.assertEqual([q.secid for q in states], [1, 14, 21])
+        self.assertEqual((states[0].best_bid, states[0].best_offer, states[0].seccode), (171.85, 171.9, 'GAZP'))
+        self.assertEqual(self.conflator.take(), [])
+        # После take() снова уведомляем
+        self.update(14, last=1.5)
+        self.assertEqual(self.notified, [1, 14, 21, 14])
+        self.assertIsNone(self.conflator.take(1))
+        self.assertEqual(self.conflator.take(14).last_price, 1.5)
+        self.assertEqual(self.conflator.get(1).best_bid, 171.85)
+
+    def test_passthrough(self):
+        orders = parse(open('tests/orders.xml').read(), compact=True)
+        self.conflator(orders)
+        self.conflator(orders)
+        self.assertEqual(self.passed, [orders, orders])
+        self.assertEqual(self.conflator.pending, 0)
+
+
+class TestMetrics(ut.TestCase):
+    def test_histogram(self):
+        hist = Histogram((10, 100, 1000))
+        for micros in [5, 7, 50, 500, 5000]:
+            hist.add(micros / 1e6)
+        self.assertEqual(hist.counts, [2, 1, 1, 1])
+        self.assertEqual(hist.count, 5)
+        self.assertAlmostEqual(hist.mean, 1112.4)
+        self.assertAlmostEqual(hist.max, 5000)
+        self.assertEqual(hist.percentile(40), 10)
+        self.assertEqual(hist.percentile(60), 100)
+        self.assertAlmostEqual(hist.percentile(99), 5000)
+        self.assertEqual(Histogram().percentile(50), 0)
+
+    def test_sampling(self):
+        metrics = Metrics(sample=3)
+        timed = [metrics.count('quotes', 100) for i in range(7)]
+        self.assertEqual(timed, [False, False, True, False, False, True, False])
+        metrics.observe('quotes', PARSE, 0.0001)
+        snap = metrics.snapshot()['quotes']
+        self.assertEqual((snap['count'], snap['bytes'], snap['sampled']), (7, 700, 2))
+        self.assertEqual(snap[PARSE]['count'], 1)
+        self.assertEqual(snap[HANDLER]['count'], 0)
+        self.assertIsNone(metrics.histogram('trades', PARSE))
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {})
+
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Команды заявок по шаблонам против построения дерева lxml.
+"""
+
+import datetime
+import unittest as ut
+import lxml.etree as et
+import encoders
+
+
+def _elem(tag, text):
+    elem = et.Element(tag)
+    elem.text = text
+    return elem
+
+
+def _security(root, board, ticker, client, buysell):
+    sec = et.Element("security")
+    sec.append(_elem("board", board))
+    sec.append(_elem("seccode", ticker))
+    root.append(sec)
+    root.append(_elem("client", client))
+    root.append(_elem("buysell", buysell.upper()))
+
+
+# Прежние построители из commands.py
+def lxml_new_order(board, ticker, client, buysell, quantity, price=0, bymarket=True, usecredit=True):
+    root = et.Element("command", {"id": "neworder"})
+    _security(root, board, ticker, client, buysell)
+    root.append(_elem("quantity", str(quantity)))
+    if not bymarket:
+        root.append(_elem("price", str(price)))
+    else:
+        root.append(et.Element("bymarket"))
+    if usecredit:
+        root.append(et.Element("usecredit"))
+    return et.tostring(root, encoding="utf-8")
+
+
+def lxml_new_stoploss(board, ticker, client, buysell, quantity, trigger_price, price=0,
+                      bymarket=True, usecredit=True, linked_order=None, valid_for=None):
+    root = et.Element("command", {"id": "newstoporder"})
+    _security(root, board, ticker, client, buysell)
+    if linked_order:
+        root.append(_elem("linkedorderno", str(linked_order)))
+    if valid_for:
+        root.append(_elem("validfor", valid_for.strftime(encoders.timeformat)))
+    sl = et.Element("stoploss")
+    sl.append(_elem("quantity", str(quantity)))
+    sl.append(_elem("activationprice", str(trigger_price)))
+    if not bymarket:
+        sl.append(_elem("orderprice", str(price)))
+    else:
+        sl.append(et.Element("bymarket"))
+    if usecredit:
+        sl.append(et.Element("usecredit"))
+    root.append(sl)
+    return et.tostring(root, encoding="utf-8")
+
+
+def lxml_cancel(kind, id):
+    root = et.Element("command", {"id": kind})
+    root.append(_elem("transactionid", str(id)))
+    return et.tostring(root, encoding="utf-8")
+
+
+def lxml_move_order(id, price, quantity=0, moveflag=0):
+    root = et.Element("command", {"id": "moveorder"})
+    root.append(_elem("transactionid", str(id)))
+    root.append(_elem("price", str(price)))
+    root.append(_elem("quantity", str(quantity)))
+    root.append(_elem("moveflag", str(moveflag)))
+    return et.tostring(root, encoding="utf-8")
+
+
+BOARDS = ["TQBR", u"FUT"]
+TICKERS = ["SBER", u"RIH5", "A&B", u"<ТИКЕР>", "x\ry"]
+CLIENTS = [u"клиент 1", "C&C>", "   "]
+PRICES = [0, 10, 250.75, 0.1 + 0.2, 1e-07, 12345678901234, "101.5"]
+
+
+class TestEncoders(ut.TestCase):
+    def test_new_order(self):
+        for board in BOARDS:
+            for ticker in TICKERS:
+                for client in CLIENTS:
+                    for price in PRICES:
+                        for flags in ((True, True), (False, True), (False, False), (True, False)):
+                            args = (board, ticker, client, "b", 10, price) + flags
+                            self.assertEqual(encoders.new_order(*args), lxml_new_order(*args), args)
+
+    def test_new_stoploss(self):
+        valid = datetime.datetime(2015, 3, 1, 18, 45, 0)
+        for ticker in TICKERS:
+            for price in PRICES:
+                for linked, valid_for in ((None, None), (4581, valid), (0, None)):
+                    for flags in ((True, True), (False, False)):
+                        args = ("TQBR", ticker, u"клиент", "S", 3, price, price) + flags + (linked, valid_for)
+                        self.assertEqual(encoders.new_stoploss(*args), lxml_new_stoploss(*args), args)
+
+    def test_cancel_move(self):
+        for id in (1, 4581, 12345678901, "77"):
+            self.assertEqual(encoders.cancel_order(id), lxml_cancel("cancelorder", id))
+            self.assertEqual(encoders.cancel_stoploss(id), lxml_cancel("cancelstoporder", id))
+            for price in PRICES:
+                for quantity, moveflag in ((0, 0), (5, 1), (5, 2)):
+                    self.assertEqual(encoders.move_order(id, price, quantity, moveflag),
+                                     lxml_move_order(id, price, quantity, moveflag))
+
+    def test_invalid(self):
+        for ticker in ("SB\x00ER", u"\x1b", u"￿"):
+            self.assertRaises(ValueError, lxml_new_order, "TQBR", ticker, "c", "b", 1)
+            self.assertRaises(ValueError, encoders.new_order, "TQBR", ticker, "c", "b", 1)
+        self.assertRaises(ValueError, encoders.new_order, "TQBR", None, "c", "b", 1)
+
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Фьючерсы заявок по номеру транзакции.
+"""
+
+import unittest as ut
+from structures import *
+from orders import *
+
+
+def orders(*states):
+    # Пакет заявок с заданными (transactionid, status)
+    items = "".join('<order transactionid="%d"><status>%s</status></order>' % state
+                    for state in states)
+    return parse("<orders>%s</orders>" % items, compact=True)
+
+
+def result(id, success=True):
+    return CmdResult.parse('<result success="%s" transactionid="%d"/>'
+                           % ("true" if success else "false", id))
+
+
+class TestOrderTracker(ut.TestCase):
+    def setUp(self):
+        self.tracker = OrderTracker()
+
+    def tearDown(self):
+        # Завершить оставшиеся сроки, чтобы фоновый поток трекера вышел
+        self.tracker.expire(float('inf'))
+        reaper = self.tracker._reaper
+        if reaper is not None:
+            reaper.join(5)
+
+    def test_fixture(self):
+        matched = self.tracker.track(4581)
+        active = self.tracker.track(4531, statuses=['active'])
+        stop = self.tracker.track(4561)
+        for compact in (False, True):
+            self.tracker.on_message(parse(open('tests/orders.xml').read(), compact))
+        self.assertEqual(matched.result(0).status, 'matched')
+        self.assertEqual(active.result(0).id, 4531)
+        self.assertFalse(stop.done())
+        self.assertEqual(stop.order.status, 'watching')
+        self.assertEqual(stop.updates, 2)
+        self.assertEqual(self.tracker.pending, 1)
+
+    def test_lifecycle(self):
+        seen = []
+        future = self.tracker.track(result(7))
+        future.add_update_callback(lambda f: seen.append(f.order.status))
+        self.tracker.on_message(orders((7, 'forwarding'), (8, 'active')))
+        self.tracker.on_message(orders((7, 'active')))
+        self.assertFalse(future.done())
+        self.tracker.on_message(orders((7, 'cancelled')))
+        self.assertEqual(future.result(0).status, 'cancelled')
+        self.assertEqual(seen, ['forwarding', 'active', 'cancelled'])
+        self.assertEqual(self.tracker.pending, 0)
+
+    def test_early(self):
+        # Заявка пришла раньше, чем ее начали отслеживать
+        self.tracker.on_message(orders((9, 'matched')))
+        self.assertEqual(self.tracker.track(9).result(0).status, 'matched')
+
+    def test_failed(self):
+        future = self.tracker.track(result(0, success=False))
+        self.assertRaises(OrderError, future.result, 0)
+
+    def test_timeout(self):
+        future = self.tracker.track(5, timeout=0)
+        other = self.tracker.track(6, timeout=60)
+        self.tracker.on_message(orders((6, 'active')))
+        self.assertRaises(OrderTimeout, future.result, 0)
+        self.assertFalse(other.done())
+        self.assertEqual(self.tracker.pending, 1)
+
+    def test_timeout_silent(self):
+        # Срок истекает и без новых пакетов заявок
+        future = self.tracker.track(5, timeout=0.05)
+        self.tracker.track(6, timeout=0.2)
+        self.assertRaises(OrderTimeout, future.result, 5)
+        self.assertEqual(self.tracker.pending, 1)
+        self.tracker._reaper.join(5)
+        self.assertEqual(self.tracker.pending, 0)
+        self.assertIsNone(self.tracker._reaper)
+
+    def test_reaper_exit(self):
+        # Поток не ждет сроков уже завершенных фьючерсов
+        future = self.tracker.track(5, timeout=60)
+        reaper = self.tracker._reaper
+        self.tracker.on_message(orders((5, 'matched')))
+        self.assertEqual(future.result(0).status, 'matched')
+        reaper.join(5)
+        self.assertFalse(reaper.is_alive())
+        self.assertEqual(self.tracker._deadlines, [])
+        cancelled = self.tracker.track(6, timeout=60)
+        reaper = self.tracker._reaper
+        self.assertTrue(cancelled.cancel())
+        reaper.join(5)
+        self.assertFalse(reaper.is_alive())
+
+    def test_cancelled(self):
+        future = self.tracker.track(5)
+        self.assertTrue(future.cancel())
+        self.tracker.on_message(orders((5, 'matched')))
+        self.assertTrue(future.cancelled())
+        self.assertIsNone(future.order)
+        self.assertEqual(self.tracker.pending, 0)
+
+
+if __name__ == '__main__':
+    ut.main()
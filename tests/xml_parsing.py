@@ -6,6 +6,7 @@ Created on Wed Aug 05 17:09:45 2015
 """
 
 import unittest as ut
+import structures
 from structures import *
 from datetime import datetime as dt
 
@@ -348,6 +349,22 @@ class TestDateTimeMapper(ut.TestCase):
     def test_norm(self):
         self.assertEqual(self.mapper.to_python('11.08.2015 23:08:00'), dt(2015,8,11,23,8))
 
+    def test_fast(self):
+        for text in ('11.08.2015 23:08:00', '11.08.2015 00:00:59', '29.02.2016 12:00:00',
+                     '1.8.2015 9:05:03', '01.08.2015 9:05:03', '31.12.1999 23:59:59'):
+            self.assertEqual(parse_datetime(text), dt.strptime(text, timeformat))
+            self.assertEqual(self.mapper.to_python(text), dt.strptime(text, timeformat))
+        self.assertEqual(self.mapper.to_python('1.08.2015 23:06:34Z'), dt(2015,8,1,23,6,34))
+
+    def test_bad(self):
+        for text in ('29.02.2015 12:00:00', '11.08.2015 24:00:00', '11.13.2015 23:08:00',
+                     '11.08.2015 23:08:+1', '11-08-2015 23:08:00', ''):
+            self.assertRaises(ValueError, parse_datetime, text)
+
+    def test_fields(self):
+        self.assertIsInstance(Trade.time.mapper, TransaqDateTimeMapper)
+        self.assertIsInstance(Order.withdraw_time.mapper, NullableDateTimeMapper)
+
 
 class TestGlobalParse(ut.TestCase):
     def test_candles(self):
@@ -371,6 +388,163 @@ class TestGlobalParse(ut.TestCase):
         self.assertTrue(obj and isinstance(obj,ClientTradePacket))
 
 
+class TestRegistry(ut.TestCase):
+    def test_registered(self):
+        self.assertIs(registered_class('quotations'), QuotationPacket)
+        self.assertIs(registered_class('orders'), ClientOrderPacket)
+        self.assertIs(registered_class('positions'), PositionPacket)
+        self.assertIs(registered_class('trade'), Trade)
+        self.assertIs(registered_class('babe'), None)
+
+    def test_custom(self):
+        @register(root_name='babe')
+        class Babe(Entity):
+            name = StringField('@name')
+
+        o = parse('<babe id="1" name="Jane"/>')
+        self.assertIsInstance(o, Babe)
+        self.assertEqual(o.name, 'Jane')
+        structures._registry.pop('babe')
+
+    def test_unknown(self):
+        self.assertIs(parse('<babe id="1"/>'), None)
+
+
+class TestCompactRecords(ut.TestCase):
+    def test_trades(self):
+        xml = open('tests/alltrades.xml').read()
+        obj = parse(xml)
+        rec = parse(xml, compact=True)
+        self.assertIsInstance(rec, Record)
+        self.assertIs(rec.structure, TradePacket)
+        self.assertEqual(len(rec.items), len(obj.items))
+        for o, r in zip(obj.items, rec.items):
+            self.assertIs(r.structure, Trade)
+            self.assertFalse(hasattr(r, 'node'))
+            for name in Trade.field_names():
+                self.assertEqual(getattr(r, name), getattr(o, name))
+
+    def test_orders(self):
+        xml = open('tests/orders.xml').read()
+        rec = parse(xml, compact=True)
+        self.assertEqual([r.structure for r in rec.items], [Order, Order, TakeProfit, StopLoss])
+        self.assertEqual(rec.items[0].time, dt(2015,8,10,16,11,30))
+        self.assertEqual(rec.items[2].result, u"TP исполнен")
+        self.assertFalse(hasattr(rec.items[3], 'time'))
+
+    def test_nested(self):
+        rec = ClientPortfolio.parse(open('tests/portfolio.xml').read()).to_record()
+        self.assertEqual(rec.money.value_parts[1].register, 'T0')
+        self.assertEqual(rec.securities[0].value_parts[0].balance, 3)
+
+    def test_slots(self):
+        rec = parse('<quote secid="1"><price>1.5</price></quote>', compact=True)
+        self.assertEqual(rec.price, 1.5)
+        self.assertRaises(AttributeError, setattr, rec, 'babe', 1)
+        self.assertEqual(rec, Quote.parse('<quote secid="1"><price>1.5</price></quote>').to_record())
+
+
+class TestExport(ut.TestCase):
+    def test_dict(self):
+        obj = ClientPortfolio.parse(open('tests/portfolio.xml').read())
+        data = obj.to_dict()
+        self.assertEqual(sorted(data), sorted(ClientPortfolio.field_names()))
+        self.assertEqual(data['money']['value_parts'][1]['register'], 'T0')
+        self.assertEqual(obj.to_record().to_dict(), data)
+
+    def test_tuple(self):
+        obj = parse(open('tests/alltrades.xml').read())
+        trade = obj.items[0]
+        self.assertEqual(trade.to_tuple(), tuple(getattr(trade, n) for n in Trade.field_names()))
+        self.assertEqual(obj.to_tuple(), obj.to_record().to_tuple())
+
+    def test_eq(self):
+        xml = open('tests/portfolio.xml').read()
+        self.assertEqual(ClientPortfolio.parse(xml), ClientPortfolio.parse(xml))
+        self.assertNotEqual(CmdResult.parse('<result success="true"/>'),
+                            CmdResult.parse('<result success="false"/>'))
+        # У сущностей равенство по id
+        self.assertEqual(Quote.parse('<quote secid="1"><price>1</price></quote>'),
+                         Quote.parse('<quote secid="1"><price>2</price></quote>'))
+
+    def test_packets(self):
+        # Пакеты с самописным разбором хранят заявки и позиции в items
+        for name in ('orders.xml', 'positions.xml'):
+            xml = open('tests/' + name).read()
+            obj = parse(xml)
+            self.assertTrue(obj.items)
+            data = obj.to_dict()
+            self.assertEqual(len(data['items']), len(obj.items))
+            self.assertEqual(obj.to_tuple(), obj.to_record().to_tuple())
+            self.assertEqual(data, parse(xml, compact=True).to_dict())
+            self.assertEqual(obj, parse(xml))
+            self.assertNotEqual(obj, parse('<%s/>' % obj.ROOT_NAME))
+        orders = parse(open('tests/orders.xml').read())
+        fewer = parse(open('tests/orders.xml').read())
+        fewer.items = fewer.items[:1]
+        self.assertNotEqual(orders, fewer)
+
+    def test_hash(self):
+        # Равные по значениям объекты не должны расходиться в множествах
+        xml = open('tests/orders.xml').read()
+        self.assertRaises(TypeError, hash, parse(xml))
+        self.assertRaises(TypeError, hash, parse(xml, compact=True))
+        order, same = parse(xml).items[0], parse(xml).items[0]
+        self.assertEqual(len(set([order, same])), 1)
+        self.assertNotIn('_cls', vars(structures))
+
+    def test_repr(self):
+        obj = CmdResult.parse('<result success="true" transactionid="5"/>')
+        self.assertEqual(repr(obj), "CmdResult(success=True, id=5)")
+
+
+class TestStreaming(ut.TestCase):
+    def test_candles(self):
+        xml = open('tests/candles.xml').read()
+        stream = iterparse(xml)
+        self.assertEqual(stream.packet, None)
+        items = []
+        for item in stream:
+            self.assertEqual(stream.packet.seccode, 'VTBR')
+            items.append(item)
+        self.assertEqual(items, parse(xml, compact=True).items)
+        self.assertEqual(stream.packet.status, 1)
+
+    def test_securities(self):
+        xml = open('tests/securities.xml').read()
+        stream = SecurityPacket.stream(open('tests/securities.xml', 'rb'), compact=False)
+        items = list(stream)
+        self.assertTrue(all(isinstance(o, Security) for o in items))
+        self.assertEqual([o.to_record() for o in items], parse(xml, compact=True).items)
+        # Обработанные элементы в дереве не копятся
+        self.assertIs(items[0].node.getparent(), None)
+        self.assertEqual(len(items[-1].node.getparent()), 1)
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, ClientOrderPacket.stream, open('tests/orders.xml').read())
+        self.assertEqual(iterparse('<babe/>'), None)
+
+    def test_root_tag(self):
+        self.assertEqual(root_tag('<?xml version="1.0" encoding="utf-8"?>\n<quotes>'), 'quotes')
+        self.assertEqual(root_tag('<server_status connected="true"/>'), 'server_status')
+        self.assertEqual(root_tag('<error>'), 'error')
+        self.assertEqual(root_tag('babe'), None)
+        self.assertEqual(message_tag(ServerStatus.parse('<server_status connected="true"/>')),
+                         'server_status')
+        self.assertEqual(message_tag(RawMessage('quotes', b'<quotes/>')), 'quotes')
+        self.assertIsNone(message_tag(object()))
+
+
+class TestRawMessage(ut.TestCase):
+    def test_parse(self):
+        xml = open('tests/quotes.xml').read()
+        o = RawMessage(root_tag(xml), xml)
+        self.assertEqual(o.tag, 'quotes')
+        self.assertIsInstance(o.parse(), QuotePacket)
+        self.assertEqual(o.parse(compact=True), parse(xml, compact=True))
+        self.assertEqual(list(o.stream()), parse(xml, compact=True).items)
+
+
 class TestEntity(ut.TestCase):
     def test_some(self):
         xml = "<babe id=\"1\"/>"
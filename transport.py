@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Транспорт коннектора: откуда берутся сообщения и куда уходят команды.
+
+Connector работает с любым объектом с функциями библиотеки txmlconnector
+(см. Transport). Обычно это сама dll (commands.load_library), а
+SimulatedTransport - чисто питоновый симулятор, который проигрывает
+записанные или синтетические сообщения (например фикстуры tests/*.xml)
+в коллбэк из своего потока с заданной частотой. С ним путь доставки
+можно гонять и мерить без Windows и брокера::
+
+    sim = SimulatedTransport(fixtures('tests', 'quotes.xml', 'alltrades.xml'), rate=1000)
+    conn = Connector(library=sim)
+    conn.initialize(logdir, 2, handler)
+    conn.connect("login", "password", "localhost:3900")
+    sim.join()
+"""
+import ctypes, glob, logging, os, threading, time
+import lxml.etree as et
+from timeit import default_timer as timer
+
+log = logging.getLogger("transaq.connector")
+
+
+def fixtures(directory, *names):
+    """
+    Сообщения из xml-файлов каталога (все xml, если имена не заданы).
+    Файлы со статусами сервера разбиваются по строкам.
+    Фикстуры tests/ в пакет не входят, каталог указывается явно.
+
+    :param directory:
+        Каталог с файлами сообщений.
+    :return:
+        Список сообщений в байтах.
+    :raises IOError:
+        В каталоге нет xml-файлов.
+    """
+    paths = [os.path.join(directory, name) for name in names] or \
+        sorted(glob.glob(os.path.join(directory, '*.xml')))
+    if not paths:
+        raise IOError("no xml files in %s" % directory)
+    result = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            if 'statuses' in path:
+                result.extend(line.strip() for line in f if line.strip())
+            else:
+                result.append(f.read())
+    return result
+
+
+class Transport(object):
+    """
+    Интерфейс транспорта - функции библиотеки txmlconnector.
+    Сообщения отдаются указателями на память, которую освобождает FreeMemory.
+    """
+
+    def Initialize(self, logdir, loglevel):
+        """
+        Инициализация. Возвращает 0/None или указатель на ошибку.
+        """
+        raise NotImplementedError
+
+    def UnInitialize(self):
+        """
+        Де-инициализация. Возвращает 0/None или указатель на ошибку.
+        """
+        raise NotImplementedError
+
+    def SetCallback(self, callback):
+        """
+        Установить коллбэк входящих сообщений. Возвращает успешность.
+        """
+        raise NotImplementedError
+
+    def SendCommand(self, cmd):
+        """
+        Отправить команду (байты). Возвращает указатель на ответ.
+        """
+        raise NotImplementedError
+
+    def FreeMemory(self, ptr):
+        """
+        Освободить память сообщения.
+        """
+        raise NotImplementedError
+
+
+class MemoryTransport(Transport):
+    """
+    Транспорт в памяти процесса: сообщения лежат в буферах ctypes,
+    пока их не освободят через FreeMemory.
+    """
+
+    def __init__(self):
+        self.callback = None
+        # Неосвобожденные буферы по адресам
+        self.buffers = {}
+        self._lock = threading.Lock()
+
+    def message(self, xml):
+        """
+        Положить сообщение в нативную память.
+
+        :return:
+            Указатель (адрес).
+        """
+        buf = ctypes.create_string_buffer(xml)
+        ptr = ctypes.addressof(buf)
+        with self._lock:
+            self.buffers[ptr] = buf
+        return ptr
+
+    def push(self, xml):
+        """
+        Отдать сообщение в коллбэк.
+
+        :return:
+            Что вернул коллбэк.
+        """
+        return self.callback(self.message(xml))
+
+    def Initialize(self, logdir, loglevel):
+        return None
+
+    def UnInitialize(self):
+        return None
+
+    def SetCallback(self, callback):
+        self.callback = callback
+        return True
+
+    def SendCommand(self, cmd):
+        return self.message('<result success="true"/>')
+
+    def FreeMemory(self, ptr):
+        with self._lock:
+            del self.buffers[ptr]
+
+
+class SimulatedTransport(MemoryTransport):
+    """
+    Симулятор txmlconnector. По команде connect отвечает статусом
+    соединения и начинает проигрывать сообщения в коллбэк из своего потока.
+
+    :param messages:
+        Сообщения (байты) для проигрывания.
+    :param rate:
+        Сообщений в секунду (None - так быстро, как примет коллбэк).
+    :param repeat:
+        Сколько раз проиграть сообщения.
+    :param replies:
+        Ответы на команды: словарь id команды -> xml
+        (по умолчанию успешный result).
+    """
+
+    def __init__(self, messages=(), rate=None, repeat=1, replies=None):
+        super(SimulatedTransport, self).__init__()
+        self.messages = list(messages)
+        self.rate = rate
+        self.repeat = repeat
+        self.replies = dict(replies or {})
+        # Полученные команды (элементы lxml) и число отданных сообщений
+        self.commands = []
+        self.sent = 0
+        self.done = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def SendCommand(self, cmd):
+        command = et.fromstring(cmd)
+        self.commands.append(command)
+        kind = command.get('id')
+        reply = self.message(self.replies.get(kind, '<result success="true"/>'))
+        if kind == 'connect':
+            self.start()
+        elif kind == 'disconnect':
+            self.stop()
+        return reply
+
+    def UnInitialize(self):
+        self.stop()
+        return None
+
+    def start(self):
+        """
+        Начать проигрывание (вызывается по команде connect).
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self.done.clear()
+        self._thread = threading.Thread(target=self._run, name="transaq-simulator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Остановить проигрывание и сообщить об отключении.
+        """
+        thread = self._thread
+        if thread is None:
+            return
+        self._stop.set()
+        if thread is not threading.current_thread():
+            thread.join()
+        self._thread = None
+        self.push('<server_status connected="false"/>')
+
+    def join(self, timeout=None):
+        """
+        Дождаться конца проигрывания.
+
+        :return:
+            True если все сообщения отданы.
+        """
+        return self.done.wait(timeout)
+
+    def _run(self):
+        self.push('<server_status connected="true"/>')
+        interval = 1.0 / self.rate if self.rate else 0
+        start = timer()
+        try:
+            for i in range(self.repeat):
+                for xml in self.messages:
+                    if self._stop.is_set():
+                        return
+                    if interval:
+                        # Держим частоту по расписанию, без накопления ошибки
+                        delay = start + self.sent * interval - timer()
+                        if delay > 0:
+                            time.sleep(delay)
+                    self.push(xml)
+                    self.sent += 1
+        except Exception:
+            log.exception(u"Симулятор остановлен ошибкой")
+        finally:
+            self.done.set()